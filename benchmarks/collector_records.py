@@ -0,0 +1,86 @@
+# Copyright 2017: GoDaddy Inc.
+
+"""Memory used by results of probes that wait in collector queue.
+
+Compares metric records with per sample dicts that were used before. Every
+variant is measured in separated process by growth of its max RSS.
+
+    python benchmarks/collector_records.py [amount of results]
+"""
+
+import collections
+import datetime
+import resource
+import subprocess
+import sys
+
+from netmet.client import records
+
+
+CLIENTS = 1000
+
+
+def _clients():
+    return [{"host": "host-%s" % i, "ip": "10.0.%s.%s" % (i / 256, i % 256),
+             "port": 5000, "az": "az-%s" % (i % 3), "dc": "dc-1",
+             "hypervisor": "hv-%s" % (i / 10)} for i in xrange(CLIENTS)]
+
+
+def _fields(i):
+    return {
+        "protocol": "icmp",
+        "timestamp": datetime.datetime.now().isoformat(),
+        "latency": 0.1 * i,
+        "packet_size": 55,
+        "lost": 0,
+        "transmitted": 1,
+        "ret_code": 0,
+        "dns_latency": 0
+    }
+
+
+def dicts(src, dests, count):
+    queue = collections.deque()
+    for i in xrange(count):
+        metric = _fields(i)
+        metric["client_src"] = src
+        metric["client_dest"] = dests[i % CLIENTS]
+        queue.append({"east-west": metric})
+    return queue
+
+
+def slots(src, dests, count):
+    hosts = records.HostTable()
+    src = hosts.intern(src)
+    dests = [hosts.intern(dest) for dest in dests]
+    queue = collections.deque()
+    for i in xrange(count):
+        queue.append(records.Metric(hosts, "east-west", src,
+                                    dests[i % CLIENTS], **_fields(i)))
+    return queue
+
+
+def measure(variant, count):
+    clients = _clients()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue = globals()[variant](clients[0], clients, count)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(after - before)
+    return queue
+
+
+def main():
+    if len(sys.argv) == 3:
+        measure(sys.argv[1], int(sys.argv[2]))
+        return
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for variant in ["dicts", "slots"]:
+        kb = int(subprocess.check_output(
+            [sys.executable, __file__, variant, str(count)]))
+        print("%s: %s results take %.1f MB (%d bytes per result)"
+              % (variant, count, kb / 1024.0, kb * 1024 / count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Copyright 2017: GoDaddy Inc.
+
+"""Time of building bulk request body for metrics on server.
+
+Compares bulk.Serializer with morph.flatten and json.dumps of every metric
+that were used before. Metrics are east-west metrics of 100 clients to 1000
+destinations, decoded from JSON (separated host objects per metric) and from
+batch format (host objects are shared by metrics of batch).
+
+    python benchmarks/db_bulk_body.py [amount of metrics]
+"""
+
+import datetime
+import json
+import sys
+import time
+
+import morph
+
+from netmet.server.utils import bulk
+
+
+def _host(i):
+    return {"host": "host-%s" % i, "ip": "10.0.%s.%s" % (i / 256, i % 256),
+            "port": 5000, "az": "az-%s" % (i % 3), "dc": "dc-1",
+            "hypervisor": "hv-%s" % (i / 10)}
+
+
+def _metrics(count):
+    hosts = [_host(i) for i in xrange(1000)]
+    timestamp = datetime.datetime.now().isoformat()
+    return [{"client_src": hosts[i / 1000 % 100],
+             "client_dest": hosts[i % 1000],
+             "protocol": "icmp", "timestamp": timestamp,
+             "latency": 0.123 * (i % 100), "packet_size": 55, "lost": 0,
+             "transmitted": 1, "ret_code": 0, "dns_latency": 0}
+            for i in xrange(count)]
+
+
+def old_body(metrics):
+    bulk_body = []
+    for d in metrics:
+        bulk_body.append(json.dumps({"index": {}}))
+        bulk_body.append(json.dumps(morph.flatten(d)))
+    return "\n".join(bulk_body)
+
+
+def new_body(metrics):
+    return "\n".join(bulk.Serializer("east-west").items(metrics))
+
+
+def _measure(name, build, metrics):
+    started_at = time.time()
+    body = build(metrics)
+    duration = time.time() - started_at
+    print("%-22s %6.2f s %8d metrics/s %6.1f MB/s"
+          % (name, duration, len(metrics) / duration,
+             len(body) / duration / 1024 / 1024))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    shared = _metrics(count)
+    separated = json.loads(json.dumps(shared))
+
+    _measure("flatten, json", old_body, separated)
+    _measure("serializer, json", new_body, separated)
+    _measure("flatten, batch", old_body, shared)
+    _measure("serializer, batch", new_body, shared)
+
+
+if __name__ == "__main__":
+    main()
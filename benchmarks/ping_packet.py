@@ -0,0 +1,72 @@
+# Copyright 2017: GoDaddy Inc.
+
+"""Micro benchmark of ICMP echo request creation.
+
+Compares ping.Ping._create_packet() that patches id & sequence into cached
+packet template with the old implementation that computed checksum of the
+whole packet in pure python loop for every probe.
+
+    python benchmarks/ping_packet.py
+"""
+
+import socket
+import struct
+import timeit
+
+import mock
+
+from netmet.utils import ping
+
+
+def legacy_checksum(src):
+    checksum = 0
+    count_to = len(src) & -2
+    count = 0
+    while count < count_to:
+        this_val = ord(src[count + 1]) * 256 + ord(src[count])
+        checksum += this_val
+        checksum &= 0xffffffff
+        count += 2
+    if count_to < len(src):
+        checksum += ord(src[len(src) - 1])
+        checksum &= 0xffffffff
+    checksum = (checksum >> 16) + (checksum & 0xffff)
+    checksum += checksum >> 16
+    answer = ~checksum
+    answer &= 0xffff
+    return answer >> 8 | (answer << 8 & 0xff00)
+
+
+def legacy_create_packet(packet_size, packet_id):
+    header = struct.pack("bbHHh", 8, 0, 0, packet_id, 1)
+    data = packet_size * "Q"
+    header = struct.pack(
+        "bbHHh", 8, 0, socket.htons(legacy_checksum(header + data)),
+        packet_id, 1)
+    return header + data
+
+
+def main(number=20000):
+    print("%-12s %-14s %-14s %s"
+          % ("packet_size", "legacy (us)", "template (us)", "speedup"))
+
+    for packet_size in [55, 500, 1400]:
+        with mock.patch("netmet.utils.ping.socket.socket"):
+            p = ping.Ping("127.0.0.1", packet_size=packet_size)
+
+        for i in xrange(100):
+            assert (legacy_create_packet(packet_size, i)
+                    == p._create_packet(i))
+
+        legacy = timeit.timeit(
+            lambda: legacy_create_packet(packet_size, 12345), number=number)
+        template = timeit.timeit(
+            lambda: p._create_packet(12345), number=number)
+
+        print("%-12s %-14.2f %-14.2f %.1fx"
+              % (packet_size, legacy / number * 10 ** 6,
+                 template / number * 10 ** 6, legacy / template))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Copyright 2017: GoDaddy Inc.
+
+"""Compares user space and kernel receive timestamps under CPU load.
+
+Pings 127.0.0.1 through ping.Engine with and without kernel_timestamps,
+first on idle interpreter and then with python threads burning CPU (GIL
+contention similar to busy collector). Loopback RTT is a few microseconds,
+so everything above that is measurement noise. Requires root.
+
+    sudo PYTHONPATH=. python benchmarks/ping_timestamps.py
+"""
+
+import threading
+import time
+
+from netmet.utils import ping
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def measure(kernel_timestamps, count):
+    engine = ping.Engine(kernel_timestamps=kernel_timestamps)
+    engine.start()
+    if engine.ret_code:
+        raise SystemExit("Can't open raw socket (code %s), run as root"
+                         % engine.ret_code)
+
+    pinger = ping.Ping("127.0.0.1", engine=engine)
+    rtts = []
+    try:
+        for _ in xrange(count):
+            result = pinger.ping()
+            if result["rtt"] is not None:
+                rtts.append(result["rtt"])
+            time.sleep(0.002)
+    finally:
+        engine.stop()
+    return rtts
+
+
+def burn(death):
+    while not death.is_set():
+        sum(xrange(1000))
+
+
+def main(count=500, load_threads=8):
+    print("%-8s %-8s %-10s %-10s %-10s"
+          % ("load", "kernel", "p50 (ms)", "p99 (ms)", "max (ms)"))
+
+    for load in [0, load_threads]:
+        death = threading.Event()
+        threads = [threading.Thread(target=burn, args=(death,))
+                   for _ in xrange(load)]
+        for t in threads:
+            t.start()
+        try:
+            for kernel_timestamps in [False, True]:
+                rtts = measure(kernel_timestamps, count)
+                print("%-8s %-8s %-10.3f %-10.3f %-10.3f"
+                      % (load, kernel_timestamps, percentile(rtts, 0.5),
+                         percentile(rtts, 0.99), max(rtts)))
+        finally:
+            death.set()
+            for t in threads:
+                t.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Copyright 2017: GoDaddy Inc.
+
+"""Size of metrics upload and time of its decoding on server.
+
+Encodes batch of 1000 east-west ICMP metrics to 1000 destinations as plain
+JSON (how Pusher sent them before) and in compact batch format, both with
+and without gzip.
+
+    python benchmarks/pusher_batch.py
+"""
+
+import datetime
+import json
+import timeit
+
+from netmet.client import records
+from netmet.utils import batch
+
+
+def _metrics(count=1000):
+    hosts = records.HostTable()
+    src = hosts.intern({"host": "host-0", "ip": "10.0.0.1", "port": 5000,
+                        "az": "az-0", "dc": "dc-1", "hypervisor": "hv-0"})
+    metrics = []
+    for i in xrange(count):
+        dest = hosts.intern({
+            "host": "host-%s" % i, "ip": "10.0.%s.%s" % (i / 256, i % 256),
+            "port": 5000, "az": "az-%s" % (i % 3), "dc": "dc-1",
+            "hypervisor": "hv-%s" % (i / 10)})
+        metrics.append(records.Metric(
+            hosts, "east-west", src, dest, protocol="icmp",
+            timestamp=datetime.datetime.now().isoformat(), latency=0.1 * i,
+            packet_size=55, lost=0, transmitted=1, ret_code=0,
+            dns_latency=0))
+    return metrics
+
+
+def main():
+    metrics = _metrics()
+    variants = {
+        "json": (json.dumps(metrics, default=records.to_dict), json.loads),
+        "batch": (batch.dumps(metrics), batch.loads)
+    }
+    for name in ["json", "batch"]:
+        data, decode = variants[name]
+        compressed = batch.compress(data)
+        print("%-12s %7d bytes, decode %.2f ms"
+              % (name, len(data), timeit.timeit(
+                  lambda: decode(data), number=20) / 20 * 1000))
+        print("%-12s %7d bytes, decode %.2f ms"
+              % (name + "+gzip", len(compressed), timeit.timeit(
+                  lambda: decode(batch.decompress(compressed)),
+                  number=20) / 20 * 1000))
+
+
+if __name__ == "__main__":
+    main()
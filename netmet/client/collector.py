@@ -1,18 +1,22 @@
 # Copyright 2017: GoDaddy Inc.
 
 import collections
-import datetime
+import functools
+import json
 import logging
-import random
 import threading
 
 import futurist
 import futurist.rejection
-import monotonic
-import requests
 
+from netmet.client import conf
+from netmet.client import records
+from netmet import config
+from netmet.utils import httping
 from netmet.utils import ping
 from netmet.utils import pusher
+from netmet.utils import resolver
+from netmet.utils import scheduler
 from netmet.utils import secure
 
 LOG = logging.getLogger(__name__)
@@ -26,94 +30,121 @@ class Collector(object):
         self.tasks = tasks
         self.pusher = None
         if netmet_server:
-            netmet_server = netmet_server.rstrip("/")
-            self.pusher = pusher.Pusher("%s/api/v1/metrics" % netmet_server,
-                                        extra_headers=secure.gen_hmac_headers)
-
+            url = "%s/api/v1/metrics" % netmet_server.rstrip("/")
+            self.pusher = pusher.Pusher(
+                url,
+                extra_headers=functools.partial(secure.gen_hmac_headers,
+                                                url=url),
+                on_response=functools.partial(secure.learn_hmac_version, url),
+                json_default=records.to_dict,
+                spool_dir=conf.spool_dir(config.get("port", None)),
+                drain_rate=config.get("pusher_drain_rate", None),
+                compact=True, compress=True, adaptive=True)
+
+        self.engine = ping.Engine(
+            kernel_timestamps=config.get("icmp_kernel_timestamps", False))
+        self.resolver = resolver.get()
+        self.http_pool = httping.ConnectionPool()
+        self.backend = config.get("collector_backend", "threads")
+        self.max_workers = config.get("collector_workers", 50)
+        self.schedule_policy = config.get("collector_schedule_policy",
+                                          scheduler.SKIP)
+        self.schedulers = []
         self.lock = threading.Lock()
         self.queue = collections.deque()
+        self.hosts = records.HostTable()
         self.death = threading.Event()
+        self.tasks_death = threading.Event()
         self.started = False
         self.main_thread = None
         self.processing_thread = None
 
+    def _metric_factory(self, task):
+        """Returns function that creates metric records for task."""
+        kind = task.keys()[0]
+        return functools.partial(records.Metric, self.hosts, kind,
+                                 self.hosts.intern(self.client_host),
+                                 self.hosts.intern(task[kind]["dest"]))
+
     def gen_periodic_ping(self, task):
 
         ip = (task["north-south"]["dest"] if "north-south" in task else
               task["east-west"]["dest"]["ip"])
         settings = task[task.keys()[0]]["settings"]
         pinger = ping.Ping(ip, timeout=settings["timeout"],
-                           packet_size=settings["packet_size"])
+                           packet_size=settings["packet_size"],
+                           engine=self.engine, resolver=self.resolver)
+        new_metric = self._metric_factory(task)
+
+        def report(result):
+            metric = {
+                "protocol": "icmp",
+                "timestamp": result["timestamp"],
+                "latency": result["rtt"],
+                "packet_size": result["packet_size"],
+                "lost": int(bool(result["ret_code"])),
+                "transmitted": int(not bool(result["ret_code"])),
+                "ret_code": result["ret_code"],
+                "dns_latency": result["dns_latency"]
+            }
+
+            if "count" in result:
+                metric.update({
+                    "latency_min": result["rtt_min"],
+                    "latency_max": result["rtt_max"],
+                    "latency_stddev": result["rtt_stddev"],
+                    "jitter": result["jitter"],
+                    "lost": result["lost"],
+                    "transmitted": result["received"]
+                })
+
+            self.queue.append(new_metric(**metric))
 
         def ping_():
+            # Doesn't wait for reply, report() is called by ICMP engine
+            # when reply arrives or when probe times out.
             try:
-                result = pinger.ping()
-
-                metric = {
-                    "client_src": self.client_host,
-                    "protocol": "icmp",
-                    "timestamp": result["timestamp"],
-                    "latency": result["rtt"],
-                    "packet_size": result["packet_size"],
-                    "lost": int(bool(result["ret_code"])),
-                    "transmitted": int(not bool(result["ret_code"])),
-                    "ret_code": result["ret_code"]
-                }
-
-                if "north-south" in task:
-                    metric["dest"] = task["north-south"]["dest"]
-                    self.queue.append({"north-south": metric})
-
+                if settings.get("count", 1) > 1:
+                    pinger.ping_train(settings["count"],
+                                      settings.get("interval", 0.01), report)
                 else:
-                    metric["client_dest"] = task["east-west"]["dest"]
-                    self.queue.append({"east-west": metric})
-
+                    pinger.ping_async(report)
             except Exception:
                 LOG.exception(self.pinger_failed_msg)
 
         return ping_
 
     def gen_periodic_http_ping(self, task):
+        settings = task[task.keys()[0]]["settings"]
+        if "east-west" in task:
+            dest = task["east-west"]["dest"]
+            url = "http://%s:%s" % (dest["host"], dest["port"])
+        else:
+            url = task["north-south"]["dest"]
+
+        pinger = httping.HTTPPing(url, timeout=settings["timeout"],
+                                  keepalive=settings.get("keepalive", False),
+                                  pool=self.http_pool, resolver=self.resolver)
+        new_metric = self._metric_factory(task)
 
         def http_ping():
             try:
-                started_at = monotonic.monotonic()
-
-                metric = {
-                    "client_src": self.client_host,
-                    "protocol": "http",
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "packet_size": 0,
-                    "latency": 0,
-                    "lost": 1,
-                    "transmitted": 0,
-                    "ret_code": 504
-                }
-                settings = task[task.keys()[0]]["settings"]
-
-                if "east-west" in task:
-                    dest = task["east-west"]["dest"]
-                    metric["client_dest"] = dest
-                    dest = "http://%s:%s" % (dest["host"], dest["port"])
-                else:
-                    dest = task["north-south"]["dest"]
-                    metric["dest"] = dest
-
-                r = requests.get(dest, timeout=settings["timeout"])
-                metric.update({
-                    "latency": (monotonic.monotonic() - started_at) * 1000,
-                    "packet_size": len(r.content),
-                    "lost": int(r.status_code != 200),
-                    "transmitted": int(r.status_code == 200),
-                    "ret_code": r.status_code
-                })
-            except requests.exceptions.ConnectionError:
-                pass
+                result = pinger.ping()
             except Exception:
                 LOG.exception("Collector failed to call another clinet API")
-            finally:
-                type_ = "east-west" if "east-west" in task else "north-south"
-                self.queue.append({type_: metric})
+                return
+
+            self.queue.append(new_metric(
+                protocol="http",
+                timestamp=result["timestamp"],
+                packet_size=result["size"],
+                latency=result["latency"],
+                dns_latency=result["dns_latency"],
+                connect_latency=result["connect_latency"],
+                ttfb_latency=result["ttfb_latency"],
+                lost=int(result["ret_code"] != 200),
+                transmitted=int(result["ret_code"] == 200),
+                ret_code=result["ret_code"]))
 
         return http_ping
 
@@ -128,85 +159,172 @@ class Collector(object):
 
             self.death.wait(0.1)
 
-    def _job_per_period(self, callables, period):
-
-        def helper():
-            delay = period / float(len(callables))
-            pool = futurist.ThreadPoolExecutor(
-                max_workers=50,
-                check_and_reject=futurist.rejection.reject_when_reached(50))
-
-            with pool:
-                while not self.death.is_set():
-                    for item in callables:
-                        while not self.death.is_set():
-                            try:
-                                pool.submit(item)
-                                break
-                            except futurist.RejectedSubmission:
-                                LOG.warning("Collector: Feed me! Mre threads!")
-                                self.death.wait(delay)
-
-                        self.death.wait(delay)
-
-                    # up to 0.1 second delay  between runs of tasks
-                    self.death.wait(random.random() * min(delay, 1) / 10.0)
-        return helper
+    def _gen_tasks(self):
+        """Returns list of (period, callable, inline, phase) for each task.
 
-    def _job(self):
+        inline callables don't block: they send ICMP request to ip address
+        and return, reply is handled by ICMP engine. Hostnames may be
+        resolved synchronously, so they are pinged by workers. phase of task
+        in its period is stable for the same client and task.
+        """
         generators = {
             "icmp": self.gen_periodic_ping,
             "http": self.gen_periodic_http_ping
         }
 
-        period_tasks = {}
+        tasks = []
         for task in self.tasks:
             task_data = task.values()[0]
-            period_ = task_data["settings"]["period"]
+            settings = task_data["settings"]
             protocol = task_data["protocol"]
-            period_tasks.setdefault(period_, [])
             if protocol in generators:
-                period_tasks[period_].append(generators[protocol](task))
+                dest = task_data.get("dest")
+                dest = dest.get("ip") if isinstance(dest, dict) else dest
+                inline = (protocol == "icmp" and resolver.is_ip(dest)
+                          and settings.get("count", 1) <= 1)
+                phase = scheduler.phase(json.dumps([self.client_host, task],
+                                                   sort_keys=True))
+                tasks.append((settings["period"], generators[protocol](task),
+                              inline, phase))
             else:
                 LOG.warning("Allowed protocols are: %s" % generators.keys())
+        return tasks
+
+    def _submitter(self, pool):
+        def submit(task):
+            try:
+                pool.submit(task)
+            except futurist.RejectedSubmission:
+                return False
+        return submit
 
-        pool = futurist.ThreadPoolExecutor(max_workers=len(period_tasks))
+    def _job_per_period(self, scheduler, death):
+
+        def helper():
+            pool = futurist.ThreadPoolExecutor(
+                max_workers=50,
+                check_and_reject=futurist.rejection.reject_when_reached(50))
+
+            with pool:
+                scheduler.run(death, self._submitter(pool))
+        return helper
+
+    def _job_threads(self, tasks, death=None):
+        death = death or self.death
+        period_schedulers = {}
+        for period, callable_, _, phase in tasks:
+            if period not in period_schedulers:
+                period_schedulers[period] = scheduler.Scheduler(
+                    policy=self.schedule_policy)
+            period_schedulers[period].add(period, callable_, phase=phase)
+        self.schedulers = period_schedulers.values()
+
+        pool = futurist.ThreadPoolExecutor(max_workers=len(period_schedulers))
         with pool:
-            min_period = min(period_tasks)
-            min_lag = float(min_period) / len(period_tasks[min_period])
-            lag = min(min_lag / len(period_tasks), 1)
+            for scheduler_ in self.schedulers:
+                pool.submit(self._job_per_period(scheduler_, death))
+
+    def _job_events(self, tasks, death=None):
+        """Runs all tasks from one thread and one bounded pool of workers.
+
+        Amount of threads doesn't depend on amount of tasks: inline tasks are
+        called from this thread, others are executed by max_workers threads.
+        If max_workers runs are already waiting for workers, run is skipped.
+        """
+        death = death or self.death
+        scheduler_ = scheduler.Scheduler(policy=self.schedule_policy)
+        for period, callable_, inline, phase in tasks:
+            scheduler_.add(period, (callable_, inline), phase=phase)
+        self.schedulers = [scheduler_]
+
+        pool = futurist.ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            check_and_reject=futurist.rejection.reject_when_reached(
+                self.max_workers))
+        submit = self._submitter(pool)
+
+        def dispatch(task):
+            callable_, inline = task
+            if inline:
+                callable_()
+            else:
+                return submit(callable_)
+
+        with pool:
+            scheduler_.run(death, dispatch)
+
+    def _job(self, death=None):
+        """Runs tasks until death (by default death of collector) is set."""
+        death = death or self.death
+        tasks = self._gen_tasks()
+        if not tasks:
+            return
+
+        if self.backend == "events":
+            self._job_events(tasks, death)
+        else:
+            self._job_threads(tasks, death)
 
-            LOG.info(period_tasks)
-            for period, callables in period_tasks.iteritems():
-                pool.submit(self._job_per_period(callables, period))
-                self.death.wait(lag)
+    def stats(self):
+        """Returns stats of task schedulers, lag is in ms."""
+        return {"scheduler": scheduler.merge_stats(
+            s.stats() for s in self.schedulers)}
 
     def start(self):
         with self.lock:
             if not self.started:
                 self.started = True
                 self.death = threading.Event()
+                self.tasks_death = threading.Event()
             else:
                 return
 
         if self.pusher:
             self.pusher.start()
 
-        self.main_thread = threading.Thread(target=self._job)
-        self.main_thread.daemon = True
-        self.main_thread.start()
+        self.engine.start()
+        if self.engine.ret_code:
+            LOG.warning("Collector: can't start ICMP engine (code %s)"
+                        % self.engine.ret_code)
+
+        self._start_tasks()
 
         self.processing_thread = threading.Thread(target=self.process_results)
         self.processing_thread.deamon = True
         self.processing_thread.start()
         return True
 
+    def _start_tasks(self):
+        self.main_thread = threading.Thread(target=self._job,
+                                            args=(self.tasks_death,))
+        self.main_thread.daemon = True
+        self.main_thread.start()
+
+    def update_tasks(self, tasks):
+        """Replaces tasks, pusher and ICMP engine keep running.
+
+        Phase of task depends only on client and task, so tasks that are
+        kept are run at the same time of their periods as before.
+        """
+        with self.lock:
+            self.tasks = tasks
+            if self.started and not self.death.is_set():
+                self.tasks_death.set()
+                self.main_thread.join()
+                self.tasks_death = threading.Event()
+                self._start_tasks()
+
     def stop(self):
         with self.lock:
             if self.started and not self.death.is_set():
-                self.death.set()
+                self.tasks_death.set()
                 self.main_thread.join()
+                # engine reports probes that are in flight as lost, so it's
+                # stopped before results processing
+                self.engine.stop()
+                self.death.set()
                 self.processing_thread.join()
+                self.http_pool.close()
                 if self.pusher:
                     self.pusher.stop()
                 self.started = False
@@ -14,6 +14,7 @@ LOG = logging.getLogger(__name__)
 
 _RUNTIME_CONF_DIR = "/var/run/netmet/"
 _RUNTIME_CONF_FILE = _RUNTIME_CONF_DIR + "restore_api_%s"
+_SPOOL_DIR = _RUNTIME_CONF_DIR + "spool_%s"
 _RESTORE_API = "%(server)s/api/v1/clients/%(host)s/%(port)s"
 
 
@@ -27,7 +28,8 @@ def restore(hmacs, port):
         for hmac in hmacs:
             try:
                 r = requests.post(
-                    url, headers=secure.gen_hmac_headers("", hmac))
+                    url, headers=secure.gen_hmac_headers("", hmac, url=url))
+                secure.learn_hmac_version(url, r)
 
                 if r.status_code == 403:
                     continue
@@ -89,3 +91,8 @@ def restore_url_clear(port):
         os.remove(_RUNTIME_CONF_FILE % port)
     except OSError:
         pass
+
+
+def spool_dir(port):
+    """Returns directory where metrics are spooled while server is down."""
+    return _SPOOL_DIR % port if port else None
@@ -66,6 +66,18 @@ def get_config():
         return flask.jsonify({"error": "Netmet is not configured"}), 404
 
 
+@APP.route("/api/v2/collector/stats", methods=['GET'])
+def get_collector_stats():
+    """Returns stats of collector, e.g. lag of its scheduler."""
+    global _COLLECTOR
+
+    collector_ = _COLLECTOR
+    if collector_:
+        return flask.jsonify(collector_.stats()), 200
+    else:
+        return flask.jsonify({"error": "Netmet is not configured"}), 404
+
+
 @APP.route("/api/v2/config", methods=['POST'])
 @secure.check_hmac_auth
 def set_config_v2():
@@ -95,7 +107,10 @@ def set_config_v2():
                 "properties": {
                     "packet_size": {"type": "number", "minimum": 1},
                     "period": {"type": "number", "minimum": 0.1},
-                    "timeout": {"type": "number", "minimum": 0.01}
+                    "timeout": {"type": "number", "minimum": 0.01},
+                    "count": {"type": "integer", "minimum": 1},
+                    "interval": {"type": "number", "minimum": 0},
+                    "keepalive": {"type": "boolean"}
                 },
                 "required": ["period", "timeout"],
                 "additionProperties": False
@@ -173,15 +188,24 @@ def set_config_v2():
         return flask.jsonify({"error": "Bad request: %s" % e}), 400
 
     with _LOCK:
-        if _COLLECTOR:
-            _COLLECTOR.stop()
+        if _COLLECTOR and data == _CONFIG:
+            return flask.jsonify({"message": "Config is not changed"}), 200
+
+        if (_COLLECTOR and
+                data["netmet_server"] == _CONFIG["netmet_server"] and
+                data["client_host"] == _CONFIG["client_host"]):
+            # only tasks are changed, so collector is not restarted
+            _COLLECTOR.update_tasks(data["tasks"])
+        else:
+            if _COLLECTOR:
+                _COLLECTOR.stop()
 
+            conf.restore_url_set(data["netmet_server"],
+                                 data["client_host"]["host"],
+                                 data["client_host"]["port"])
+            _COLLECTOR = collector.Collector(**data)
+            _COLLECTOR.start()
         _CONFIG = data
-        conf.restore_url_set(data["netmet_server"],
-                             data["client_host"]["host"],
-                             data["client_host"]["port"])
-        _COLLECTOR = collector.Collector(**data)
-        _COLLECTOR.start()
 
     return flask.jsonify({"message": "Succesfully update netmet config"}), 201
 
@@ -0,0 +1,72 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+
+from netmet.utils import batch
+
+
+class HostTable(object):
+    """Stores every host once, records refer to hosts by index.
+
+    Hosts are interned by value, as every update of tasks brings new host
+    objects, so table grows only with new hosts.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self.hosts = []
+
+    def intern(self, host):
+        key = json.dumps(host, sort_keys=True)
+        idx = self._index.get(key)
+        if idx is None:
+            idx = self._index[key] = len(self.hosts)
+            self.hosts.append(host)
+        return idx
+
+
+class Metric(object):
+    """Result of probe that is expanded to document only when it's sent.
+
+    kind is "north-south" or "east-west", src and dest are indexes in hosts
+    table. Optional fields that are not set are not present in document.
+    """
+
+    FIELDS = ("protocol", "timestamp", "latency", "packet_size", "lost",
+              "transmitted", "ret_code", "dns_latency", "connect_latency",
+              "ttfb_latency", "latency_min", "latency_max", "latency_stddev",
+              "jitter")
+
+    __slots__ = ("hosts", "kind", "src", "dest") + FIELDS
+
+    def __init__(self, hosts, kind, src, dest, **fields):
+        self.hosts = hosts
+        self.kind = kind
+        self.src = src
+        self.dest = dest
+        for k, v in fields.iteritems():
+            setattr(self, k, v)
+
+    def compact(self):
+        """Returns kind, src host, dest host and dict of set fields."""
+        fields = {}
+        for field in self.FIELDS:
+            try:
+                fields[field] = getattr(self, field)
+            except AttributeError:
+                pass
+        hosts = self.hosts.hosts
+        return self.kind, hosts[self.src], hosts[self.dest], fields
+
+    def to_dict(self):
+        return batch.document(*self.compact())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+def to_dict(obj):
+    """json.dumps() default hook that expands metric records."""
+    if isinstance(obj, Metric):
+        return obj.to_dict()
+    raise TypeError("%r is not JSON serializable" % obj)
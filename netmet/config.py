@@ -1,11 +1,14 @@
 # Copyright 2017: GoDaddy Inc.
 
 _DATA = {}
+_MISSING = object()
 
 
 def set(key, value):
     _DATA[key] = value
 
 
-def get(key):
-    return _DATA[key]
+def get(key, default=_MISSING):
+    if default is _MISSING:
+        return _DATA[key]
+    return _DATA.get(key, default)
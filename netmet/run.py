@@ -11,6 +11,8 @@ from netmet.client import main as client_main
 from netmet import config
 from netmet.server import main as server_main
 from netmet.utils import asyncer
+from netmet.utils import scheduler
+from netmet.utils import secure
 
 
 LOG = logging.getLogger(__name__)
@@ -85,6 +87,30 @@ def load():
     hmacs, check_hmac = _parse_hmac()
     config.set("hmac_keys", hmacs)
     config.set("hmac_skip_check", check_hmac)
+    # by default hmac version is negotiated with every peer
+    hmac_version = os.getenv("NETMET_HMAC_VERSION")
+    if hmac_version and (not hmac_version.isdigit() or (
+            int(hmac_version) not in secure.HMAC_VERSIONS)):
+        raise ValueError("NETMET_HMAC_VERSION should be one of %s"
+                         % secure.HMAC_VERSIONS)
+    config.set("hmac_version", hmac_version and int(hmac_version))
+    config.set("icmp_kernel_timestamps",
+               bool(os.getenv("NETMET_ICMP_KERNEL_TIMESTAMPS")))
+
+    backend = os.getenv("NETMET_COLLECTOR_BACKEND", "threads")
+    if backend not in ["threads", "events"]:
+        raise ValueError("NETMET_COLLECTOR_BACKEND should be 'threads' or "
+                         "'events'")
+    config.set("collector_backend", backend)
+    config.set("collector_workers",
+               int(os.getenv("NETMET_COLLECTOR_WORKERS", 50)))
+    policy = os.getenv("NETMET_COLLECTOR_SCHEDULE_POLICY", scheduler.SKIP)
+    if policy not in scheduler.POLICIES:
+        raise ValueError("NETMET_COLLECTOR_SCHEDULE_POLICY should be one of "
+                         "%s" % scheduler.POLICIES)
+    config.set("collector_schedule_policy", policy)
+    config.set("pusher_drain_rate",
+               float(os.getenv("NETMET_PUSHER_DRAIN_RATE", 0)) or None)
 
     app = mode.load()
     http_server = wsgi.WSGIServer((os.getenv("HOST", ""), port), app)
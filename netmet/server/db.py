@@ -2,34 +2,75 @@
 
 import copy
 import datetime
+import hashlib
 import json
 import logging
+import random
+import threading
+import time
 
+import cachetools
 import elasticsearch
+import monotonic
 import morph
 
 from netmet import exceptions
+from netmet.server.utils import bulk
 from netmet.utils import worker
 
 
 LOG = logging.getLogger(__name__)
 
-# Use streaming API instead of this
-# Elastic doesn't allow to query more than 10k elements (for the reason)
-MAX_AMOUNT_OF_SERVERS = 10000
+_MISSING = object()
 
 
 def get():
     return DB.get()
 
 
+def _rollup_mapping(dest_fields):
+    properties = {
+        "timestamp": {"type": "date"},
+        "protocol": {"type": "keyword"},
+        "count": {"type": "long"},
+        "transmitted": {"type": "long"},
+        "lost": {"type": "long"},
+        "latency_min": {"type": "float"},
+        "latency_max": {"type": "float"},
+        "latency_avg": {"type": "float"},
+        "latency_sum": {"type": "double"},
+        "latency_count": {"type": "long"},
+        "latency_p50": {"type": "float"},
+        "latency_p90": {"type": "float"},
+        "latency_p99": {"type": "float"}
+    }
+    for field in ["client_src.host", "client_src.az", "client_src.dc"]:
+        properties[field] = {"type": "keyword"}
+    for field in dest_fields:
+        properties[field] = {"type": "keyword"}
+    return {"dynamic": "strict", "properties": properties}
+
+
+def _floor(dt, interval):
+    """Rounds datetime down to interval (in seconds) that divides day."""
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    seconds = int((dt - day).total_seconds()) // interval * interval
+    return day + datetime.timedelta(seconds=seconds)
+
+
 class DB(worker.LonelyWorker):
-    _period = 600   # every 10 minutes check needs to rollover index
+    _period = 60   # every minute rollup metrics & check rollover of index
 
     _CATALOG_IDX = "netmet_catalog"
     _DATA_ALIAS = "netmet_data_v2"
     _DATA_IDX = "<%s-{now/d}-000001>" % _DATA_ALIAS
     _EVENTS_IDX = "netmet_events"
+    _DEAD_LETTERS_IDX = "netmet_dead_letters"
+    _ROLLUP_IDX = "netmet_rollup_%s"
+
+    # Bulk response without details of successfully stored items
+    _BULK_FILTER = ("errors,items.*.status,items.*.error.type,"
+                    "items.*.error.reason")
 
     _CATALOG = {
         "settings": {
@@ -49,7 +90,8 @@ class DB(worker.LonelyWorker):
                     "hypervisor": {"type": "keyword"},
                     "az": {"type": "keyword"},
                     "dc": {"type": "keyword"},
-                    "configured": {"type": "boolean"}
+                    "configured": {"type": "boolean"},
+                    "tasks_hash": {"type": "keyword", "index": False}
                 }
             },
             "config": {
@@ -88,6 +130,13 @@ class DB(worker.LonelyWorker):
                     "packet_size": {"type": "integer"},
                     "lost": {"type": "integer"},
                     "latency": {"type": "float"},
+                    "latency_min": {"type": "float"},
+                    "latency_max": {"type": "float"},
+                    "latency_stddev": {"type": "float"},
+                    "jitter": {"type": "float"},
+                    "dns_latency": {"type": "float"},
+                    "connect_latency": {"type": "float"},
+                    "ttfb_latency": {"type": "float"},
                     "ret_code": {"type": "integer"},
                     "events": {"type": "keyword"}
                 }
@@ -113,6 +162,13 @@ class DB(worker.LonelyWorker):
                     "transmitted": {"type": "integer"},
                     "lost": {"type": "integer"},
                     "latency": {"type": "float"},
+                    "latency_min": {"type": "float"},
+                    "latency_max": {"type": "float"},
+                    "latency_stddev": {"type": "float"},
+                    "jitter": {"type": "float"},
+                    "dns_latency": {"type": "float"},
+                    "connect_latency": {"type": "float"},
+                    "ttfb_latency": {"type": "float"},
                     "ret_code": {"type": "integer"},
                     "events": {"type": "keyword"}
                 }
@@ -145,6 +201,88 @@ class DB(worker.LonelyWorker):
         }
     }
 
+    _DEAD_LETTERS = {
+        "settings": {
+            "index": {
+                "number_of_shards": 1,
+                "number_of_replicas": 1
+            }
+        },
+        "mappings": {
+            "metrics": {
+                "dynamic": "strict",
+                "properties": {
+                    "timestamp": {"type": "date"},
+                    "status": {"type": "integer"},
+                    "error": {"type": "text"},
+                    "item": {"type": "text", "index": False}
+                }
+            }
+        }
+    }
+
+    # Metrics aggregated per minute and per hour. Rollup of period is done
+    # when metrics of it are likely delivered: after _ROLLUP_DELAY seconds.
+    _ROLLUPS = [("1m", 60), ("1h", 3600)]
+    _ROLLUP_DELAY = 180
+    _ROLLUP_MAX_PERIODS = 30
+    # Server takes rollup of index by lease in its checkpoint for this amount
+    # of seconds, lease of crashed server expires
+    _ROLLUP_LEASE = 300
+    _ROLLUP_MAX_BUCKETS = 10000
+    _ROLLUP_PERCENTS = [50, 90, 99]
+    _ROLLUP_KEYS = {
+        "east-west": ["client_src.host", "client_src.az", "client_src.dc",
+                      "client_dest.host", "client_dest.az", "client_dest.dc",
+                      "protocol"],
+        "north-south": ["client_src.host", "client_src.az", "client_src.dc",
+                        "dest", "protocol"]
+    }
+
+    _ROLLUP = {
+        "settings": {
+            "index": {
+                "number_of_shards": 5,
+                "number_of_replicas": 1
+            }
+        },
+        "mappings": {
+            "east-west": _rollup_mapping(
+                ["client_dest.host", "client_dest.az", "client_dest.dc"]),
+            "north-south": _rollup_mapping(["dest"]),
+            "checkpoint": {
+                "dynamic": "strict",
+                "properties": {
+                    "timestamp": {"type": "date"},
+                    "owner": {"type": "keyword"},
+                    "lease_until": {"type": "date"}
+                }
+            }
+        }
+    }
+
+    # Results of metrics_matrix() are cached for short time, as dashboards
+    # poll the same matrices
+    _MATRIX_CACHE_SIZE = 100
+    _MATRIX_CACHE_TTL = 15
+    _MATRIX_MAX_BUCKETS = 1000
+
+    # Clients and configs are cached in memory. Cache is invalidated by
+    # writes of this process and when worker or read with cached=False
+    # finds that the latest config (its id or _version) was changed by
+    # other server. _CATALOG_TTL limits age of cache anyway.
+    _CATALOG_TTL = 300
+
+    def __init__(self):
+        super(DB, self).__init__()
+        self._matrix_cache = cachetools.TTLCache(self._MATRIX_CACHE_SIZE,
+                                                 self._MATRIX_CACHE_TTL)
+        self._matrix_lock = threading.Lock()
+        self._catalog = {}
+        self._catalog_stamp = 0
+        self._catalog_version = None
+        self._catalog_lock = threading.Lock()
+
     @classmethod
     def create(cls, own_url, elastic):
         super(DB, cls).create()
@@ -163,11 +301,184 @@ class DB(worker.LonelyWorker):
         except Exception:
             LOG.exception("DB update failed")
 
+        try:
+            if getattr(self, "_inited", False):
+                self.server_config_get(cached=False)
+        except Exception:
+            LOG.exception("DB catalog refresh failed")
+
+        try:
+            if getattr(self, "_inited", False):
+                self._rollup_data()
+        except Exception:
+            LOG.exception("DB rollup failed")
+
     def _rollover_data(self):
         body = {"conditions": {"max_age": "1d", "max_docs": 10000000}}
         body.update(self._DATA)
         self.elastic.indices.rollover(alias=DB._DATA_ALIAS, body=body)
 
+    def _rollup_data(self):
+        """Aggregates new metrics to rollup indexes.
+
+        Rollup of index is done by server that holds lease in its checkpoint,
+        others skip it. Rollup documents have deterministic ids, so if server
+        which lease expired still works they just overwrite the same
+        documents.
+        """
+        clients = self.clients_count()
+        if not clients:
+            return
+
+        # terms aggregation of source hosts is split on partitions so there
+        # is up to _ROLLUP_MAX_BUCKETS buckets (src, dest, protocol) in each
+        buckets = 2 * clients * clients
+        partitions = min(clients, -(-buckets // self._ROLLUP_MAX_BUCKETS))
+
+        now = datetime.datetime.now()
+        delay = datetime.timedelta(seconds=self._ROLLUP_DELAY)
+        for name, interval in self._ROLLUPS:
+            idx = self._ROLLUP_IDX % name
+            step = datetime.timedelta(seconds=interval)
+            end = _floor(now - delay, interval)
+            start, owner, version = self._rollup_checkpoint(idx)
+            start = start or end - step
+            if start >= end:
+                continue
+            if owner:
+                LOG.info("Skipping rollup of %s, it's done by %s"
+                         % (idx, owner))
+                continue
+
+            try:
+                version = self._rollup_checkpoint_set(idx, start, version)
+                for i in xrange(self._ROLLUP_MAX_PERIODS):
+                    if start >= end:
+                        break
+                    for doc_type in self._ROLLUP_KEYS:
+                        for partition in xrange(partitions):
+                            self._rollup_period(idx, doc_type, start,
+                                                start + step, partition,
+                                                partitions)
+                    start += step
+                    version = self._rollup_checkpoint_set(
+                        idx, start, version, lease=start < end)
+            except elasticsearch.exceptions.ConflictError:
+                LOG.info("Skipping rollup of %s, it's taken by other server"
+                         % idx)
+
+    def _rollup_checkpoint(self, idx):
+        """Returns checkpoint of idx: (start, owner, version).
+
+        start is the first period that is not rolled up yet, owner is other
+        server that holds lease and version is version of checkpoint.
+        """
+        r = self.elastic.get(index=idx, doc_type="checkpoint",
+                             id="checkpoint", ignore=404)
+        if not r.get("found"):
+            return None, None, None
+
+        source = r["_source"]
+        start = source.get("timestamp") and datetime.datetime.strptime(
+            source["timestamp"], "%Y-%m-%dT%H:%M:%S")
+        owner = source.get("owner")
+        if (owner == getattr(self, "own_url", None)
+                or source.get("lease_until", 0) < time.time() * 1000):
+            owner = None
+        return start, owner, r["_version"]
+
+    def _rollup_checkpoint_set(self, idx, start, version, lease=True):
+        """Stores checkpoint and takes or releases lease, returns version.
+
+        Checkpoint is stored only if its version is not changed by other
+        server, otherwise ConflictError is raised.
+        """
+        lease_until = time.time() + (self._ROLLUP_LEASE if lease else 0)
+        body = {"timestamp": start.isoformat(),
+                "owner": getattr(self, "own_url", None),
+                "lease_until": int(lease_until * 1000)}
+        if version:
+            kwargs = {"version": version}
+        else:
+            kwargs = {"op_type": "create"}
+        r = self.elastic.index(index=idx, doc_type="checkpoint",
+                               id="checkpoint", body=body, **kwargs)
+        return r["_version"]
+
+    def _rollup_query(self, doc_type, start, end, partition, partitions):
+        keys = self._ROLLUP_KEYS[doc_type]
+        aggs = {
+            "latency": {"stats": {"field": "latency"}},
+            "percentiles": {"percentiles": {
+                "field": "latency", "percents": self._ROLLUP_PERCENTS}},
+            "lost": {"sum": {"field": "lost"}},
+            "transmitted": {"sum": {"field": "transmitted"}}
+        }
+        for i in reversed(xrange(len(keys))):
+            terms = {"field": keys[i], "size": self._ROLLUP_MAX_BUCKETS}
+            if i == 0:
+                terms["include"] = {"partition": partition,
+                                    "num_partitions": partitions}
+            aggs = {"k%s" % i: {"terms": terms, "aggs": aggs}}
+
+        return {
+            "size": 0,
+            "query": {"range": {"timestamp": {"gte": start.isoformat(),
+                                              "lt": end.isoformat()}}},
+            "aggs": aggs
+        }
+
+    def _rollup_docs(self, keys, aggs, doc, level=0):
+        """Converts nested terms buckets to rollup documents."""
+        for bucket in aggs["k%s" % level]["buckets"]:
+            doc[keys[level]] = bucket["key"]
+            if level + 1 < len(keys):
+                for d in self._rollup_docs(keys, bucket, doc, level + 1):
+                    yield d
+                continue
+
+            stats = bucket["latency"]
+            percentiles = bucket["percentiles"]["values"]
+            d = dict(doc)
+            d.update({
+                "count": bucket["doc_count"],
+                "lost": int(bucket["lost"]["value"] or 0),
+                "transmitted": int(bucket["transmitted"]["value"] or 0),
+                "latency_min": stats["min"],
+                "latency_max": stats["max"],
+                "latency_avg": stats["avg"],
+                "latency_sum": stats["sum"],
+                "latency_count": stats["count"]
+            })
+            for p in self._ROLLUP_PERCENTS:
+                d["latency_p%s" % p] = percentiles.get("%.1f" % p)
+            yield d
+
+    def _rollup_period(self, idx, doc_type, start, end, partition,
+                       partitions):
+        keys = self._ROLLUP_KEYS[doc_type]
+        r = self.elastic.search(
+            index=DB._DATA_ALIAS + "*", doc_type=doc_type,
+            body=self._rollup_query(doc_type, start, end,
+                                    partition, partitions))
+
+        bulk_body = []
+        timestamp = start.isoformat()
+        for doc in self._rollup_docs(keys, r["aggregations"],
+                                     {"timestamp": timestamp}):
+            id_ = hashlib.sha1("|".join(
+                [timestamp] + [unicode(doc[k]) for k in keys]).encode("utf8"))
+            bulk_body.append(json.dumps({"index": {"_id": id_.hexdigest()}}))
+            bulk_body.append(json.dumps(doc))
+
+        if bulk_body:
+            r = self.elastic.bulk(index=idx, doc_type=doc_type,
+                                  body="\n".join(bulk_body),
+                                  filter_path="errors")
+            if r.get("errors"):
+                LOG.warning("Failed to store some rollups of %s %s to %s"
+                            % (doc_type, timestamp, idx))
+
     def _ensure_elastic(self):
         self.elastic.info()
 
@@ -178,7 +489,10 @@ class DB(worker.LonelyWorker):
             If there is index but it has different schema process is shutdown
         """
         data = [(self._CATALOG_IDX, self._CATALOG),
-                (self._EVENTS_IDX, self._EVENTS)]
+                (self._EVENTS_IDX, self._EVENTS),
+                (self._DEAD_LETTERS_IDX, self._DEAD_LETTERS)]
+        for name, interval in self._ROLLUPS:
+            data.append((self._ROLLUP_IDX % name, self._ROLLUP))
 
         for idx, mapping in data:
             try:
@@ -199,11 +513,96 @@ class DB(worker.LonelyWorker):
             if not self.elastic.indices.exists_alias(name=DB._DATA_ALIAS):
                 raise exceptions.DBInitFailure(elastic=self.elastic, message=e)
 
-    def clients_get(self):
-        data = self.elastic.search(index=DB._CATALOG_IDX, doc_type="clients",
-                                   size=MAX_AMOUNT_OF_SERVERS)
+        # New fields are added to mapping of existing indexes, otherwise
+        # strict mapping rejects new documents (of data till next rollover).
+        data.append((DB._DATA_ALIAS, self._DATA))
+        for idx, schema in data:
+            for doc_type, mapping in schema["mappings"].iteritems():
+                self.elastic.indices.put_mapping(
+                    index=idx, doc_type=doc_type, body=mapping)
+
+    def _catalog_get(self, key):
+        with self._catalog_lock:
+            expires_at, value = self._catalog.get(key, (None, _MISSING))
+            if expires_at is None or expires_at < monotonic.monotonic():
+                return _MISSING
+            return value
+
+    def _catalog_set(self, key, value, stamp):
+        """Caches value, if catalog was not changed since stamp."""
+        with self._catalog_lock:
+            if stamp == self._catalog_stamp:
+                self._catalog[key] = (
+                    monotonic.monotonic() + self._CATALOG_TTL, value)
+
+    def _catalog_invalidate(self):
+        with self._catalog_lock:
+            self._catalog_stamp += 1
+            self._catalog = {}
+            return self._catalog_stamp
+
+    def _catalog_check(self, config_hit, stamp):
+        """Invalidates cache if the latest config was changed.
+
+        Returns stamp to cache config_hit with, it is moved only by own
+        invalidation, so changes done during the search are not hidden.
+        """
+        version = config_hit and (config_hit["_id"],
+                                  config_hit.get("_version"))
+        if version != self._catalog_version:
+            self._catalog_version = version
+            new_stamp = self._catalog_invalidate()
+            if new_stamp == stamp + 1:
+                return new_stamp
+        return stamp
+
+    def clients_get(self, page_size=1000, cached=True):
+        """Returns iterator over all clients.
+
+        Clients are read from cache or streamed from catalog by pages with
+        search_after and cached if all of them are read.
+        """
+        if cached:
+            clients = self._catalog_get("clients")
+            if clients is not _MISSING:
+                return iter(clients)
+        return self._clients_stream(page_size, self._catalog_stamp)
+
+    def clients_view(self, name, build):
+        """Returns build(clients) that is cached together with clients.
 
-        return [morph.unflatten(x["_source"]) for x in data["hits"]["hits"]]
+        Value is dropped with cache, so it's built once per catalog version.
+        Callers must not change it.
+        """
+        value = self._catalog_get(name)
+        if value is _MISSING:
+            stamp = self._catalog_stamp
+            value = build(self.clients_get())
+            self._catalog_set(name, value, stamp)
+        return value
+
+    def _clients_stream(self, page_size, stamp):
+        clients = []
+        body = {"size": page_size, "sort": [{"_uid": "asc"}]}
+        while True:
+            data = self.elastic.search(
+                index=DB._CATALOG_IDX, doc_type="clients", body=body,
+                filter_path="hits.hits._source,hits.hits.sort")
+            hits = data.get("hits", {}).get("hits", [])
+            for hit in hits:
+                client = morph.unflatten(hit["_source"])
+                clients.append(client)
+                yield client
+
+            if len(hits) < page_size:
+                break
+            body["search_after"] = hits[-1]["sort"]
+
+        self._catalog_set("clients", clients, stamp)
+
+    def clients_count(self):
+        return self.elastic.count(index=DB._CATALOG_IDX,
+                                  doc_type="clients")["count"]
 
     def clients_set(self, catalog):
         bulk_body = []
@@ -218,21 +617,73 @@ class DB(worker.LonelyWorker):
         self.elastic.bulk(index=DB._CATALOG_IDX, doc_type="clients",
                           body="\n".join(bulk_body),
                           refresh="true")
+        self._catalog_invalidate()
 
-    def server_config_get(self, only_applied=False):
-        query = {"sort": {"timestamp": {"order": "desc"}}}
-        if only_applied:
-            query["query"] = {"term": {"applied": True}}
-        result = self.elastic.search(index=DB._CATALOG_IDX, doc_type="config",
-                                     body=query, size=1)
+    def clients_configured(self, hosts, configured=True, chunk_size=1000):
+        """Sets configured flag of clients with hosts.
 
-        hits = result["hits"]["hits"]
-        if not hits:
+        hosts is list of hosts or dict host -> hash of pushed config, that is
+        stored as tasks_hash of client.
+        """
+        hashes = hosts if isinstance(hosts, dict) else None
+        hosts = list(hosts)
+        script = "ctx._source.configured = params.configured"
+        if hashes is not None:
+            script += ("; ctx._source.tasks_hash = "
+                       "params.hashes[ctx._source.host]")
+
+        for i in xrange(0, len(hosts), chunk_size):
+            chunk = hosts[i:i + chunk_size]
+            params = {"configured": configured}
+            if hashes is not None:
+                params["hashes"] = {h: hashes[h] for h in chunk}
+            body = {
+                "query": {"terms": {"host": chunk}},
+                "script": {
+                    "inline": script,
+                    "lang": "painless",
+                    "params": params
+                }
+            }
+            r = self.elastic.update_by_query(
+                index=DB._CATALOG_IDX, doc_type="clients", body=body,
+                conflicts="proceed", refresh="true")
+            if r.get("failures"):
+                LOG.error("Failed to update %s of %s clients: %s"
+                          % (len(r["failures"]), len(chunk),
+                             json.dumps(r["failures"][0])))
+        if hosts:
+            self._catalog_invalidate()
+
+    def server_config_get(self, only_applied=False, cached=True):
+        """Returns the latest (applied) config.
+
+        With cached=False config is read from elastic, that also checks
+        whatever cached catalog is still valid.
+        """
+        key = "config_applied" if only_applied else "config"
+        hit = self._catalog_get(key) if cached else _MISSING
+        if hit is _MISSING:
+            stamp = self._catalog_stamp
+            query = {"sort": {"timestamp": {"order": "desc"}}}
+            if only_applied:
+                query["query"] = {"term": {"applied": True}}
+            result = self.elastic.search(index=DB._CATALOG_IDX,
+                                         doc_type="config", body=query,
+                                         size=1, version=True)
+            hits = result["hits"]["hits"]
+            hit = hits[0] if hits else None
+            if not only_applied:
+                stamp = self._catalog_check(hit, stamp)
+            self._catalog_set(key, hit, stamp)
+
+        if not hit:
             return
 
-        result = hits[0]["_source"]
+        # cached hit is not changed, as callers may change result
+        result = dict(hit["_source"])
         result["config"] = json.loads(result["config"])
-        result["id"] = hits[0]["_id"]
+        result["id"] = hit["_id"]
         return result
 
     def server_config_add(self, config):
@@ -246,40 +697,244 @@ class DB(worker.LonelyWorker):
         self.elastic.index(index=DB._CATALOG_IDX,
                            doc_type="config", body=body,
                            refresh="true")
+        self._catalog_invalidate()
 
     def server_config_apply(self, id_):
         self.elastic.update(index=DB._CATALOG_IDX,
                             doc_type="config", id=id_,
                             body={"doc": {"applied": True}},
                             refresh="true")
+        self._catalog_invalidate()
 
     def server_config_meshed(self, id_):
         self.elastic.update(index=DB._CATALOG_IDX,
                             doc_type="config", id=id_,
                             body={"doc": {"meshed": True}},
                             refresh="true")
+        self._catalog_invalidate()
 
     def metrics_add(self, doc_type, data):
+        """Stores metrics, returns amount of them per status of bulk item."""
+        return self.metrics_bulk(self.metrics_bulk_items(doc_type, data))[0]
+
+    @staticmethod
+    def metrics_bulk_items(doc_type, data):
+        """Returns serialized bulk items (action and source) for metrics."""
         if doc_type not in ["east-west", "north-south"]:
             raise ValueError("Wrong doc type")
 
-        bulk_body = []
-        for d in data:
-            bulk_body.append(json.dumps({"index": {}}))
-            bulk_body.append(json.dumps(morph.flatten(d)))
+        return bulk.Serializer(doc_type).items(data)
+
+    def metrics_bulk(self, items, attempts=3, backoff=0.5):
+        """Stores items of metrics_bulk_items() with bulk requests.
 
-        # NOTE(boris-42): We should analyze Elastic response here.
-        r = self.elastic.bulk(index=DB._DATA_ALIAS, doc_type=doc_type,
-                              body="\n".join(bulk_body))
+        Items rejected by elastic because of load (429 and 5xx) and items of
+        requests that failed are resent up to attempts times with jittered
+        exponential backoff, items that are malformed are stored to dead
+        letters index.
 
+        Returns amount of items per final status and items that are still
+        not stored, items stored by previous attempts are not among them.
+        """
         results = {}
-        for it in r["items"]:
-            k = it["index"]["status"]
-            results.setdefault(k, 0)
-            results[k] += 1
+        for attempt in xrange(attempts):
+            if attempt:
+                delay = backoff * 2 ** (attempt - 1)
+                time.sleep(random.uniform(delay / 2.0, delay))
+
+            body = "\n".join(items)
+            started_at = time.time()
+            try:
+                r = self.elastic.bulk(index=DB._DATA_ALIAS, body=body,
+                                      filter_path=DB._BULK_FILTER)
+            except elasticsearch.exceptions.TransportError as e:
+                LOG.warning("Metrics bulk request of %s metrics failed, "
+                            "attempt %s of %s: %s"
+                            % (len(items), attempt + 1, attempts, e))
+                continue
+
+            duration = time.time() - started_at
+            LOG.info("Metrics bulk request: %s bytes in %.3f s, %d bytes/s"
+                     % (len(body), duration, len(body) / max(duration, 1e-6)))
+            items, failed = self._parse_bulk(items, r, results)
+            if failed:
+                self._dead_letters_add(failed)
+            if not items:
+                break
+
+            LOG.warning("Elastic rejected %s metrics, attempt %s of %s"
+                        % (len(items), attempt + 1, attempts))
 
         LOG.info("Metrics bulk insert result: %s" % results)
-        return results
+        return results, items
+
+    def _parse_bulk(self, items, response, results):
+        """Counts results, returns items to retry and malformed items."""
+        retry = []
+        failed = []
+        if not response.get("errors"):
+            results[201] = results.get(201, 0) + len(items)
+            return retry, failed
+
+        for item, result in zip(items, response["items"]):
+            result = result["index"]
+            status = result["status"]
+            if status == 429 or status >= 500:
+                retry.append(item)
+                continue
+
+            results[status] = results.get(status, 0) + 1
+            if status >= 400:
+                failed.append((item, status, result.get("error")))
+
+        return retry, failed
+
+    def _dead_letters_add(self, failed):
+        LOG.warning("Elastic failed to store %s malformed metrics, they are "
+                    "stored to %s" % (len(failed), DB._DEAD_LETTERS_IDX))
+
+        timestamp = datetime.datetime.now().isoformat()
+        bulk_body = []
+        for item, status, error in failed:
+            bulk_body.append(json.dumps({"index": {}}))
+            bulk_body.append(json.dumps({
+                "timestamp": timestamp, "status": status,
+                "error": json.dumps(error), "item": item}))
+
+        try:
+            self.elastic.bulk(index=DB._DEAD_LETTERS_IDX, doc_type="metrics",
+                              body="\n".join(bulk_body), filter_path="errors")
+        except elasticsearch.exceptions.ElasticsearchException:
+            LOG.exception("Failed to store dead letters")
+
+    def metrics_matrix(self, period, group_by="az", doc_type="east-west",
+                       filters=None):
+        """Returns loss and latency between groups of hosts.
+
+        Result is dict with matrix, list of cells, and truncated flag that is
+        set if there are more than _MATRIX_MAX_BUCKETS src or dest groups.
+
+        :param period: Amount of last seconds to aggregate metrics of
+        :param group_by: Field of hosts to group by: host, az or dc
+        :param doc_type: east-west or north-south, north-south metrics are
+                         grouped by dest instead of field of dest host
+        :param filters: Dict with required values of src_<field>,
+                        dest_<field> and protocol
+        """
+        filters = filters or {}
+        key = (period, group_by, doc_type, tuple(sorted(filters.items())))
+        with self._matrix_lock:
+            result = self._matrix_cache.get(key)
+        if result is None:
+            result = self._metrics_matrix(period, group_by, doc_type, filters)
+            with self._matrix_lock:
+                self._matrix_cache[key] = result
+        return result
+
+    def _matrix_field(self, name, doc_type):
+        side, field = name.split("_", 1)
+        if side == "dest" and doc_type == "north-south":
+            return "dest"
+        return "client_%s.%s" % (side, field)
+
+    def _matrix_query(self, start, group_by, doc_type, filters, rollup):
+        query = [{"range": {"timestamp": {"gte": start.isoformat()}}}]
+        for name, value in sorted(filters.items()):
+            if name != "protocol":
+                name = self._matrix_field(name, doc_type)
+            query.append({"term": {name: value}})
+
+        if rollup:
+            metrics = {
+                "count": {"sum": {"field": "count"}},
+                "latency_sum": {"sum": {"field": "latency_sum"}},
+                "latency_count": {"sum": {"field": "latency_count"}},
+                "latency_min": {"min": {"field": "latency_min"}},
+                "latency_max": {"max": {"field": "latency_max"}}
+            }
+        else:
+            metrics = {"latency": {"stats": {"field": "latency"}}}
+        metrics["lost"] = {"sum": {"field": "lost"}}
+        metrics["transmitted"] = {"sum": {"field": "transmitted"}}
+
+        size = self._MATRIX_MAX_BUCKETS
+        dest = self._matrix_field("dest_" + group_by, doc_type)
+        return {
+            "size": 0,
+            "query": {"bool": {"filter": query}},
+            "aggs": {
+                "src": {
+                    "terms": {"field": "client_src." + group_by, "size": size},
+                    "aggs": {
+                        "dest": {
+                            "terms": {"field": dest, "size": size},
+                            "aggs": metrics
+                        }
+                    }
+                }
+            }
+        }
+
+    def _matrix_cell(self, src, bucket, rollup):
+        # transmitted counts received replies, so probes are lost + it
+        lost = int(bucket["lost"]["value"] or 0)
+        transmitted = int(bucket["transmitted"]["value"] or 0)
+        if rollup:
+            count = int(bucket["count"]["value"] or 0)
+            latency_count = bucket["latency_count"]["value"]
+            latency_avg = (bucket["latency_sum"]["value"] / latency_count
+                           if latency_count else None)
+            latency_min = bucket["latency_min"]["value"]
+            latency_max = bucket["latency_max"]["value"]
+        else:
+            count = bucket["doc_count"]
+            latency_avg = bucket["latency"]["avg"]
+            latency_min = bucket["latency"]["min"]
+            latency_max = bucket["latency"]["max"]
+
+        return {
+            "src": src,
+            "dest": bucket["key"],
+            "count": count,
+            "lost": lost,
+            "transmitted": transmitted,
+            "loss": (float(lost) / (lost + transmitted)
+                     if lost + transmitted else None),
+            "latency_avg": latency_avg,
+            "latency_min": latency_min,
+            "latency_max": latency_max
+        }
+
+    def _metrics_matrix(self, period, group_by, doc_type, filters):
+        # short periods are read from raw metrics, rollups are not complete
+        # for last few minutes
+        if period < 3600:
+            index, rollup = DB._DATA_ALIAS + "*", False
+        elif period <= 86400:
+            index, rollup = DB._ROLLUP_IDX % "1m", True
+        else:
+            index, rollup = DB._ROLLUP_IDX % "1h", True
+
+        start = datetime.datetime.now() - datetime.timedelta(seconds=period)
+        r = self.elastic.search(
+            index=index, doc_type=doc_type,
+            body=self._matrix_query(start, group_by, doc_type, filters,
+                                    rollup))
+
+        matrix = []
+        aggs = r["aggregations"]["src"]
+        # terms aggregations return up to _MATRIX_MAX_BUCKETS groups
+        truncated = bool(aggs.get("sum_other_doc_count"))
+        for src in aggs["buckets"]:
+            truncated = truncated or bool(
+                src["dest"].get("sum_other_doc_count"))
+            for dest in src["dest"]["buckets"]:
+                matrix.append(self._matrix_cell(src["key"], dest, rollup))
+        if truncated:
+            LOG.warning("Matrix of %s grouped by %s has more than %s groups, "
+                        "it is truncated" % (doc_type, group_by,
+                                             self._MATRIX_MAX_BUCKETS))
+        return {"matrix": matrix, "truncated": truncated}
 
     def event_get(self, id_):
         r = self.elastic.get(index=DB._EVENTS_IDX, doc_type="events", id=id_)
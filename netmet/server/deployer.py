@@ -30,11 +30,11 @@ class Deployer(worker.LonelyWorker):
                 LOG.info(no_changes_msg)
             else:
                 with eslock.Glock("update_config"):
-                    config = get_conf()   # Refresh config after lock
+                    config = get_conf(cached=False)   # Refresh after lock
                     if not is_applied(config):
                         LOG.info("Deployer detect new config: "
                                  "Updating deployment")
-                        clients = db.get().clients_get()
+                        clients = db.get().clients_get(cached=False)
 
                         # TODO(boris-42): Add support of multi drivers
                         new_clients = StaticDeployer().redeploy(
@@ -66,7 +66,14 @@ class StaticDeployer(Deployer):
         new_idx = {c["host"]: c for c in new_clients}
 
         for c in new_clients:
-            c["configured"] = False
+            # unchanged clients keep hash of their config, so mesher doesn't
+            # push the same config to them again
+            old = old_idx.get(c["host"], {})
+            c["configured"] = bool(
+                old.get("configured") and old.get("tasks_hash") and
+                all(old.get(k) == v for k, v in c.iteritems()))
+            if c["configured"]:
+                c["tasks_hash"] = old["tasks_hash"]
 
         unregister = ["%s:%s/api/v1/unregister" % (h, old_idx[h]["port"])
                       for h in old_idx if h not in new_idx]
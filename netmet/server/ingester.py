@@ -0,0 +1,102 @@
+# Copyright 2017: GoDaddy Inc.
+
+import collections
+import logging
+import threading
+
+from netmet.server import db
+from netmet.utils import worker
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Ingester(worker.LonelyWorker):
+    """Joins metrics from different clients requests into big bulk requests.
+
+    Metrics are serialized to bulk items in request handler and put to the
+    queue of up to max_items items, handler doesn't wait for elastic.
+    Queue is flushed every period or as soon as it has bulk_size bytes,
+    every bulk request is up to bulk_size bytes. If elastic fails or keeps
+    rejecting items, they are returned to the queue and retried on next
+    flush, so when it's full new metrics are rejected.
+    """
+
+    _period = 1
+    max_items = 200000
+    bulk_size = 5 * 1024 * 1024
+
+    def __init__(self):
+        self._queue = collections.deque()
+        self._queue_bytes = 0
+        self._queue_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, data):
+        """Queues metrics, data is dict doc_type -> list of metrics.
+
+        Returns False if queue is full and metrics were not queued.
+        """
+        items = []
+        for doc_type, metrics in data.iteritems():
+            items.extend(db.DB.metrics_bulk_items(doc_type, metrics))
+
+        size = sum(len(item) for item in items)
+        with self._queue_lock:
+            if len(self._queue) + len(items) > self.max_items:
+                return False
+            self._queue.extend(items)
+            self._queue_bytes += size
+            full = self._queue_bytes >= self.bulk_size
+
+        if full:
+            self.force_update()
+        return True
+
+    def size(self):
+        return len(self._queue)
+
+    def _pop_bulk(self):
+        items = []
+        size = 0
+        with self._queue_lock:
+            while self._queue and (not items or size < self.bulk_size):
+                item = self._queue.popleft()
+                items.append(item)
+                size += len(item)
+            self._queue_bytes -= size
+        return items, size
+
+    def _return_bulk(self, items, size):
+        with self._queue_lock:
+            self._queue.extendleft(reversed(items))
+            self._queue_bytes += size
+
+    def _flush(self):
+        with self._flush_lock:
+            while self._queue:
+                items, size = self._pop_bulk()
+                try:
+                    rejected = db.get().metrics_bulk(items)[1]
+                except Exception:
+                    self._return_bulk(items, size)
+                    LOG.exception("Failed to store %s metrics, %s metrics "
+                                  "are queued" % (len(items), self.size()))
+                    return
+
+                if rejected:
+                    self._return_bulk(rejected, sum(len(x) for x in rejected))
+                    LOG.warning("Elastic is overloaded, %s metrics are queued"
+                                % self.size())
+                    return
+
+    def _job(self):
+        self._flush()
+
+    @classmethod
+    def destroy(cls):
+        self = cls._self
+        super(Ingester, cls).destroy()
+        if self is not None:
+            # store metrics that were accepted before stop
+            self._flush()
@@ -1,9 +1,11 @@
 # Copyright 2017: GoDaddy Inc.
 
 import functools
+import itertools
 import json
 import logging
 import os
+import re
 
 import elasticsearch
 import flask
@@ -13,7 +15,9 @@ import jsonschema
 from netmet import exceptions
 from netmet.server import db
 from netmet.server import deployer
+from netmet.server import ingester
 from netmet.server import mesher
+from netmet.utils import batch
 from netmet.utils import secure
 from netmet.utils import status
 
@@ -111,7 +115,10 @@ def config_set():
                         "dest": {"type": "string"},
                         "protocol": {"enum": ["http", "icmp"]},
                         "period": {"type": "number"},
-                        "timeout": {"type": "number"}
+                        "timeout": {"type": "number"},
+                        "count": {"type": "integer", "minimum": 1},
+                        "interval": {"type": "number", "minimum": 0},
+                        "keepalive": {"type": "boolean"}
                     },
                     "required": ["dest", "protocol", "period", "timeout"],
                     "additionalProperties": False
@@ -136,7 +143,25 @@ def config_set():
 @db_errors_handler
 def clients_list():
     """List all hosts."""
-    return flask.jsonify(db.get().clients_get()), 200
+
+    def stream(first, clients):
+        yield "["
+        try:
+            for i, client in enumerate(itertools.chain(first, clients)):
+                yield ("," if i else "") + json.dumps(client)
+        except Exception:
+            # status is already sent, error aborts chunked response, so
+            # client gets broken response instead of truncated list
+            LOG.exception("Failed to stream clients")
+            raise
+        yield "]"
+
+    # clients are streamed from elastic, so whole catalog is not in memory,
+    # the first page is read here, so elastic errors set response status
+    clients = iter(db.get().clients_get())
+    first = list(itertools.islice(clients, 1))
+    return flask.Response(stream(first, clients), 200,
+                          mimetype="application/json")
 
 
 @app.route("/api/v1/clients/<host>/<port>", methods=["POST"])
@@ -152,16 +177,31 @@ def client_refresh(host, port):
 @db_errors_handler
 @secure.check_hmac_auth
 def metrics_add():
-    """Stores metrics to elastic."""
+    """Queues metrics to be stored to elastic."""
 
     # Check just basic schema, let elastic check everything else
     schema = {
         "type": "array",
-        "items": {"type": "object"}
+        "items": {
+            "type": "object",
+            "additionalProperties": {"type": "object"}
+        }
     }
 
+    encoding = flask.request.headers.get("Content-Encoding", "identity")
+    if encoding not in ["gzip", "identity"]:
+        return flask.jsonify({"error": "Unsupported Content-Encoding: %s"
+                                       % encoding}), 415
+
     try:
-        req_data = flask.request.get_json(silent=False, force=True)
+        req_data = flask.request.get_data()
+        if encoding == "gzip":
+            req_data = batch.decompress(req_data)
+
+        if flask.request.mimetype == batch.CONTENT_TYPE:
+            req_data = batch.loads(req_data)
+        else:
+            req_data = json.loads(req_data)
         jsonschema.validate(req_data, schema)
     except (ValueError, jsonschema.exceptions.ValidationError) as e:
         return flask.jsonify({"error": "Bad request: %s" % e}), 400
@@ -175,21 +215,49 @@ def metrics_add():
             else:
                 LOG.warning("Ignoring wrong object %s" % json.dumps(d))
 
-        # TODO(boris-42): Use pusher here, to reduce amount of quires
-        # from netmet server to elastic, join data from different netmet
-        # clients requests before pushing them to elastic
-        for k, v in data.iteritems():
-            if v:
-                db.get().metrics_add(k, v)
+        if not ingester.Ingester.get().add(data):
+            return (flask.jsonify({"error": "Too many metrics are queued"}),
+                    429, {"Retry-After": "5"})
+
+    # not 202: not upgraded clients treat only 201 as success and resend data
+    return flask.jsonify({"message": "metrics are queued"}), 201
+
 
-    return flask.jsonify({"message": "successfully stored metrics"}), 201
+_PERIOD = re.compile(r"^(\d+)([smhd])$")
+_PERIOD_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_MATRIX_FILTERS = ["src_host", "src_az", "src_dc", "dest_host", "dest_az",
+                   "dest_dc", "protocol"]
 
 
 @app.route("/api/v1/metrics/<period>", methods=["GET"])
 @db_errors_handler
 def metrics_get(period):
-    """Get metrics for period."""
-    return flask.jsonify({"message": "noop"}), 200
+    """Returns loss and latency matrix for last period, e.g. 15m, 1h or 7d.
+
+    Query args: group_by (az, dc or host), type (east-west or north-south)
+    and filters src_host, src_az, src_dc, dest_host, dest_az, dest_dc and
+    protocol.
+    """
+    match = _PERIOD.match(period)
+    if not match or not int(match.group(1)):
+        return flask.jsonify({"error": "Wrong period %s" % period}), 400
+    seconds = int(match.group(1)) * _PERIOD_UNITS[match.group(2)]
+
+    args = flask.request.args
+    group_by = args.get("group_by", "az")
+    if group_by not in ["host", "az", "dc"]:
+        return flask.jsonify({"error": "Wrong group_by %s" % group_by}), 400
+
+    doc_type = args.get("type", "east-west")
+    if doc_type not in ["east-west", "north-south"]:
+        return flask.jsonify({"error": "Wrong type %s" % doc_type}), 400
+
+    filters = dict((k, args[k]) for k in _MATRIX_FILTERS if k in args)
+    result = db.get().metrics_matrix(seconds, group_by=group_by,
+                                     doc_type=doc_type, filters=filters)
+    return flask.jsonify({"period": period, "group_by": group_by,
+                          "type": doc_type, "matrix": result["matrix"],
+                          "truncated": result["truncated"]}), 200
 
 
 @app.route("/api/v1/events", methods=["GET"])
@@ -268,6 +336,7 @@ app = routing.add_routing_map(app, html_uri=None, json_uri="/")
 def die():
     deployer.Deployer.destroy()
     mesher.Mesher.destroy()
+    ingester.Ingester.destroy()
     db.DB.destroy()
 
 
@@ -287,6 +356,7 @@ def load():
                          " separated by comma.")
 
     db.DB.create(NETMET_OWN_URL, ELASTIC.split(","))
+    ingester.Ingester.create()
     deployer.Deployer.create(mesher.Mesher.force_update)
     mesher.Mesher.create(NETMET_SERVER)
 
@@ -1,8 +1,12 @@
 # Copyright 2017: GoDaddy Inc.
 
+import collections
+import hashlib
 import json
 import logging
+import random
 
+import futurist
 import requests
 
 from netmet import exceptions
@@ -16,9 +20,14 @@ LOG = logging.getLogger(__name__)
 
 class MeshPlugin(object):
 
-    def mesh(self, config, clients, external):
+    def tasks(self, config, client, clients, external):
+        """Returns tasks of one client."""
         return []
 
+    def mesh(self, config, clients, external):
+        for client in clients:
+            yield client, self.tasks(config, client, clients, external)
+
 
 class FullMesh(MeshPlugin):
 
@@ -33,7 +42,10 @@ class FullMesh(MeshPlugin):
                         "properties": {
                             "period": {"type": "number"},
                             "timeout": {"type": "number"},
-                            "packet_size": {"type": "number"}
+                            "packet_size": {"type": "number"},
+                            "count": {"type": "integer", "minimum": 1},
+                            "interval": {"type": "number", "minimum": 0},
+                            "keepalive": {"type": "boolean"}
                         }
                     }
                 }
@@ -42,35 +54,36 @@ class FullMesh(MeshPlugin):
         "additionalProperties": False
     }
 
-    def mesh(self, mesh_config, clients, external):
+    def tasks(self, mesh_config, client, clients, external):
+        tasks = []
 
-        for client in clients:
-            tasks = []
+        for other_client in clients:
+            if client == other_client:
+                continue
 
-            for other_client in clients:
-                if client == other_client:
-                    continue
+            for protocol in ["http", "icmp"]:
+                task = {"dest": other_client, "protocol": protocol}
+                if mesh_config.get("north-south", {}).get(protocol):
+                    task["settings"] = mesh_config["north-south"][protocol]
 
-                for protocol in ["http", "icmp"]:
-                    task = {"dest": other_client, "protocol": protocol}
-                    if mesh_config.get("north-south", {}).get(protocol):
-                        task["settings"] = mesh_config["north-south"][protocol]
+                tasks.append({"east-west": task})
 
-                    tasks.append({"east-west": task})
+        for ext in external:
+            task = {
+                "dest": ext["dest"],
+                "protocol": ext["protocol"],
+                "settings": {
+                    "period": ext["period"],
+                    "timeout": ext["timeout"]
+                }
+            }
+            for key in ["count", "interval", "keepalive"]:
+                if key in ext:
+                    task["settings"][key] = ext[key]
 
-            for ext in external:
-                tasks.append({
-                    "north-south": {
-                        "dest": ext["dest"],
-                        "protocol": ext["protocol"],
-                        "settings": {
-                            "period": ext["period"],
-                            "timeout": ext["timeout"]
-                        }
-                    }
-                })
+            tasks.append({"north-south": task})
 
-            yield client, tasks
+        return tasks
 
 
 class DistributedMesh(MeshPlugin):
@@ -111,7 +124,7 @@ class DistributedMesh(MeshPlugin):
     }
 
     def mesh(self, config, clients, external):
-        pass
+        return []
 
 
 class Mesher(worker.LonelyWorker):
@@ -120,6 +133,13 @@ class Mesher(worker.LonelyWorker):
     update_failed_msg = "Mesher update failed."
     lock_name = "update_config"
     client_api = "http://%s:%s/api/v2/config"
+    # Configs are pushed to push_workers clients in parallel, failed pushes
+    # are retried push_attempts times with exponential backoff.
+    push_workers = 20
+    push_timeout = 10
+    push_attempts = 3
+    push_backoff = 0.5
+    _session = None
     # TODO(boris-42): Make this plugable
     plugins = {
         "full_mesh": FullMesh()
@@ -143,42 +163,145 @@ class Mesher(worker.LonelyWorker):
         super(Mesher, cls).create()
         cls._self.netmet_server_url = netmet_server_url
 
-    def _update_client(self, client, tasks):
-        try:
-            body = {
-                "netmet_server": self.netmet_server_url,
-                "client_host": client,
-                "tasks": tasks,
-                "settings": {
-                    "timeout": 1,
-                    "period": 5
-                }
+    def _get_session(self):
+        if self._session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.push_workers,
+                pool_maxsize=self.push_workers)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def _client_data(self, client, tasks):
+        body = {
+            "netmet_server": self.netmet_server_url,
+            "client_host": client,
+            "tasks": tasks,
+            "settings": {
+                "timeout": 1,
+                "period": 5
             }
-            data = json.dumps(body)
-            requests.post(self.client_api % (client["host"], client["port"]),
-                          data=data, headers=secure.gen_hmac_headers(data))
-            # Set client configured
-        except Exception as e:
-            exc = bool(LOG.isEnabledFor(logging.DEBUG))
-            msg = "Failed to update client config %s. "
-            if exc:
-                LOG.exception(msg % client["host"])
-            else:
-                LOG.warning(msg % client["host"] + str(e))
+        }
+        # keys are sorted, so the same config has the same hash
+        return json.dumps(body, sort_keys=True)
 
-            return False, (500, msg % client["host"])
+    @staticmethod
+    def _tasks_hash(data):
+        return hashlib.sha1(data).hexdigest()
 
-        return True, 200, "Client updated"
+    def _update_client(self, client, tasks):
+        return self._post_config(client, self._client_data(client, tasks))
 
-    def _mesh(self, config):
-        mesh = self.plugins[config["mesher"].keys()[0]].mesh
+    def _post_config(self, client, data):
+        url = self.client_api % (client["host"], client["port"])
+        msg = "Failed to update client config %s. " % client["host"]
 
-        allowed = set(["ip", "port", "host", "hypervisor", "dc", "az"])
-        clients = [{k: x[k] for k in allowed if k in x}
-                   for x in db.get().clients_get()]
+        for attempt in xrange(self.push_attempts):
+            if attempt:
+                self._death.wait(self.push_backoff * 2 ** (attempt - 1) *
+                                 random.uniform(0.5, 1))
+            try:
+                r = self._get_session().post(
+                    url, data=data,
+                    headers=secure.gen_hmac_headers(data, url=url),
+                    timeout=self.push_timeout)
+                secure.learn_hmac_version(url, r)
+            except Exception as e:
+                error = str(e)
+                if LOG.isEnabledFor(logging.DEBUG):
+                    LOG.exception(msg)
+                continue
+
+            if r.status_code < 300:
+                return True, 200, "Client updated"
+
+            error = "Status code %s" % r.status_code
+            if r.status_code < 500 and r.status_code != 429:
+                break
+
+        LOG.warning(msg + error)
+        return False, 500, msg
+
+    def _push(self, clients_tasks, hashes=None):
+        """Pushes tasks to clients in parallel.
+
+        Clients which config has the same hash as in hashes (host -> hash of
+        the last pushed config) are skipped. Returns dict host -> hash of
+        configured clients and list of hosts of failed clients. Only a few
+        tasks per worker are built ahead, so tasks of the whole mesh are not
+        kept in memory.
+        """
+        hashes = hashes or {}
+        configured, failed = {}, []
+        pending = collections.deque()
+        skipped = 0
+
+        def collect():
+            client, tasks_hash, future = pending.popleft()
+            if future.result()[0]:
+                configured[client["host"]] = tasks_hash
+            else:
+                failed.append(client["host"])
+
+        with futurist.ThreadPoolExecutor(max_workers=self.push_workers) as e:
+            for client, tasks in clients_tasks:
+                data = self._client_data(client, tasks)
+                tasks_hash = self._tasks_hash(data)
+                if hashes.get(client["host"]) == tasks_hash:
+                    skipped += 1
+                    continue
 
+                if len(pending) >= 2 * self.push_workers:
+                    collect()
+                pending.append((client, tasks_hash,
+                                e.submit(self._post_config, client, data)))
+            while pending:
+                collect()
+
+        LOG.info("Mesher: %s clients are updated, %s are not changed."
+                 % (len(configured) + len(failed), skipped))
+        return configured, failed
+
+    def _clients(self, cached=True):
+        """Returns clients, index (host, port) -> client and hashes.
+
+        hashes are host -> hash of config that was pushed to configured
+        client. Hashes are changed by pushes of other servers, so they are
+        compared only with cached=False. Cached result is built once per
+        version of catalog and must not be changed.
+        """
+        if cached:
+            return db.get().clients_view("mesher_clients",
+                                         self._build_clients)
+        return self._build_clients(db.get().clients_get(cached=False))
+
+    @staticmethod
+    def _build_clients(catalog):
+        allowed = set(["ip", "port", "host", "hypervisor", "dc", "az"])
+        clients, hashes = [], {}
+        for x in catalog:
+            clients.append({k: x[k] for k in allowed if k in x})
+            if x.get("configured") and x.get("tasks_hash"):
+                hashes[x["host"]] = x["tasks_hash"]
+        index = {(c.get("host"), c.get("port")): c for c in clients}
+        return clients, index, hashes
+
+    def _mesh(self, config, clients):
+        mesh = self.plugins[config["mesher"].keys()[0]].mesh
         return mesh(config["mesher"].values()[0], clients, config["external"])
 
+    def _client_tasks(self, config, host, port):
+        """Returns client and its tasks, or None if there is no client."""
+        clients, index, _ = self._clients()
+        client = index.get((host, port))
+        if client is None:
+            return None
+
+        plugin = self.plugins[config["mesher"].keys()[0]]
+        return client, plugin.tasks(config["mesher"].values()[0], client,
+                                    clients, config["external"])
+
     def refresh_client(self, host, port):
         lock_acuired = False
         attempts = 0
@@ -190,11 +313,16 @@ class Mesher(worker.LonelyWorker):
                     if not (config["applied"] and config["meshed"]):
                         return False, 404, "Configuration not found"
 
-                    for c in self._mesh(config["config"]):
-                        if c[0]["host"] == host and c[0]["port"] == port:
-                            return self._update_client(c[0], c[1])
+                    c = self._client_tasks(config["config"], host, port)
+                    if c is None:
+                        return False, 404, "Client not found"
 
-                    return False, 404, "Client not found"
+                    data = self._client_data(*c)
+                    result = self._post_config(c[0], data)
+                    if result[0]:
+                        db.get().clients_configured(
+                            {host: self._tasks_hash(data)})
+                    return result
 
             except exceptions.GlobalLockException:
                 attempts += 1
@@ -214,12 +342,20 @@ class Mesher(worker.LonelyWorker):
                     # TODO(boris-42): Alogrithm should be a bit smarter
                     # even if it is meshed try to update all not configured
                     # clients.
-                    config = get_conf()
+                    config = get_conf(cached=False)
                     if not is_meshed(config):
                         LOG.info(self.new_config_msg)
-                        for c in self._mesh(config["config"]):
-                            # TODO(boris-42): Run this in parallel
-                            self._update_client(c[0], c[1])
+                        # only clients which config is changed are updated
+                        clients, _, hashes = self._clients(cached=False)
+                        configured, failed = self._push(
+                            self._mesh(config["config"], clients), hashes)
+                        db.get().clients_configured(configured)
+                        db.get().clients_configured(failed, configured=False)
+                        if failed:
+                            LOG.warning("Mesher: failed to update %s of %s "
+                                        "clients." % (len(failed),
+                                                      len(configured) +
+                                                      len(failed)))
                         db.get().server_config_meshed(config["id"])
                     else:
                         LOG.info(self.no_changes_msg)
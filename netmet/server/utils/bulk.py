@@ -0,0 +1,83 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+import math
+
+import morph
+
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _encode(value):
+    if isinstance(value, basestring):
+        return _encode_string(value)
+    # bool is checked before int, because it's subclass of int
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float) and not math.isinf(value) and value == value:
+        return repr(value)
+    return json.dumps(value)
+
+
+def _encode_scalar(value):
+    if isinstance(value, (dict, list)):
+        raise ValueError("%r is not scalar" % value)
+    return _encode(value)
+
+
+class Serializer(object):
+    """Serializes metrics of one doc type to bulk index items.
+
+    It's specialized version of json.dumps(morph.flatten(metric)) for
+    metrics: only their host objects (client_src, client_dest) are nested,
+    so only they are flattened and each of them is serialized once, as
+    metrics of one batch share host objects. Action line is precomputed.
+    """
+
+    def __init__(self, doc_type):
+        self.action = json.dumps({"index": {"_type": doc_type}}) + "\n{"
+        # (key, id of host) -> (host, serialized fields), host is kept, so
+        # its id is not reused while serializer is alive
+        self._hosts = {}
+
+    def _flatten(self, key, value):
+        if isinstance(value, dict):
+            prefix = key + "."
+            try:
+                return ", ".join(
+                    _encode_string(prefix + k) + ": " + _encode_scalar(v)
+                    for k, v in value.iteritems())
+            except ValueError:
+                pass    # host has nested objects
+        return ", ".join("%s: %s" % (_encode_string(k), _encode(v))
+                         for k, v in morph.flatten({key: value}).iteritems())
+
+    def _host(self, key, host):
+        cached = self._hosts.get((key, id(host)))
+        if cached is None:
+            cached = (host, self._flatten(key, host))
+            self._hosts[(key, id(host))] = cached
+        return cached[1]
+
+    def item(self, metric):
+        parts = []
+        for key, value in metric.iteritems():
+            if isinstance(value, dict):
+                part = self._host(key, value)
+            elif isinstance(value, list):
+                part = self._flatten(key, value)
+            else:
+                part = _encode_string(key) + ": " + _encode(value)
+            if part:
+                parts.append(part)
+        return self.action + ", ".join(parts) + "}"
+
+    def items(self, metrics):
+        return [self.item(metric) for metric in metrics]
@@ -0,0 +1,88 @@
+# Copyright 2017: GoDaddy Inc.
+
+"""Compact encoding of batches of metrics that clients send to server.
+
+Batch is JSON document {"hosts": [...], "metrics": [...]}. Hosts are stored
+once per batch and metrics refer to them by index: [kind, src, dest, fields].
+Objects that can't be compacted are stored in metrics as is.
+"""
+
+import json
+import zlib
+
+
+CONTENT_TYPE = "application/vnd.netmet.batch+json"
+MAX_SIZE = 64 * 1024 * 1024
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def document(kind, src, dest, fields):
+    """Returns metric document as it's stored in elastic."""
+    fields["client_src"] = src
+    fields["dest" if kind == "north-south" else "client_dest"] = dest
+    return {kind: fields}
+
+
+def dumps(objects, default=None):
+    """Encodes objects, ones that have compact() method are compacted.
+
+    compact() returns kind, src host, dest host and dict with other fields.
+    """
+    hosts = []
+    index = {}
+
+    def intern(host):
+        idx = index.get(id(host))
+        if idx is None:
+            idx = index[id(host)] = len(hosts)
+            hosts.append(host)
+        return idx
+
+    metrics = []
+    for obj in objects:
+        if hasattr(obj, "compact"):
+            kind, src, dest, fields = obj.compact()
+            metrics.append([kind, intern(src), intern(dest), fields])
+        else:
+            metrics.append(obj)
+
+    return json.dumps({"hosts": hosts, "metrics": metrics}, default=default)
+
+
+def loads(data):
+    """Decodes batch to list of metric documents."""
+    batch = json.loads(data)
+    if not isinstance(batch, dict):
+        raise ValueError("Batch should be an object")
+
+    hosts = batch.get("hosts", [])
+    result = []
+    try:
+        for metric in batch.get("metrics", []):
+            if isinstance(metric, list):
+                kind, src, dest, fields = metric
+                metric = document(kind, hosts[src], hosts[dest], fields)
+            result.append(metric)
+    except (TypeError, IndexError) as e:
+        raise ValueError("Wrong batch metric: %s" % e)
+    return result
+
+
+def compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, max_size=MAX_SIZE):
+    """Decompresses gzip data, raises ValueError if it's broken or big."""
+    try:
+        decompressor = zlib.decompressobj(_GZIP_WBITS)
+        result = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError("Can't decompress data: %s" % e)
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed data is bigger than %s bytes"
+                         % max_size)
+    return result
@@ -0,0 +1,217 @@
+# Copyright 2017: GoDaddy Inc.
+
+import collections
+import datetime
+import httplib
+import socket
+import ssl
+import threading
+import urlparse
+
+import monotonic
+
+
+FAILED_CODE = 504
+READ_CHUNK = 65536
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+ERRORS = (httplib.HTTPException, socket.error, ssl.CertificateError)
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """HTTP connection to already resolved ip of host."""
+
+    def __init__(self, host, port, ip, timeout):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.ip = ip
+
+    def connect(self):
+        self.sock = socket.create_connection((self.ip, self.port),
+                                             self.timeout)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """HTTPS connection to already resolved ip, host is used for TLS."""
+
+    def __init__(self, host, port, ip, timeout):
+        httplib.HTTPSConnection.__init__(self, host, port, timeout=timeout)
+        self.ip = ip
+
+    def connect(self):
+        sock = socket.create_connection((self.ip, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class ConnectionPool(object):
+    """Bounded per destination pool of idle keep-alive connections."""
+
+    def __init__(self, max_size=2):
+        self.max_size = max_size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, collections.deque())
+            if len(idle) < self.max_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+
+class HTTPPing(object):
+    """Probes url with GET request and measures each phase of it.
+
+    With keepalive connections are taken from pool and returned back to it
+    if server allows, otherwise every probe opens a new connection.
+    Redirects are followed up to max_redirects times. Urls without http or
+    https scheme or host are not requested, their probes fail.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, url, timeout=5, keepalive=False, pool=None,
+                 resolver=None):
+        parsed = urlparse.urlparse(url)
+        self.url = url
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.valid = parsed.scheme in ("http", "https") and bool(self.host)
+        try:
+            self.port = parsed.port or (443 if self.https else 80)
+        except ValueError:
+            self.port, self.valid = None, False
+        self.path = parsed.path or "/"
+        if parsed.query:
+            self.path += "?" + parsed.query
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.resolver = resolver
+
+    def _resolve(self):
+        if self.resolver:
+            return self.resolver.resolve(self.host)
+
+        started_at = monotonic.monotonic()
+        try:
+            ip = socket.gethostbyname(self.host)
+        except socket.error:
+            ip = None
+        return ip, (monotonic.monotonic() - started_at) * 1000
+
+    def _connection(self, ip):
+        cls = _HTTPSConnection if self.https else _HTTPConnection
+        return cls(self.host, self.port, ip, self.timeout)
+
+    def _request(self, conn, result, started_at):
+        headers = {} if self.keepalive else {"Connection": "close"}
+        conn.request("GET", self.path, headers=headers)
+        r = conn.getresponse()
+        result["ttfb_latency"] = (monotonic.monotonic() - started_at) * 1000
+
+        size = 0
+        chunk = r.read(READ_CHUNK)
+        while chunk:
+            size += len(chunk)
+            chunk = r.read(READ_CHUNK)
+
+        result.update({
+            "ret_code": r.status,
+            "size": size,
+            "latency": (monotonic.monotonic() - started_at) * 1000,
+            "location": r.getheader("location")
+        })
+        return not r.will_close
+
+    def ping(self):
+        """Returns result of probe, latencies are in milliseconds.
+
+        latency is total time of request and redirects that were followed
+        without DNS resolution, other latencies, size and ret_code are of
+        the last response. ret_code is HTTP status or FAILED_CODE if request
+        didn't get response.
+        """
+        started_at = monotonic.monotonic()
+        result = self._ping()
+        timestamp = result["timestamp"]
+        dns_latency = result["dns_latency"]
+        pinger = self
+        redirects = 0
+        while (result["ret_code"] in REDIRECT_CODES and result["location"]
+               and redirects < self.max_redirects):
+            redirects += 1
+            pinger = HTTPPing(urlparse.urljoin(pinger.url, result["location"]),
+                              timeout=self.timeout, keepalive=self.keepalive,
+                              pool=self.pool, resolver=self.resolver)
+            result = pinger._ping()
+            dns_latency += result["dns_latency"]
+
+        if redirects and result["latency"] is not None:
+            result["latency"] = (
+                (monotonic.monotonic() - started_at) * 1000 - dns_latency)
+        result["dest"] = self.url
+        result["timestamp"] = timestamp
+        result.pop("location")
+        return result
+
+    def _ping(self):
+        result = {
+            "ret_code": FAILED_CODE,
+            "timestamp": datetime.datetime.now().isoformat(),
+            "dest": self.url,
+            "size": 0,
+            "dns_latency": 0,
+            "connect_latency": 0,
+            "ttfb_latency": None,
+            "latency": None,
+            "location": None
+        }
+
+        if not self.valid:
+            return result
+
+        ip, result["dns_latency"] = self._resolve()
+        if not ip:
+            return result
+
+        key = (self.https, self.host, self.port, ip)
+        conn = self.keepalive and self.pool.get(key)
+        if conn:
+            try:
+                if self._request(conn, result, monotonic.monotonic()):
+                    self.pool.put(key, conn)
+                else:
+                    conn.close()
+                return result
+            except ERRORS:
+                # server could close idle connection, retry with new one
+                conn.close()
+
+        conn = self._connection(ip)
+        try:
+            started_at = monotonic.monotonic()
+            conn.connect()
+            result["connect_latency"] = (
+                (monotonic.monotonic() - started_at) * 1000)
+            if self._request(conn, result, started_at) and self.keepalive:
+                self.pool.put(key, conn)
+                return result
+        except ERRORS:
+            result.update({"ret_code": FAILED_CODE, "ttfb_latency": None,
+                           "latency": None})
+
+        conn.close()
+        return result
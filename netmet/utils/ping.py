@@ -1,14 +1,26 @@
 # Copyright 2017: GoDaddy Inc.
 
 import datetime
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import math
 import random
 import select
 import socket
 import struct
+import sys
+import threading
+import time
 
 import monotonic
 
 
+LOG = logging.getLogger(__name__)
+
+
 class EXIT_STATUS(object):
     SUCCESS = 0
     ERROR_HOST_NOT_FOUND = 1
@@ -18,62 +30,447 @@ class EXIT_STATUS(object):
     ERROR_SOCKET_ERROR = 5
 
 
+# Linux ioctl that returns kernel receive time of the last read packet,
+# python 2 doesn't have recvmsg() to get it from SO_TIMESTAMPNS cmsg.
+SIOCGSTAMPNS = 0x8907
+
+# Payload and partial checksum of echo request per packet size
+_TEMPLATES = {}
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def _sum16(src):
+    """Ones' complement sum of 16 bit words of src without folding."""
+    count_to = len(src) & -2
+    words = struct.unpack("<%dH" % (count_to // 2), src[:count_to])
+    checksum = sum(words)
+    if count_to < len(src):
+        checksum += ord(src[-1])
+    return checksum
+
+
+def _fold(checksum):
+    """Folds sum to 16 bits and returns its complement in network order."""
+    checksum = (checksum >> 16) + (checksum & 0xffff)
+    checksum += checksum >> 16
+    answer = ~checksum & 0xffff
+    return answer >> 8 | (answer << 8 & 0xff00)
+
+
+def _word(value):
+    """Value of native unsigned short as it is seen by _sum16()."""
+    if _LITTLE_ENDIAN:
+        return value & 0xffff
+    return (value >> 8 & 0xff) | (value << 8 & 0xff00)
+
+
+def _template(packet_size):
+    """Returns payload and checksum of header w/o id & sequence fields.
+
+    Only id and sequence differ between echo requests of the same size, so
+    checksum of a new packet is an incremental update (RFC 1624) of this
+    partial checksum with the two 16 bit fields.
+    """
+    template = _TEMPLATES.get(packet_size)
+    if not template:
+        data = packet_size * "Q"
+        header = struct.pack("bbHHh", 8, 0, 0, 0, 0)
+        template = _TEMPLATES[packet_size] = (data, _sum16(header + data))
+    return template
+
+
+def train_stats(results, interval):
+    """Aggregates results of ping train to one result.
+
+    rtt is average of received replies, jitter is mean difference between
+    RTTs of consecutive received replies.
+    """
+    rtts = [r["rtt"] for r in results if r["ret_code"] == EXIT_STATUS.SUCCESS]
+    codes = [r["ret_code"] for r in results if r["ret_code"]]
+
+    stats = {
+        "rtt": None,
+        "rtt_min": None,
+        "rtt_max": None,
+        "rtt_stddev": None,
+        "jitter": None,
+        "ret_code": EXIT_STATUS.SUCCESS if rtts else codes[0],
+        "count": len(results),
+        "received": len(rtts),
+        "lost": len(results) - len(rtts),
+        "loss": (len(results) - len(rtts)) / float(len(results)),
+        "interval": interval,
+        "packet_size": results[0]["packet_size"],
+        "timeout": results[0]["timeout"],
+        "timestamp": results[0]["timestamp"],
+        "dest": results[0]["dest"],
+        "dest_ip": None,
+        "dns_latency": sum(r.get("dns_latency") or 0 for r in results)
+    }
+
+    if rtts:
+        avg = sum(rtts) / float(len(rtts))
+        stats.update({
+            "rtt": avg,
+            "rtt_min": min(rtts),
+            "rtt_max": max(rtts),
+            "rtt_stddev": math.sqrt(
+                sum((x - avg) ** 2 for x in rtts) / float(len(rtts)))
+        })
+    if len(rtts) > 1:
+        stats["jitter"] = sum(
+            abs(rtts[i] - rtts[i - 1]) for i in xrange(1, len(rtts))
+        ) / float(len(rtts) - 1)
+
+    return stats
+
+
+def open_socket():
+    """Opens ICMP socket, returns socket, whatever it is raw and error code.
+
+    Unprivileged ping socket (SOCK_DGRAM, allowed by Linux sysctl
+    net.ipv4.ping_group_range) is preferred: kernel delivers to it only
+    replies to its own requests and doesn't require root. Raw socket that
+    receives every ICMP packet of the host is the fallback.
+    """
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_ICMP), False, 0
+    except socket.error:
+        pass
+
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                             socket.getprotobyname("icmp")), True, 0
+    except socket.error as e:
+        if e.errno == 1:
+            return None, True, EXIT_STATUS.ERROR_ROOT_REQUIRED
+        return None, True, EXIT_STATUS.ERROR_CANT_OPEN_SOCKET
+
+
+class Engine(object):
+    """Shared ICMP transport for many Ping objects.
+
+    Owns one ICMP socket (see open_socket()) and one receiver thread.
+    Echo requests for all targets are sent through this socket without
+    waiting for a reply. The receiver thread waits on epoll, hands replies
+    back to probes by (source ip, packet id, sequence) and expires probes
+    from a deadline heap, so a probe in flight costs a heap entry instead of
+    a blocked thread.
+
+    With kernel_timestamps=True receive time of a reply is the time when
+    kernel got the packet (SIOCGSTAMPNS), and send time is taken right
+    before sendto(), so RTT doesn't include delays of scheduling python
+    threads on loaded hosts.
+    """
+
+    # Upper bound for one poll() call, so stop() is noticed fast enough
+    max_poll_interval = 0.1
+    # Amount of packets read from socket per one poll() wakeup
+    max_read_batch = 64
+
+    def __init__(self, kernel_timestamps=False):
+        self.ret_code = 0
+        self.sock = None
+        self.raw = True
+        self.kernel_timestamps = kernel_timestamps
+        self._ids = itertools.count(random.randint(0, 65535))
+        self._sequences = itertools.count(random.randint(0, 65535))
+        self._probes = {}
+        self._deadlines = []
+        self._lock = threading.Lock()
+        self._death = threading.Event()
+        self._receiver = None
+
+    def _create_socket(self):
+        self.sock, self.raw, self.ret_code = open_socket()
+        if not self.sock:
+            return
+
+        if self.kernel_timestamps:
+            # First SIOCGSTAMPNS call enables timestamping of socket packets,
+            # ENOENT just means that nothing was received yet.
+            try:
+                fcntl.ioctl(self.sock.fileno(), SIOCGSTAMPNS,
+                            struct.pack("ll", 0, 0))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    LOG.warning("ICMP engine: kernel timestamps are not "
+                                "supported, using user space timestamps.")
+                    self.kernel_timestamps = False
+
+    def _rx_timestamp(self):
+        """Returns kernel receive time of the last read packet or None."""
+        try:
+            timespec = fcntl.ioctl(self.sock.fileno(), SIOCGSTAMPNS,
+                                   struct.pack("ll", 0, 0))
+        except IOError:
+            return None
+        sec, nsec = struct.unpack("ll", timespec)
+        return sec + nsec / 1e9
+
+    def start(self):
+        with self._lock:
+            if self._receiver:
+                return
+            self.ret_code = 0
+            self._death = threading.Event()
+            self._create_socket()
+            if not self.sock:
+                return
+            self._receiver = threading.Thread(target=self._receive)
+            self._receiver.daemon = True
+            self._receiver.start()
+
+    def stop(self):
+        with self._lock:
+            receiver, self._receiver = self._receiver, None
+            if not receiver:
+                return
+            self._death.set()
+
+        receiver.join()
+        with self._lock:
+            self.sock.close()
+            self.sock = None
+            probes, self._probes, self._deadlines = self._probes, {}, []
+
+        for probe in probes.itervalues():
+            self._callback(probe, None)
+
+    def next_id(self):
+        return next(self._ids) & 0xffff
+
+    def send(self, dest_ip, packet, packet_id, sequence, timeout, callback):
+        """Sends packet and returns immediately.
+
+        callback is called from receiver thread with delay in ms or with
+        None if there was no reply in timeout seconds.
+        """
+        sock = self.sock
+        if not sock:
+            raise socket.error("ICMP engine is not started")
+
+        if not self.raw:
+            # Kernel replaces id of packets sent via ping socket with id of
+            # the socket, so probes are told apart only by sequence.
+            packet_id, sequence = 0, next(self._sequences) & 0xffff
+            packet = packet[:6] + struct.pack("H", sequence) + packet[8:]
+
+        key = (dest_ip, packet_id, sequence)
+        # sent_at, deadline, callback, sent_at wall clock (kernel timestamps)
+        probe = [None, None, callback, None]
+        with self._lock:
+            self._probes[key] = probe
+
+        try:
+            while packet:
+                probe[0] = monotonic.monotonic()
+                probe[1] = probe[0] + timeout
+                if self.kernel_timestamps:
+                    probe[3] = time.time()
+                sent = sock.sendto(packet, (dest_ip, 1))
+                packet = packet[sent:]
+        except Exception:
+            with self._lock:
+                self._probes.pop(key, None)
+            raise
+
+        with self._lock:
+            heapq.heappush(self._deadlines, (probe[1], key))
+
+    def ping(self, dest_ip, packet, packet_id, sequence, timeout):
+        """Sends packet and waits for reply, returns delay or None."""
+        done = threading.Event()
+        result = []
+
+        def callback(delay):
+            result.append(delay)
+            done.set()
+
+        self.send(dest_ip, packet, packet_id, sequence, timeout, callback)
+        done.wait(timeout + self.max_poll_interval * 2)
+        return result[0] if result else None
+
+    def _callback(self, probe, delay):
+        try:
+            probe[2](delay)
+        except Exception:
+            LOG.exception("ICMP engine probe callback failed")
+
+    def _poller(self):
+        if hasattr(select, "epoll"):
+            epoll = select.epoll()
+            epoll.register(self.sock.fileno(), select.EPOLLIN)
+            return epoll.poll, epoll.close
+
+        return (lambda timeout: select.select([self.sock], [], [],
+                                              timeout)[0]), lambda: None
+
+    def _next_wait(self):
+        wait = self.max_poll_interval
+        if self._deadlines:
+            wait = min(wait, self._deadlines[0][0] - monotonic.monotonic())
+        return max(wait, 0)
+
+    def _read(self):
+        for _ in xrange(self.max_read_batch):
+            try:
+                rec_packet, addr = self.sock.recvfrom(1024,
+                                                      socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            received_at = monotonic.monotonic()
+            kernel_received_at = (self.kernel_timestamps
+                                  and self._rx_timestamp())
+            if self.raw:
+                type_, code, checksum, rec_id, sequence = struct.unpack(
+                    "bbHHH", rec_packet[20:28])
+            else:
+                type_, code, checksum, rec_id, sequence = struct.unpack(
+                    "bbHHH", rec_packet[:8])
+                rec_id = 0
+            if type_ != 0:
+                continue
+
+            with self._lock:
+                probe = self._probes.pop((addr[0], rec_id, sequence), None)
+            if probe:
+                if received_at > probe[1]:
+                    self._callback(probe, None)
+                elif kernel_received_at and probe[3]:
+                    self._callback(probe,
+                                   (kernel_received_at - probe[3]) * 1000)
+                else:
+                    self._callback(probe, (received_at - probe[0]) * 1000)
+
+    def _expire(self):
+        now = monotonic.monotonic()
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, key = heapq.heappop(self._deadlines)
+                probe = self._probes.get(key)
+                if probe and probe[1] <= now:
+                    expired.append(self._probes.pop(key))
+
+        for probe in expired:
+            self._callback(probe, None)
+
+    def _receive(self):
+        poll, close = self._poller()
+        try:
+            while not self._death.is_set():
+                try:
+                    if poll(self._next_wait()):
+                        self._read()
+                    self._expire()
+                except Exception:
+                    if not self._death.is_set():
+                        LOG.exception("ICMP engine failed to receive packet")
+        finally:
+            close()
+
+
 class Ping(object):
 
-    def __init__(self, dest, timeout=1, packet_size=55):
+    def __init__(self, dest, timeout=1, packet_size=55, engine=None,
+                 resolver=None):
         self.ret_code = 0
         self.sock = None
+        self.raw = True
         self.dest = dest
         self.dest_ip = None
+        self.dns_latency = 0
         self.timeout = timeout
         self.packet_size = packet_size
+        self.engine = engine
+        self.resolver = resolver
         self._create_socket()
 
-    def _create_socket(self):
+    def _resolve(self):
+        """Sets dest_ip and dns_latency, returns False if dest is unknown.
+
+        With resolver dest is resolved through its cache before every ping,
+        otherwise only once when socket is created.
+        """
+        if self.resolver:
+            self.dest_ip, self.dns_latency = self.resolver.resolve(self.dest)
+            return bool(self.dest_ip)
+
         try:
             socket.inet_pton(socket.AF_INET, self.dest)
-            dest_ip = self.dest
+            self.dest_ip = self.dest
         except socket.error:
+            started_at = monotonic.monotonic()
             try:
-                dest_ip = socket.gethostbyname(self.dest)
+                self.dest_ip = socket.gethostbyname(self.dest)
             except socket.gaierror:
-                self.ret_code = EXIT_STATUS.ERROR_HOST_NOT_FOUND
-                return
-        self.dest_ip = dest_ip
+                return False
+            self.dns_latency = (monotonic.monotonic() - started_at) * 1000
+        return True
 
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
-                                      socket.getprotobyname("icmp"))
-        except socket.error as e:
-            if e.errno == 1:
-                self.ret_code = EXIT_STATUS.ERROR_ROOT_REQUIRED
-            else:
-                self.ret_code = EXIT_STATUS.ERROR_CANT_OPEN_SOCKET
+    def _create_socket(self):
+        self.ret_code = 0
+        if not self._resolve():
+            self.ret_code = EXIT_STATUS.ERROR_HOST_NOT_FOUND
             return
 
+        if self.engine:
+            return
+
+        self.sock, self.raw, self.ret_code = open_socket()
+
     def __del__(self):
         if getattr(self, "sock", False):
             self.sock.close()
 
-    def ping(self):
-        result = {
+    def _new_result(self):
+        return {
             "rtt": None,
             "ret_code": None,
             "packet_size": self.packet_size,
             "timeout": self.timeout,
             "timestamp": datetime.datetime.now().isoformat(),
             "dest": self.dest_ip,
-            "dest_ip": None
+            "dest_ip": None,
+            "dns_latency": self.dns_latency
         }
 
-        if not self.sock:
+    def _set_delay(self, result, delay):
+        if delay is not None:
+            result["ret_code"] = EXIT_STATUS.SUCCESS
+            result["rtt"] = delay
+        else:
+            result["ret_code"] = EXIT_STATUS.ERROR_TIMEOUT
+        return result
+
+    def _get_ret_code(self):
+        if self.resolver and self.dest_ip and not self._resolve():
+            return EXIT_STATUS.ERROR_HOST_NOT_FOUND
+
+        if not (self.sock or self.engine and self.dest_ip):
             self._create_socket()
 
-        if self.ret_code:
-            result["ret_code"] = self.ret_code
+        return self.ret_code or self.engine and self.engine.ret_code
+
+    def ping(self):
+        ret_code = self._get_ret_code()
+        result = self._new_result()
+        if ret_code:
+            result["ret_code"] = ret_code
             return result
 
         try:
+            if self.engine:
+                packet_id = self.engine.next_id()
+                return self._set_delay(result, self.engine.ping(
+                    self.dest_ip, self._create_packet(packet_id),
+                    packet_id, 1, self.timeout))
+
             packet_id = random.randint(0, 65534)
             packet = self._create_packet(packet_id)
             while packet:
@@ -81,46 +478,83 @@ class Ping(object):
                 sent = self.sock.sendto(packet, (self.dest_ip, 1))
                 packet = packet[sent:]
 
-            delay = self._response_handler(packet_id, strated_at)
-            if delay:
-                result["ret_code"] = EXIT_STATUS.SUCCESS
-                result["rtt"] = delay
-            else:
-                result["ret_code"] = EXIT_STATUS.ERROR_TIMEOUT
+            self._set_delay(result,
+                            self._response_handler(packet_id, strated_at))
         except socket.error:
             result["ret_code"] = EXIT_STATUS.ERROR_SOCKET_ERROR
 
         return result
 
+    def ping_async(self, callback):
+        """Sends echo request and returns without waiting for reply.
+
+        callback is called with the same result that ping() returns, from
+        engine receiver thread. Without engine it is just a blocking ping().
+        """
+        if not self.engine:
+            callback(self.ping())
+            return
+
+        self._send_async(self.engine.next_id(), 1, callback)
+
+    def _send_async(self, packet_id, sequence, callback):
+        ret_code = self._get_ret_code()
+        result = self._new_result()
+        if ret_code:
+            result["ret_code"] = ret_code
+            callback(result)
+            return
+
+        try:
+            self.engine.send(
+                self.dest_ip, self._create_packet(packet_id, sequence),
+                packet_id, sequence, self.timeout,
+                lambda d: callback(self._set_delay(result, d)))
+        except socket.error:
+            result["ret_code"] = EXIT_STATUS.ERROR_SOCKET_ERROR
+            callback(result)
+
+    def ping_train(self, count, interval, callback):
+        """Sends train of echo requests and reports aggregated result.
+
+        Packets of train share id and have sequence numbers 1..count, they
+        are sent with interval seconds between them. callback is called once
+        with result of train_stats() when the last reply arrives or expires.
+        """
+        results = [None] * count
+        remaining = [count]
+        lock = threading.Lock()
+
+        def collect(idx):
+            def callback_(result):
+                results[idx] = result
+                with lock:
+                    remaining[0] -= 1
+                    last = not remaining[0]
+                if last:
+                    callback(train_stats(results, interval))
+            return callback_
+
+        packet_id = self.engine.next_id() if self.engine else None
+        for i in xrange(count):
+            if i:
+                time.sleep(interval)
+            if self.engine:
+                self._send_async(packet_id, i + 1, collect(i))
+            else:
+                collect(i)(self.ping())
+
     def _checksum(self, src):
-        checksum = 0
-        count_to = len(src) & -2
-        count = 0
-        while count < count_to:
-            this_val = ord(src[count + 1]) * 256 + ord(src[count])
-            checksum += this_val
-            checksum &= 0xffffffff
-            count += 2
-        if count_to < len(src):
-            checksum += ord(src[len(src) - 1])
-            checksum &= 0xffffffff
-        checksum = (checksum >> 16) + (checksum & 0xffff)
-        checksum += checksum >> 16
-        answer = ~checksum
-        answer &= 0xffff
-        return answer >> 8 | (answer << 8 & 0xff00)
-
-    def _create_packet(self, packet_id):
+        return _fold(_sum16(src))
+
+    def _create_packet(self, packet_id, sequence=1):
         """Creates a new echo request packet based on the given id."""
-        # Builds Dummy Header
         # Header is type (8), code (8), checksum (16), id (16), sequence (16)
-        header = struct.pack("bbHHh", 8, 0, 0, packet_id, 1)
-        data = self.packet_size * "Q"
+        data, checksum = _template(self.packet_size)
+        checksum = _fold(checksum + _word(packet_id) + _word(sequence))
 
-        # Builds Real Header
-        header = struct.pack(
-            "bbHHh", 8, 0, socket.htons(self._checksum(header + data)),
-            packet_id, 1)
+        header = struct.pack("bbHHh", 8, 0, socket.htons(checksum),
+                             packet_id, sequence)
         return header + data
 
     def _response_handler(self, packet_id, sent_at):
@@ -133,11 +567,13 @@ class Ping(object):
 
             rec_packet, addr = self.sock.recvfrom(1024)
             received_at = monotonic.monotonic()
-            icmp_header = rec_packet[20:28]
+            icmp_header = rec_packet[20:28] if self.raw else rec_packet[:8]
             type_, code, checksum, rec_id, sequence = struct.unpack(
                 "bbHHh", icmp_header)
 
-            if type_ == 0 and rec_id == packet_id:
+            # NOTE: Kernel sets id of ping socket packets, it delivers to
+            #       the socket only replies to its own requests.
+            if type_ == 0 and (rec_id == packet_id or not self.raw):
                 return (received_at - sent_at) * 1000
 
         return None
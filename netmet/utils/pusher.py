@@ -3,55 +3,200 @@
 import collections
 import json
 import logging
+import random
 import threading
 
 import futurist
 import monotonic
 import requests
 
+from netmet.utils import batch
+from netmet.utils import spool
+
 
 LOG = logging.getLogger(__name__)
 
+# 202 (accepted for processing) is success as well
+SUCCESS = [201, 202]
+
+
+class Window(object):
+    """Adapts batch size and delay between requests to state of server.
+
+    Batch size grows by step objects after every fast successful request
+    and is halved when server is overloaded: it fails, answers 429 or 5xx
+    or answers slower than target_latency (AIMD). Delay between requests is
+    doubled on every failed request up to max_delay, after slow request it
+    is not shorter than its latency and after fast one it's halved down to
+    min_delay. Delays are jittered, so clients don't retry in sync.
+    """
+
+    def __init__(self, max_count, min_count=10, step=None, min_delay=0.2,
+                 max_delay=60, target_latency=1.0):
+        self.max_count = max_count
+        self.min_count = min(min_count, max_count)
+        self.step = step or self.min_count
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.count = max_count
+        self.delay = min_delay
+
+    def _decrease(self):
+        self.count = max(self.min_count, self.count // 2)
+
+    def update(self, status, latency, retry_after=None):
+        """Updates window by result of request.
+
+        status is HTTP status code or None if request failed.
+        """
+        if status in SUCCESS:
+            if latency > self.target_latency:
+                self._decrease()
+                self.delay = min(self.max_delay, max(self.min_delay, latency))
+            else:
+                self.count = min(self.max_count, self.count + self.step)
+                self.delay = max(self.min_delay, self.delay / 2.0)
+            return
+
+        if status is None or status == 429 or status >= 500:
+            self._decrease()
+        self.delay = min(self.max_delay,
+                         max(self.min_delay, self.delay * 2, retry_after or 0))
+
+    def wait_time(self):
+        """Returns jittered delay before next request."""
+        return random.uniform(self.delay / 2.0, self.delay)
+
 
 class Pusher(object):
+    """Sends objects to url in batches.
+
+    Up to max_memory objects are kept in memory, others are spilled to disk
+    spool if spool_dir is set or the oldest are dropped otherwise or if spool
+    can't be written (e.g. no permissions or free space). Objects
+    from spool are sent in the same order with up to drain_rate objects per
+    second, objects that are not sent are moved to spool on stop().
+
+    With compact objects are sent in batch format and with compress they are
+    gzipped. If server doesn't accept them, pusher falls back to plain JSON.
+
+    With adaptive batch size and delays between requests are set by Window
+    instead of max_count and dealey_between_requests, which become their
+    limits. Instead of giving up after 3 failed requests in row pusher backs
+    off till delay reaches period, then next send is delayed by it as well.
+    """
 
     def __init__(self, url, extra_headers=None, period=10, max_count=1000,
-                 dealey_between_requests=0.2, timeout=2):
+                 dealey_between_requests=0.2, timeout=2, json_default=None,
+                 max_memory=10000, spool_dir=None, drain_rate=None,
+                 compact=False, compress=False, adaptive=False,
+                 max_backoff=60, target_latency=1.0, on_response=None):
         self.url = url
         self.extra_headers = extra_headers
+        self.on_response = on_response
         self.period = period
         self.dealey_between_requests = dealey_between_requests
         self.timeout = timeout
         self.max_count = max_count
+        self.json_default = json_default
+        self.max_memory = max_memory
+        self.drain_rate = drain_rate
+        self.compact = compact
+        self.compress = compress
+        self.dropped = 0
+        self.spool_errors = 0
+        self.window = None
+        if adaptive:
+            self.window = Window(max_count, min_delay=dealey_between_requests,
+                                 max_delay=max_backoff,
+                                 target_latency=target_latency)
+        self._interval = period
         self.objects = collections.deque()
+        self.spool = None
+        if spool_dir:
+            self.spool = spool.Spool(spool_dir, json_default=json_default)
+        self._lock = threading.Lock()
         self._worker = None
         self.session = requests.session()
 
+    def _refill(self):
+        """Moves objects from spool to memory, returns True if it did."""
+        if not self.spool or self.spool.empty():
+            return False
+
+        with self._lock:
+            free = self.max_memory - len(self.objects)
+            if free > 0:
+                self.objects.extend(self.spool.read(free))
+        return True
+
+    def _encode(self, body):
+        if not (self.compact or self.compress):
+            return json.dumps(body, default=self.json_default), {}
+
+        headers = {}
+        if self.compact:
+            data = batch.dumps(body, default=self.json_default)
+            headers["Content-Type"] = batch.CONTENT_TYPE
+        else:
+            data = json.dumps(body, default=self.json_default)
+            headers["Content-Type"] = "application/json"
+
+        if self.compress:
+            data = batch.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        return data, headers
+
+    def _retry_after(self, response):
+        try:
+            return float(response.headers.get("Retry-After", 0))
+        except (TypeError, ValueError):
+            return 0
+
     def _send(self):
         body = []
         fails_in_row = 0
         while not self._death.is_set():
+            draining = self._refill()
+            max_count = self.window.count if self.window else self.max_count
+            while len(body) > max_count:
+                self.objects.appendleft(body.pop())
             count = len(body)
-            while self.objects and count < self.max_count:
+            while self.objects and count < max_count:
                 count += 1
                 body.append(self.objects.popleft())
+            sent = len(body)
 
             error_status = None
+            status, retry_after = None, None
+            started_at = monotonic.monotonic()
             try:
-                data = json.dumps(body)
-                headers = {}
+                data, headers = self._encode(body)
                 if isinstance(self.extra_headers, dict):
-                    headers = self.extra_headers
+                    headers.update(self.extra_headers)
                 if callable(self.extra_headers):
-                    headers = self.extra_headers(data)
+                    headers.update(self.extra_headers(data))
 
                 r = self.session.post(
                     self.url, data=data, headers=headers, timeout=self.timeout)
-                if r.status_code == 201:
+                if self.on_response:
+                    self.on_response(r)
+                if (r.status_code in [400, 415]
+                        and (self.compact or self.compress)):
+                    LOG.warning("%s doesn't accept compact or compressed "
+                                "data, sending plain JSON" % self.url)
+                    self.compact = self.compress = False
+                    continue
+
+                status = r.status_code
+                if status == 429:
+                    retry_after = self._retry_after(r)
+                if r.status_code in SUCCESS:
                     body = []
                     fails_in_row = 0
-
-                error_status = r.status_code if r.status_code != 201 else None
+                else:
+                    error_status = r.status_code
             except requests.exceptions.RequestException as e:
                 error_status = str(e)
             finally:
@@ -60,21 +205,42 @@ class Pusher(object):
                     LOG.warning("Can't push data to %s (status %s)"
                                 % (self.url, error_status))
 
-            if not body and len(self.objects) < self.max_count:
+            if self.window:
+                self.window.update(status, monotonic.monotonic() - started_at,
+                                   retry_after=retry_after)
+
+            backlog = self.spool and not self.spool.empty()
+            if not body and len(self.objects) < max_count and not backlog:
                 break
 
-            if fails_in_row > 2:
-                self.objects.extendleft(body[::-1])
+            if self.window:
+                if status not in SUCCESS and self.window.delay >= self.period:
+                    break
+                delay = self.window.wait_time()
+            elif fails_in_row > 2:
                 break
+            else:
+                delay = self.dealey_between_requests
+
+            if draining and self.drain_rate and not error_status:
+                delay = max(delay, sent / float(self.drain_rate))
+            self._death.wait(delay)
 
-            self._death.wait(self.dealey_between_requests)
+        if body:
+            self.objects.extendleft(body[::-1])
+
+    def _next_interval(self):
+        if self.window and self.window.delay >= self.period:
+            return max(self.period, self.window.wait_time())
+        return self.period
 
     def _send_periodically(self):
         while not self._death.is_set():
             try:
-                if monotonic.monotonic() - self._started_at > self.period:
+                if monotonic.monotonic() - self._started_at > self._interval:
                     self._send()
                     self._started_at = monotonic.monotonic()
+                    self._interval = self._next_interval()
 
                 self._death.wait(self.period / 20.0)
             except Exception:
@@ -83,8 +249,32 @@ class Pusher(object):
                 self._started_at = monotonic.monotonic()
                 LOG.exception("Pusher failed")
 
+    def _spool_append(self, item):
+        """Appends item to spool, returns False if spool can't be written."""
+        try:
+            self.spool.append([item])
+            return True
+        except (IOError, OSError) as e:
+            self.spool_errors += 1
+            if self.spool_errors % self.max_memory == 1:
+                LOG.warning("Can't write to spool %s, objects are kept in "
+                            "memory: %s" % (self.spool.path, e))
+            return False
+
     def add(self, item):
-        self.objects.append(item)
+        with self._lock:
+            full = len(self.objects) >= self.max_memory
+            if self.spool and (full or not self.spool.empty()):
+                if self._spool_append(item):
+                    return
+
+            if full:
+                self.objects.popleft()
+                self.dropped += 1
+                if self.dropped % self.max_memory == 1:
+                    LOG.warning("Pusher buffer is full, %s objects are "
+                                "dropped" % self.dropped)
+            self.objects.append(item)
 
     def start(self):
         if not self._worker:
@@ -97,3 +287,17 @@ class Pusher(object):
         if self._worker:
             self._death.set()
             self._worker.shutdown()
+            self._worker = None
+
+        if self.spool:
+            with self._lock:
+                try:
+                    self.spool.prepend(list(self.objects))
+                    self.objects.clear()
+                except (IOError, OSError):
+                    LOG.exception("Can't move %s objects to spool %s"
+                                  % (len(self.objects), self.spool.path))
+            try:
+                self.spool.close()
+            except (IOError, OSError):
+                LOG.exception("Can't close spool %s" % self.spool.path)
@@ -0,0 +1,98 @@
+# Copyright 2017: GoDaddy Inc.
+
+import logging
+import socket
+import threading
+
+import monotonic
+
+
+LOG = logging.getLogger(__name__)
+
+
+def is_ip(host):
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+        return True
+    except (socket.error, TypeError):
+        return False
+
+
+class Resolver(object):
+    """Cache of hostname resolutions shared by all probes.
+
+    Resolved addresses are kept for ttl seconds and failed resolutions for
+    negative_ttl seconds. Entry that is used when it's older than
+    refresh_after part of its ttl is resolved again in background, so
+    probes don't wait for DNS while it's valid.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=10, refresh_after=0.75):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_after = refresh_after
+        self._cache = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _lookup(self, host):
+        started_at = monotonic.monotonic()
+        try:
+            ip = socket.gethostbyname(host)
+        except socket.error:
+            ip = None
+
+        resolved_at = monotonic.monotonic()
+        with self._lock:
+            self._cache[host] = (ip, resolved_at)
+        return ip, (resolved_at - started_at) * 1000
+
+    def _refresh(self, host):
+        try:
+            self._lookup(host)
+        except Exception:
+            LOG.exception("Resolver failed to refresh %s" % host)
+        finally:
+            with self._lock:
+                self._refreshing.discard(host)
+
+    def _refresh_async(self, host):
+        with self._lock:
+            if host in self._refreshing:
+                return
+            self._refreshing.add(host)
+
+        thread = threading.Thread(target=self._refresh, args=(host,))
+        thread.daemon = True
+        thread.start()
+
+    def resolve(self, host):
+        """Returns ip of host (None if not found) and resolve time in ms.
+
+        Resolve time is 0 if host is ip address or it's taken from cache.
+        """
+        if is_ip(host):
+            return host, 0
+
+        entry = self._cache.get(host)
+        if entry:
+            ip, resolved_at = entry
+            age = monotonic.monotonic() - resolved_at
+            ttl = self.ttl if ip else self.negative_ttl
+            if age < ttl:
+                if ip and age > ttl * self.refresh_after:
+                    self._refresh_async(host)
+                return ip, 0
+
+        return self._lookup(host)
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+
+
+_RESOLVER = Resolver()
+
+
+def get():
+    return _RESOLVER
@@ -0,0 +1,124 @@
+# Copyright 2017: GoDaddy Inc.
+
+import heapq
+import logging
+import threading
+import time
+import zlib
+
+import monotonic
+
+
+LOG = logging.getLogger(__name__)
+
+SKIP = "skip"
+CATCH_UP = "catch-up"
+POLICIES = [SKIP, CATCH_UP]
+
+
+def phase(key):
+    """Returns stable phase in [0, 1) for key."""
+    return (zlib.crc32(key) & 0xffffffff) / float(2 ** 32)
+
+
+class Scheduler(object):
+    """Runs tasks periodically at absolute deadlines.
+
+    Every run of task is planned period after previous deadline, not after
+    time when it was actually run, so delays don't accumulate. Runs of task
+    happen at the same phase of its period (shared wall clock based), that
+    is stable across restarts of process.
+
+    If task is late at least by one period, runs that were missed are
+    skipped with SKIP policy, with CATCH_UP policy up to max_catch_up of
+    them are run right away and the rest are skipped.
+    """
+
+    warn_interval = 60
+
+    def __init__(self, policy=SKIP, max_catch_up=3):
+        if policy not in POLICIES:
+            raise ValueError("Scheduler policy should be one of %s" % POLICIES)
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self._tasks = []
+        self._queue = []
+        self._stats = {"runs": 0, "skipped": 0, "lag_total": 0, "lag_max": 0}
+        self._lock = threading.Lock()
+        self._warned_at = None
+
+    def add(self, period, task, phase=0):
+        """Adds task that is run every period seconds at phase of it."""
+        now = monotonic.monotonic()
+        first = now + (phase * period - time.time()) % period
+        heapq.heappush(self._queue, (first, len(self._tasks)))
+        self._tasks.append((period, task))
+
+    def _next_deadline(self, deadline, period, lag):
+        missed = int(lag // period)
+        allowed = self.max_catch_up if self.policy == CATCH_UP else 0
+        if missed <= allowed:
+            return deadline + period, 0
+        return deadline + (missed - allowed + 1) * period, missed - allowed
+
+    def _count(self, lag, skipped):
+        with self._lock:
+            self._stats["skipped"] += skipped
+            self._stats["runs"] += 1
+            self._stats["lag_total"] += lag
+            self._stats["lag_max"] = max(self._stats["lag_max"], lag)
+
+        if skipped:
+            now = monotonic.monotonic()
+            if (self._warned_at is None
+                    or now - self._warned_at > self.warn_interval):
+                self._warned_at = now
+                LOG.warning("Scheduler is late on %.3f seconds, %s runs of "
+                            "task are skipped" % (lag, skipped))
+
+    def run(self, death, dispatch):
+        """Calls dispatch(task) on deadlines of task until death is set.
+
+        dispatch returns False if it didn't run task, that is counted as
+        skipped run.
+        """
+        while self._queue and not death.is_set():
+            deadline, idx = self._queue[0]
+            now = monotonic.monotonic()
+            if deadline > now:
+                death.wait(deadline - now)
+                continue
+
+            period, task = self._tasks[idx]
+            lag = now - deadline
+            next_deadline, skipped = self._next_deadline(deadline, period, lag)
+            heapq.heapreplace(self._queue, (next_deadline, idx))
+            if dispatch(task) is False:
+                skipped += 1
+            self._count(lag, skipped)
+
+    def stats(self):
+        """Returns amount of runs, skipped runs and lag in ms."""
+        with self._lock:
+            s = dict(self._stats)
+
+        lag_total = s.pop("lag_total")
+        s["tasks"] = len(self._tasks)
+        s["lag_avg"] = lag_total * 1000 / s["runs"] if s["runs"] else 0
+        s["lag_max"] *= 1000
+        s["lag_total"] = lag_total * 1000
+        return s
+
+
+def merge_stats(stats):
+    """Merges stats of few schedulers into one."""
+    merged = {"tasks": 0, "runs": 0, "skipped": 0, "lag_total": 0,
+              "lag_max": 0, "lag_avg": 0}
+    for s in stats:
+        for key in ["tasks", "runs", "skipped", "lag_total"]:
+            merged[key] += s[key]
+        merged["lag_max"] = max(merged["lag_max"], s["lag_max"])
+
+    if merged["runs"]:
+        merged["lag_avg"] = merged["lag_total"] / merged["runs"]
+    return merged
@@ -4,12 +4,21 @@ import datetime
 import functools
 import hashlib
 import hmac
+import urlparse
 
 import flask
 
 from netmet import config
 
 
+HMAC_VERSIONS = [1, 2]
+HMAC_VERSIONS_HEADER = "X-AUTH-HMAC-VERSIONS"
+
+_KEY_IDS = {}
+# netloc of peer -> hmac version that it advertised
+_PEER_VERSIONS = {}
+
+
 def generate_digest(data, hmac_key):
     """Generate a hmac using a known key given the provided content."""
     h = hmac.new(hmac_key, data, digestmod=hashlib.sha384)
@@ -17,6 +26,22 @@ def generate_digest(data, hmac_key):
     return h.hexdigest()
 
 
+def generate_digest_v2(data, timestamp, hmac_key):
+    """Generate a hmac of timestamp and content in one pass over content."""
+    h = hmac.new(hmac_key, timestamp + "\n", digestmod=hashlib.sha384)
+    h.update(data)
+    return h.hexdigest()
+
+
+def key_id(hmac_key):
+    """Returns id of hmac key, that can be sent without revealing the key."""
+    if hmac_key not in _KEY_IDS:
+        _KEY_IDS[hmac_key] = hmac.new(
+            hmac_key, "netmet-key-id", digestmod=hashlib.sha256
+        ).hexdigest()[:16]
+    return _KEY_IDS[hmac_key]
+
+
 def is_valid_digest(hexdigest, data, valid_hmacs):
     """Check whatever hexdigest is valid for data and any of valid_hmacs
 
@@ -30,29 +55,94 @@ def is_valid_digest(hexdigest, data, valid_hmacs):
     return False
 
 
-def gen_hmac_headers(data, hmac=None):
+def is_valid_digest_v2(hexdigest, data, timestamp, valid_hmacs, kid=None):
+    """Check whatever v2 hexdigest is valid for data and any of valid_hmacs
+
+    If kid is set, only hmac with such key id is checked.
+    """
+    for valid_hmac in valid_hmacs:
+        if kid and kid != key_id(valid_hmac):
+            continue
+        if hmac.compare_digest(
+                hexdigest, generate_digest_v2(data, timestamp, valid_hmac)):
+            return True
+    return False
+
+
+def hmac_version(url=None):
+    """Returns hmac version to sign requests to url.
+
+    It's version from config if it's set, otherwise the highest version
+    that peer advertised or 1, that all peers accept.
+    """
+    version = config.get("hmac_version", None)
+    if version:
+        return version
+    if url:
+        return _PEER_VERSIONS.get(urlparse.urlparse(url).netloc, 1)
+    return 1
+
+
+def learn_hmac_version(url, response):
+    """Remembers the highest hmac version advertised in response of peer."""
+    peer = urlparse.urlparse(url).netloc
+    try:
+        header = response.headers.get(HMAC_VERSIONS_HEADER) or ""
+        versions = [int(v) for v in header.split(",") if v.strip()]
+        versions = [v for v in versions if v in HMAC_VERSIONS]
+    except (AttributeError, TypeError, ValueError):
+        versions = []
+
+    if versions:
+        _PEER_VERSIONS[peer] = max(versions)
+    else:
+        # peer was downgraded or doesn't support negotiation
+        _PEER_VERSIONS.pop(peer, None)
+
+
+def gen_hmac_headers(data, hmac=None, version=None, url=None):
     """Generates and returns valid headers for HMAC auth as dicts
 
     Generates timestamp place it in X-AUTH-HMAC-TIMESTAMP
     Adds timestamp to data and generates hmac digest and puts it to
     X-AUTH-HMAC-DIGEST.
+
+    Version 2 digest is generated in one pass over data, its version and id
+    of key are put to X-AUTH-HMAC-VERSION and X-AUTH-HMAC-KEY-ID. If version
+    is not set, it's negotiated with peer at url (see hmac_version()).
     """
     if not (hmac or config.get("hmac_keys")):
         return {}
 
+    hmac_key = hmac or config.get("hmac_keys")[0]
+    version = version or hmac_version(url)
     timestamp = datetime.datetime.now().strftime("%s")
     headers = {}
     headers["X-AUTH-HMAC-TIMESTAMP"] = timestamp
-    headers["X-AUTH-HMAC-DIGEST"] = generate_digest(
-        data + timestamp, hmac or config.get("hmac_keys")[0])
+    if version == 1:
+        headers["X-AUTH-HMAC-DIGEST"] = generate_digest(
+            data + timestamp, hmac_key)
+    else:
+        headers["X-AUTH-HMAC-VERSION"] = str(version)
+        headers["X-AUTH-HMAC-KEY-ID"] = key_id(hmac_key)
+        headers["X-AUTH-HMAC-DIGEST"] = generate_digest_v2(
+            data, timestamp, hmac_key)
     return headers
 
 
 def check_hmac_auth(f):
     """Flask decorator for checking hmac auth."""
 
+    def advertise_versions(response):
+        response.headers[HMAC_VERSIONS_HEADER] = ",".join(
+            str(v) for v in HMAC_VERSIONS)
+        return response
+
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
+        # senders use the highest version that receiver advertises
+        if flask.has_request_context():
+            flask.after_this_request(advertise_versions)
         if not config.get("hmac_skip_check"):
             data = flask.request.get_data()
             digest = str(flask.request.headers.get("X-AUTH-HMAC-DIGEST"))
@@ -67,8 +157,19 @@ def check_hmac_auth(f):
             if int(now) - int(timestamp) > 30:
                 return flask.jsonify({"error": "HMAC digest expired"}), 403
 
-            if not is_valid_digest(digest, data + timestamp,
-                                   config.get("hmac_keys")):
+            version = flask.request.headers.get("X-AUTH-HMAC-VERSION", "1")
+            if version == "1":
+                valid = is_valid_digest(digest, data + timestamp,
+                                        config.get("hmac_keys"))
+            elif version == "2":
+                valid = is_valid_digest_v2(
+                    digest, data, timestamp, config.get("hmac_keys"),
+                    kid=flask.request.headers.get("X-AUTH-HMAC-KEY-ID"))
+            else:
+                msg = "Unsupported HMAC version %s" % version
+                return flask.jsonify({"error": msg}), 403
+
+            if not valid:
                 return flask.jsonify({"error": "Wrong or missing digest"}), 403
 
         return f(*args, **kwargs)
@@ -0,0 +1,183 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+import logging
+import os
+import struct
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+_FRAME_HEADER = struct.Struct(">I")
+_SEGMENT_SUFFIX = ".seg"
+
+
+class Spool(object):
+    """Append-only FIFO queue of JSON items on disk.
+
+    Items are stored in segment files as frames: 4 bytes of length and JSON
+    document. New segment is started when the current one is bigger than
+    segment_size, segment is removed when all its items are read. If spool
+    grows bigger than max_size, the oldest segments are dropped.
+    """
+
+    def __init__(self, path, segment_size=4 * 1024 * 1024,
+                 max_size=512 * 1024 * 1024, json_default=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.json_default = json_default
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._writer = None
+        self._offsets = {}
+        self._segments = []
+        self._size = 0
+
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if name.endswith(_SEGMENT_SUFFIX):
+                    self._segments.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+                    self._size += os.path.getsize(os.path.join(path, name))
+            self._segments.sort()
+            if self._segments:
+                LOG.info("Spool %s has %s bytes from previous run"
+                         % (path, self._size))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "%d%s" % (segment, _SEGMENT_SUFFIX))
+
+    def _frames(self, items):
+        for item in items:
+            data = json.dumps(item, default=self.json_default)
+            yield _FRAME_HEADER.pack(len(data)) + data
+
+    def _close_writer(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def _open_writer(self):
+        self._close_writer()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        segment = self._segments[-1] + 1 if self._segments else 0
+        self._writer = open(self._segment_path(segment), "ab")
+        self._segments.append(segment)
+
+    def _remove_segment(self, segment):
+        if self._writer and segment == self._segments[-1]:
+            self._close_writer()
+
+        path = self._segment_path(segment)
+        self._size -= os.path.getsize(path)
+        os.remove(path)
+        self._segments.remove(segment)
+        self._offsets.pop(segment, None)
+
+    def _drop_oldest(self):
+        while self._size > self.max_size and len(self._segments) > 1:
+            size = os.path.getsize(self._segment_path(self._segments[0]))
+            self.dropped += size
+            LOG.warning("Spool %s exceeded %s bytes, dropping the oldest %s "
+                        "bytes" % (self.path, self.max_size, size))
+            self._remove_segment(self._segments[0])
+
+    def empty(self):
+        return not self._segments
+
+    def size(self):
+        return self._size
+
+    def append(self, items):
+        """Puts items to the end of spool."""
+        with self._lock:
+            try:
+                for frame in self._frames(items):
+                    if (not self._writer
+                            or self._writer.tell() >= self.segment_size):
+                        self._open_writer()
+                    self._writer.write(frame)
+                    self._size += len(frame)
+            except (IOError, OSError):
+                # frame could be written partially, new frames go to new
+                # segment, so they are not read shifted
+                try:
+                    self._close_writer()
+                except (IOError, OSError):
+                    self._writer = None
+                raise
+            self._drop_oldest()
+
+    def prepend(self, items):
+        """Puts items before all items that are in spool."""
+        if not items:
+            return
+
+        with self._lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            segment = self._segments[0] - 1 if self._segments else 0
+            with open(self._segment_path(segment), "wb") as f:
+                for frame in self._frames(items):
+                    f.write(frame)
+                    self._size += len(frame)
+            self._segments.insert(0, segment)
+
+    def read(self, count):
+        """Removes from spool and returns up to count the oldest items."""
+        items = []
+        with self._lock:
+            if self._writer:
+                self._writer.flush()
+
+            while self._segments and len(items) < count:
+                segment = self._segments[0]
+                with open(self._segment_path(segment), "rb") as f:
+                    f.seek(self._offsets.get(segment, 0))
+                    while len(items) < count:
+                        header = f.read(_FRAME_HEADER.size)
+                        if len(header) < _FRAME_HEADER.size:
+                            break
+                        data = f.read(_FRAME_HEADER.unpack(header)[0])
+                        try:
+                            items.append(json.loads(data))
+                        except ValueError:
+                            # frame that was partially written before crash
+                            LOG.warning("Spool %s: skipping broken item in "
+                                        "segment %s" % (self.path, segment))
+                    else:
+                        self._offsets[segment] = f.tell()
+                        break
+
+                self._remove_segment(segment)
+
+        return items
+
+    def _cut_read_items(self, segment, offset):
+        if self._writer and segment == self._segments[-1]:
+            self._close_writer()
+
+        path = self._segment_path(segment)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+        self._size -= offset
+
+    def close(self):
+        """Closes spool, so it can be opened again by a new process.
+
+        Read offsets are kept only in memory, so items that were already read
+        from partially read segments are removed from their files.
+        """
+        with self._lock:
+            self._close_writer()
+            for segment, offset in self._offsets.iteritems():
+                self._cut_read_items(segment, offset)
+            self._offsets = {}
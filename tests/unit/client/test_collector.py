@@ -2,6 +2,7 @@
 
 import collections
 import StringIO
+import threading
 import time
 
 import mock
@@ -29,9 +30,9 @@ class CollectorTestCase(test.TestCase):
         self.assertEqual(tasks, c.tasks)
         self.assertIsInstance(c.pusher, pusher.Pusher)
 
-    @mock.patch("netmet.client.collector.ping.Ping.ping")
+    @mock.patch("netmet.client.collector.ping.Ping.ping_async")
     def test_gen_periodic_ping_east_west(self, mock_ping):
-        client_host = mock.MagicMock()
+        client_host = {"host": "a", "ip": "2.2.2.2"}
         task = {
             "east-west": {
                 "dest": {
@@ -44,12 +45,13 @@ class CollectorTestCase(test.TestCase):
             }
         }
 
-        mock_ping.return_value = {
+        mock_ping.side_effect = lambda callback: callback({
             "ret_code": 0,
             "rtt": 10,
             "timestamp": "ttt",
-            "packet_size": 55
-        }
+            "packet_size": 55,
+            "dns_latency": 0
+        })
 
         c = collector.Collector("some_url", client_host, [])
         c.gen_periodic_ping(task)()
@@ -63,13 +65,14 @@ class CollectorTestCase(test.TestCase):
             "packet_size": 55,
             "lost": 0,
             "transmitted": 1,
-            "ret_code": 0
+            "ret_code": 0,
+            "dns_latency": 0
         }
-        self.assertEqual(expected, c.queue.pop()["east-west"])
+        self.assertEqual(expected, c.queue.pop().to_dict()["east-west"])
 
-    @mock.patch("netmet.client.collector.ping.Ping.ping")
+    @mock.patch("netmet.client.collector.ping.Ping.ping_async")
     def test_gen_periodic_ping_south_north(self, mock_ping):
-        client_host = mock.MagicMock()
+        client_host = {"host": "a", "ip": "2.2.2.2"}
         task = {
             "north-south": {
                 "dest": "1.1.1.1",
@@ -80,12 +83,13 @@ class CollectorTestCase(test.TestCase):
             }
         }
 
-        mock_ping.return_value = {
+        mock_ping.side_effect = lambda callback: callback({
             "ret_code": 0,
             "rtt": 10,
             "timestamp": "ttt",
-            "packet_size": 55
-        }
+            "packet_size": 55,
+            "dns_latency": 0
+        })
 
         c = collector.Collector("some_url", client_host, [])
         c.gen_periodic_ping(task)()
@@ -99,12 +103,64 @@ class CollectorTestCase(test.TestCase):
             "packet_size": 55,
             "lost": 0,
             "transmitted": 1,
-            "ret_code": 0
+            "ret_code": 0,
+            "dns_latency": 0
         }
-        self.assertEqual(expected, c.queue.pop()["north-south"])
+        self.assertEqual(expected, c.queue.pop().to_dict()["north-south"])
+
+    @mock.patch("netmet.client.collector.ping.Ping.ping_train")
+    def test_gen_periodic_ping_train(self, mock_ping_train):
+        client_host = {"host": "a", "ip": "2.2.2.2"}
+        task = {
+            "north-south": {
+                "dest": "1.1.1.1",
+                "settings": {
+                    "timeout": 5,
+                    "packet_size": 55,
+                    "count": 5,
+                    "interval": 0.05
+                }
+            }
+        }
+
+        mock_ping_train.side_effect = lambda c, i, callback: callback({
+            "ret_code": 0,
+            "rtt": 10,
+            "rtt_min": 8,
+            "rtt_max": 12,
+            "rtt_stddev": 1.5,
+            "jitter": 2,
+            "timestamp": "ttt",
+            "packet_size": 55,
+            "count": 5,
+            "received": 4,
+            "lost": 1,
+            "dns_latency": 5
+        })
+
+        c = collector.Collector("some_url", client_host, [])
+        c.gen_periodic_ping(task)()
+        mock_ping_train.assert_called_once_with(5, 0.05, mock.ANY)
+        expected = {
+            "client_src": client_host,
+            "dest": task["north-south"]["dest"],
+            "protocol": "icmp",
+            "timestamp": "ttt",
+            "latency": 10,
+            "latency_min": 8,
+            "latency_max": 12,
+            "latency_stddev": 1.5,
+            "jitter": 2,
+            "packet_size": 55,
+            "lost": 1,
+            "transmitted": 4,
+            "ret_code": 0,
+            "dns_latency": 5
+        }
+        self.assertEqual(expected, c.queue.pop().to_dict()["north-south"])
 
     @mock.patch("netmet.client.collector.LOG")
-    @mock.patch("netmet.client.collector.ping.Ping.ping")
+    @mock.patch("netmet.client.collector.ping.Ping.ping_async")
     def test_gen_periodic_ping_raises(self, mock_ping, mock_log):
         c = collector.Collector("some_url", {}, [])
         mock_ping.side_effect = Exception
@@ -117,12 +173,9 @@ class CollectorTestCase(test.TestCase):
         mock_log.exception.assert_called_once_with(c.pinger_failed_msg)
         self.assertEqual(1, mock_log.exception.call_count)
 
-    @mock.patch("netmet.client.collector.datetime")
-    @mock.patch("netmet.client.collector.monotonic.monotonic")
-    @mock.patch("netmet.client.collector.requests.get")
-    def test_gen_periodic_http_ping_east_west(self, mock_get, mock_monotonic,
-                                              mock_datetime):
-        client_host = mock.MagicMock()
+    @mock.patch("netmet.client.collector.httping.HTTPPing")
+    def test_gen_periodic_http_ping_east_west(self, mock_http_ping):
+        client_host = {"host": "a", "ip": "2.2.2.2"}
         task = {
             "east-west": {
                 "dest": {
@@ -132,18 +185,26 @@ class CollectorTestCase(test.TestCase):
                 },
                 "settings": {
                     "timeout": 5,
-                    "packet_size": 55
+                    "packet_size": 55,
+                    "keepalive": True
                 }
             }
         }
-
-        mock_datetime.datetime.now.return_value.isoformat.return_value = "aaa"
+        mock_http_ping.return_value.ping.return_value = {
+            "ret_code": 200,
+            "timestamp": "aaa",
+            "size": 10,
+            "dns_latency": 0,
+            "connect_latency": 1,
+            "ttfb_latency": 5,
+            "latency": 10
+        }
 
         c = collector.Collector("some_url", client_host, [task])
-        mock_monotonic.side_effect = [1, 2]
-        mock_get.return_value = mock.MagicMock(
-            content="Q" * 10, status_code=200)
         c.gen_periodic_http_ping(task)()
+        mock_http_ping.assert_called_once_with(
+            "http://1.2.3.4:80", timeout=5, keepalive=True,
+            pool=c.http_pool, resolver=c.resolver)
         self.assertEqual(1, len(c.queue))
 
         expected = {
@@ -151,21 +212,20 @@ class CollectorTestCase(test.TestCase):
             "client_dest": task["east-west"]["dest"],
             "protocol": "http",
             "timestamp": "aaa",
-            "latency": 1000,
+            "latency": 10,
+            "dns_latency": 0,
+            "connect_latency": 1,
+            "ttfb_latency": 5,
             "packet_size": 10,
             "lost": 0,
             "transmitted": 1,
             "ret_code": 200
         }
+        self.assertEqual(expected, c.queue.pop().to_dict()["east-west"])
 
-        self.assertEqual(expected, c.queue.pop()["east-west"])
-
-    @mock.patch("netmet.client.collector.datetime")
-    @mock.patch("netmet.client.collector.monotonic.monotonic")
-    @mock.patch("netmet.client.collector.requests.get")
-    def test_gen_periodic_http_ping_south_north(self, mock_get, mock_monotonic,
-                                                mock_datetime):
-        client_host = mock.MagicMock()
+    @mock.patch("netmet.client.collector.httping.HTTPPing.ping")
+    def test_gen_periodic_http_ping_south_north(self, mock_ping):
+        client_host = {"host": "a", "ip": "2.2.2.2"}
         task = {
             "north-south": {
                 "dest": "http://1.2.3.4",
@@ -175,13 +235,17 @@ class CollectorTestCase(test.TestCase):
                 }
             }
         }
-
-        mock_datetime.datetime.now.return_value.isoformat.return_value = "aaa"
+        mock_ping.return_value = {
+            "ret_code": 504,
+            "timestamp": "aaa",
+            "size": 0,
+            "dns_latency": 3,
+            "connect_latency": 0,
+            "ttfb_latency": None,
+            "latency": None
+        }
 
         c = collector.Collector("some_url", client_host, [task])
-        mock_monotonic.side_effect = [1, 2]
-        mock_get.return_value = mock.MagicMock(
-            content="Q" * 10, status_code=200)
         c.gen_periodic_http_ping(task)()
         self.assertEqual(1, len(c.queue))
 
@@ -190,20 +254,27 @@ class CollectorTestCase(test.TestCase):
             "dest": task["north-south"]["dest"],
             "protocol": "http",
             "timestamp": "aaa",
-            "latency": 1000,
-            "packet_size": 10,
-            "lost": 0,
-            "transmitted": 1,
-            "ret_code": 200
+            "latency": None,
+            "dns_latency": 3,
+            "connect_latency": 0,
+            "ttfb_latency": None,
+            "packet_size": 0,
+            "lost": 1,
+            "transmitted": 0,
+            "ret_code": 504
         }
+        self.assertEqual(expected, c.queue.pop().to_dict()["north-south"])
 
-        self.assertEqual(expected, c.queue.pop()["north-south"])
-
-    def test_gen_periodic_http_ping_requests_raises(self):
-        pass
-
-    def test_gen_periodic_http_ping_raises(self):
-        pass
+    @mock.patch("netmet.client.collector.LOG")
+    @mock.patch("netmet.client.collector.httping.HTTPPing.ping")
+    def test_gen_periodic_http_ping_raises(self, mock_ping, mock_log):
+        task = {"north-south": {"dest": "http://1.2.3.4",
+                                "settings": {"timeout": 5}}}
+        mock_ping.side_effect = Exception
+        c = collector.Collector("some_url", {}, [task])
+        c.gen_periodic_http_ping(task)()
+        self.assertEqual(0, len(c.queue))
+        self.assertEqual(1, mock_log.exception.call_count)
 
     @mock.patch("netmet.client.collector.pusher.Pusher.add")
     def test_process_results_with_pusher(self, mock_pusher_add):
@@ -222,6 +293,103 @@ class CollectorTestCase(test.TestCase):
         self.assertEqual("\n".join(str(i) for i in xrange(10)) + "\n",
                          mock_stdout.getvalue())
 
+    def test_gen_tasks(self):
+        tasks = [
+            {"north-south": {"protocol": "icmp", "dest": "1.1.1.1",
+                             "settings": {"period": 5}}},
+            {"north-south": {"protocol": "icmp", "dest": "1.1.1.1",
+                             "settings": {"period": 5, "count": 5}}},
+            {"east-west": {"protocol": "http", "settings": {"period": 10}}},
+            {"east-west": {"protocol": "udp", "settings": {"period": 10}}},
+            {"east-west": {"protocol": "icmp", "dest": {"ip": "2.2.2.2"},
+                           "settings": {"period": 5}}},
+            # hostname can be resolved synchronously
+            {"north-south": {"protocol": "icmp", "dest": "example.com",
+                             "settings": {"period": 5}}}
+        ]
+        c = collector.Collector(None, {}, tasks)
+        c.gen_periodic_ping = mock.MagicMock(
+            side_effect=["p1", "p2", "p3", "p4"])
+        c.gen_periodic_http_ping = mock.MagicMock(return_value="h1")
+        result = c._gen_tasks()
+        expected = [(5, "p1", True), (5, "p2", False), (10, "h1", False),
+                    (5, "p3", True), (5, "p4", False)]
+        self.assertEqual(expected, [r[:3] for r in result])
+        self.assertNotEqual(result[0][3], result[1][3])
+
+        c.gen_periodic_ping.side_effect = ["p1", "p2", "p3", "p4"]
+        self.assertEqual([r[3] for r in result],
+                         [r[3] for r in c._gen_tasks()])
+
+    @mock.patch("netmet.client.collector.Collector._job_threads")
+    @mock.patch("netmet.client.collector.Collector._job_events")
+    @mock.patch("netmet.client.collector.Collector._gen_tasks")
+    def test_job_backend(self, mock_gen_tasks, mock_job_events,
+                         mock_job_threads):
+        mock_gen_tasks.return_value = [(1, str, True)]
+        c = collector.Collector(None, {}, [])
+        c._job()
+        mock_job_threads.assert_called_once_with([(1, str, True)], c.death)
+
+        c.backend = "events"
+        c._job()
+        mock_job_events.assert_called_once_with([(1, str, True)], c.death)
+
+        mock_gen_tasks.return_value = []
+        c._job()
+        self.assertEqual(1, mock_job_events.call_count)
+        self.assertEqual(1, mock_job_threads.call_count)
+
+    def test_job_events(self):
+        c = collector.Collector(None, {}, [])
+        c.max_workers = 2
+        inline = mock.MagicMock()
+        pooled = mock.MagicMock()
+        blocking = threading.Event()
+
+        def block():
+            blocking.wait()
+
+        thread = threading.Thread(target=c._job_events, args=(
+            [(0.01, inline, True, 0), (0.01, pooled, False, 0.2),
+             (0.01, block, False, 0.4), (0.01, block, False, 0.6)],))
+        thread.start()
+        time.sleep(0.2)
+        c.death.set()
+        blocking.set()
+        thread.join()
+
+        self.assertGreater(inline.call_count, 10)
+        # workers are busy with block() and backlog is full, so most of
+        # pooled runs are skipped
+        self.assertLess(pooled.call_count, 10)
+        stats = c.stats()["scheduler"]
+        self.assertEqual(4, stats["tasks"])
+        self.assertGreater(stats["skipped"], 0)
+
+    def test_job_threads(self):
+        c = collector.Collector(None, {}, [])
+        calls = collections.Counter()
+
+        def gen(name):
+            def call():
+                calls[name] += 1
+            return call
+
+        thread = threading.Thread(target=c._job_threads, args=(
+            [(0.01, gen("a"), True, 0), (0.01, gen("b"), False, 0.5),
+             (0.02, gen("c"), False, 0)],))
+        thread.start()
+        time.sleep(0.2)
+        c.death.set()
+        thread.join()
+
+        self.assertEqual(2, len(c.schedulers))
+        self.assertGreater(calls["a"], 5)
+        self.assertGreater(calls["b"], 5)
+        self.assertGreater(calls["c"], 3)
+        self.assertEqual(3, c.stats()["scheduler"]["tasks"])
+
     @mock.patch("netmet.client.collector.Collector.gen_periodic_ping")
     @mock.patch("netmet.client.collector.Collector.gen_periodic_http_ping")
     def test_start_and_stop_no_pusher(self, mock_gen_ping, mock_gen_http_ping):
@@ -241,3 +409,60 @@ class CollectorTestCase(test.TestCase):
         c.start()
         time.sleep(0.05)
         c.stop()
+
+    @mock.patch("netmet.client.collector.pusher.Pusher")
+    def test_stop_processes_results_of_expired_probes(self, mock_pusher):
+        c = collector.Collector("netmet_url", {}, [])
+        c.engine = mock.MagicMock()
+        # probes in flight are reported as lost by engine.stop()
+        c.engine.stop.side_effect = lambda: c.queue.extend(["r1", "r2"])
+        c.start()
+        c.stop()
+        self.assertEqual([mock.call("r1"), mock.call("r2")],
+                         mock_pusher.return_value.add.call_args_list)
+        self.assertEqual(0, len(c.queue))
+
+    def test_metric_factory_hosts_not_grow(self):
+        c = collector.Collector(None, {"host": "a"}, [])
+
+        def tasks():
+            # each update of tasks brings new objects
+            return [{"east-west": {"dest": {"host": "b"}}},
+                    {"north-south": {"dest": "http://c"}}]
+
+        for i in xrange(3):
+            for task in tasks():
+                c._metric_factory(task)
+        self.assertEqual([{"host": "a"}, {"host": "b"}, "http://c"],
+                         c.hosts.hosts)
+
+    @mock.patch("netmet.client.collector.Collector.gen_periodic_ping")
+    @mock.patch("netmet.client.collector.Collector.gen_periodic_http_ping")
+    def test_update_tasks(self, mock_gen_ping, mock_gen_http_ping):
+        mock_gen_ping.return_value = str
+        mock_gen_http_ping.return_value = str
+        tasks = [{"north-south": {"dest": "a", "protocol": "icmp",
+                                  "settings": {"period": 1}}},
+                 {"north-south": {"dest": "b", "protocol": "http",
+                                  "settings": {"period": 1}}}]
+        c = collector.Collector(None, {}, [])
+        c.engine = mock.MagicMock()
+        c.update_tasks(tasks[:1])
+        self.assertEqual(tasks[:1], c.tasks)
+
+        c.start()
+        self.addCleanup(c.stop)
+        main_thread = c.main_thread
+        processing_thread = c.processing_thread
+        c.update_tasks(tasks)
+        self.assertEqual(tasks, c.tasks)
+        self.assertFalse(main_thread.is_alive())
+        self.assertTrue(c.main_thread.is_alive())
+        self.assertIs(processing_thread, c.processing_thread)
+        self.assertTrue(processing_thread.is_alive())
+        self.assertEqual(1, c.engine.start.call_count)
+        self.assertFalse(c.engine.stop.called)
+
+        c.stop()
+        self.assertFalse(c.main_thread.is_alive())
+        self.assertFalse(processing_thread.is_alive())
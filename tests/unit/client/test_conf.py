@@ -142,3 +142,8 @@ class ConfTestCase(test.TestCase):
         conf.restore_url_clear(500)
         mock_remove.assert_called_once_with(conf._RUNTIME_CONF_FILE % 500)
         self.assertEqual(1, mock_remove.call_count)
+
+    def test_spool_dir(self):
+        self.assertEqual(conf._RUNTIME_CONF_DIR + "spool_5000",
+                         conf.spool_dir(5000))
+        self.assertIsNone(conf.spool_dir(None))
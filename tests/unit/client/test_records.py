@@ -0,0 +1,79 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+
+from netmet.client import records
+from tests.unit import test
+
+
+class HostTableTestCase(test.TestCase):
+
+    def test_intern(self):
+        table = records.HostTable()
+        src = {"host": "a"}
+        dest = {"host": "b"}
+        self.assertEqual(0, table.intern(src))
+        self.assertEqual(1, table.intern(dest))
+        self.assertEqual(0, table.intern(src))
+        self.assertEqual(1, table.intern(dest))
+        self.assertEqual([src, dest], table.hosts)
+
+        self.assertEqual(0, table.intern({"host": "a"}))
+        self.assertEqual(1, table.intern({"host": "b"}))
+        self.assertEqual(2, table.intern({"host": "a", "ip": "1.1.1.1"}))
+        self.assertEqual(3, len(table.hosts))
+
+
+class MetricTestCase(test.TestCase):
+
+    def setUp(self):
+        super(MetricTestCase, self).setUp()
+        self.hosts = records.HostTable()
+        self.src = {"host": "a", "ip": "1.1.1.1"}
+        self.dest = {"host": "b", "ip": "2.2.2.2"}
+
+    def test_to_dict_east_west(self):
+        m = records.Metric(
+            self.hosts, "east-west", self.hosts.intern(self.src),
+            self.hosts.intern(self.dest), protocol="icmp", latency=None,
+            lost=1, transmitted=0, ret_code=1)
+
+        self.assertEqual({"east-west": {
+            "client_src": self.src,
+            "client_dest": self.dest,
+            "protocol": "icmp",
+            "latency": None,
+            "lost": 1,
+            "transmitted": 0,
+            "ret_code": 1
+        }}, m.to_dict())
+        self.assertEqual(repr(m.to_dict()), repr(m))
+
+    def test_to_dict_north_south(self):
+        m = records.Metric(
+            self.hosts, "north-south", self.hosts.intern(self.src),
+            self.hosts.intern("http://x"), protocol="http", latency=10,
+            ttfb_latency=5)
+
+        self.assertEqual({"north-south": {
+            "client_src": self.src,
+            "dest": "http://x",
+            "protocol": "http",
+            "latency": 10,
+            "ttfb_latency": 5
+        }}, m.to_dict())
+
+    def test_slots(self):
+        m = records.Metric(self.hosts, "east-west", 0, 0)
+        self.assertFalse(hasattr(m, "__dict__"))
+        self.assertRaises(AttributeError, setattr, m, "wrong", 1)
+
+    def test_json_default(self):
+        m = records.Metric(self.hosts, "north-south",
+                           self.hosts.intern(self.src),
+                           self.hosts.intern("1.2.3.4"), latency=1)
+        self.assertEqual(
+            [m.to_dict(), 1],
+            json.loads(json.dumps([m, 1], default=records.to_dict)))
+        self.assertRaises(TypeError, json.dumps, [object()],
+                          default=records.to_dict)
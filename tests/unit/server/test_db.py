@@ -1,5 +1,6 @@
 # Copyright 2017: GoDaddy Inc.
 
+import datetime
 import json
 
 import elasticsearch
@@ -40,7 +41,8 @@ class DBTestCase(test.TestCase):
         elastics = ["elastic"]
 
         melastic = mock_elastic.return_value
-        melastic.indices.exists.side_effect = [True, False, True]
+        melastic.indices.exists.side_effect = [True, False, True, True, True,
+                                               True]
         melastic.indices.create.side_effect = (
             elasticsearch.exceptions.ElasticsearchException)
 
@@ -60,6 +62,22 @@ class DBTestCase(test.TestCase):
         melastic.indices.rollover.assert_called_once_with(
             alias="netmet_data_v2", body=mock.ANY)
 
+        melastic.indices.put_mapping.assert_has_calls(
+            [
+                mock.call(index="netmet_data_v2", doc_type=doc_type,
+                          body=db.DB._DATA["mappings"][doc_type])
+                for doc_type in ["north-south", "east-west"]
+            ] + [
+                mock.call(index="netmet_catalog", doc_type=doc_type,
+                          body=db.DB._CATALOG["mappings"][doc_type])
+                for doc_type in ["clients", "config"]
+            ] + [
+                mock.call(index="netmet_rollup_1h", doc_type=doc_type,
+                          body=db.DB._ROLLUP["mappings"][doc_type])
+                for doc_type in ["east-west", "north-south", "checkpoint"]
+            ],
+            any_order=True)
+
         melastic.indices.exists_alias.assert_has_calls(
             [
                 mock.call(name="netmet_data_v2"),
@@ -73,21 +91,380 @@ class DBTestCase(test.TestCase):
         db.DB()._job()
         self.assertEqual(0, mock_rollover_data.call_count)
 
+    @mock.patch("netmet.server.db.DB._periodic_worker")
     @mock.patch("netmet.server.db.DB._rollover_data")
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
-    def test_job_inited(self, mock_elastic, mock_rollover_data):
+    def test_job_inited(self, mock_elastic, mock_rollover_data,
+                        mock_periodic_worker):
         db.DB.create("own_url", ["elastics"])
         self.assertEqual(1, mock_rollover_data.call_count)
         db.get()._job()
         self.assertEqual(2, mock_rollover_data.call_count)
 
+    @mock.patch("netmet.server.db.get")
+    @mock.patch("netmet.server.db.DB._rollup_data")
+    @mock.patch("netmet.server.db.DB._rollover_data")
+    def test_job_rollup(self, mock_rollover_data, mock_rollup_data,
+                        mock_get):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.own_url = "own_url"
+        mock_get.return_value = d
+        d._job()
+        self.assertFalse(mock_rollup_data.called)
+        d._inited = True
+        mock_rollover_data.side_effect = Exception
+        d._job()
+        mock_rollup_data.assert_called_once_with()
+
+    def test_floor(self):
+        dt = datetime.datetime(2017, 3, 4, 10, 25, 33, 1000)
+        self.assertEqual(datetime.datetime(2017, 3, 4, 10, 25),
+                         db._floor(dt, 60))
+        self.assertEqual(datetime.datetime(2017, 3, 4, 10),
+                         db._floor(dt, 3600))
+
+    def test_rollup_query(self):
+        q = db.DB()._rollup_query(
+            "north-south", datetime.datetime(2017, 1, 1, 10),
+            datetime.datetime(2017, 1, 1, 10, 1), 2, 5)
+        self.assertEqual(
+            {"gte": "2017-01-01T10:00:00", "lt": "2017-01-01T10:01:00"},
+            q["query"]["range"]["timestamp"])
+        aggs = q["aggs"]
+        for i, key in enumerate(db.DB._ROLLUP_KEYS["north-south"]):
+            self.assertEqual(key, aggs["k%s" % i]["terms"]["field"])
+            if i == 0:
+                self.assertEqual({"partition": 2, "num_partitions": 5},
+                                 aggs["k0"]["terms"]["include"])
+            else:
+                self.assertNotIn("include", aggs["k%s" % i]["terms"])
+            aggs = aggs["k%s" % i]["aggs"]
+        self.assertEqual(["latency", "lost", "percentiles", "transmitted"],
+                         sorted(aggs))
+
+    def _rollup_aggs(self):
+        leaf = {
+            "doc_count": 3,
+            "latency": {"min": 1, "max": 3, "avg": 2, "sum": 6, "count": 3},
+            "percentiles": {"values": {"50.0": 2, "90.0": 3, "99.0": 3}},
+            "lost": {"value": 1.0}, "transmitted": {"value": 3.0}
+        }
+
+        def terms(level, keys):
+            if level == 5:
+                return leaf
+            return {"k%s" % level: {"buckets": [
+                dict(terms(level + 1, keys), key=k) for k in keys[level]]}}
+
+        return terms(0, [["h1"], ["az1"], ["dc1"], ["d1", "d2"], ["icmp"]])
+
+    def test_rollup_docs(self):
+        docs = list(db.DB()._rollup_docs(
+            db.DB._ROLLUP_KEYS["north-south"], self._rollup_aggs(),
+            {"timestamp": "t"}))
+        self.assertEqual(2, len(docs))
+        self.assertEqual(
+            {"timestamp": "t", "client_src.host": "h1", "client_src.az": "az1",
+             "client_src.dc": "dc1", "dest": "d1", "protocol": "icmp",
+             "count": 3, "lost": 1, "transmitted": 3, "latency_min": 1,
+             "latency_max": 3, "latency_avg": 2, "latency_sum": 6,
+             "latency_count": 3, "latency_p50": 2, "latency_p90": 3,
+             "latency_p99": 3},
+            docs[0])
+        self.assertEqual("d2", docs[1]["dest"])
+
+    def test_rollup_period(self):
+        d = db.DB()
+        d.elastic = melastic = mock.MagicMock()
+        melastic.search.return_value = {"aggregations": self._rollup_aggs()}
+        melastic.bulk.return_value = {"errors": False}
+        start = datetime.datetime(2017, 1, 1, 10)
+        d._rollup_period("netmet_rollup_1m", "north-south", start,
+                         start + datetime.timedelta(minutes=1), 0, 1)
+
+        melastic.search.assert_called_once_with(
+            index="netmet_data_v2*", doc_type="north-south",
+            body=d._rollup_query(
+                "north-south", start, start + datetime.timedelta(minutes=1),
+                0, 1))
+        kwargs = melastic.bulk.call_args[1]
+        self.assertEqual("netmet_rollup_1m", kwargs["index"])
+        self.assertEqual("north-south", kwargs["doc_type"])
+        lines = map(json.loads, kwargs["body"].split("\n"))
+        self.assertEqual(4, len(lines))
+        self.assertNotEqual(lines[0]["index"]["_id"], lines[2]["index"]["_id"])
+        self.assertEqual(["d1", "d2"], [lines[1]["dest"], lines[3]["dest"]])
+
+        # the same rollup has the same ids
+        d._rollup_period("netmet_rollup_1m", "north-south", start,
+                         start + datetime.timedelta(minutes=1), 0, 1)
+        self.assertEqual(kwargs["body"], melastic.bulk.call_args[1]["body"])
+
+    @mock.patch("netmet.server.db.time.time", return_value=1000)
+    @mock.patch("netmet.server.db.DB._rollup_period")
+    @mock.patch("netmet.server.db.DB.clients_count")
+    @mock.patch("netmet.server.db.datetime")
+    def test_rollup_data(self, mock_dt, mock_clients_count,
+                         mock_rollup_period, mock_time):
+        mock_dt.datetime.now.return_value = datetime.datetime(
+            2017, 1, 1, 10, 5, 30)
+        mock_dt.datetime.strptime = datetime.datetime.strptime
+        mock_dt.timedelta = datetime.timedelta
+        mock_clients_count.return_value = 100
+        d = db.DB()
+        d.own_url = "own_url"
+        d.elastic = melastic = mock.MagicMock()
+        melastic.get.side_effect = [
+            {"found": True, "_version": 3,
+             "_source": {"timestamp": "2017-01-01T09:59:00"}},
+            {"found": False}
+        ]
+        melastic.index.side_effect = [{"_version": i} for i in xrange(4, 10)]
+        d._rollup_data()
+
+        # 1m: 09:59 - 10:02 (10:05:30 - 180 seconds), 1h: 09:00 - 10:00
+        # 2 * 100 * 100 buckets are split on 2 partitions
+        self.assertEqual(4 * 2 * 2, mock_rollup_period.call_count)
+        mock_rollup_period.assert_any_call(
+            "netmet_rollup_1m", "east-west", datetime.datetime(2017, 1, 1, 10),
+            datetime.datetime(2017, 1, 1, 10, 1), 1, 2)
+        mock_rollup_period.assert_any_call(
+            "netmet_rollup_1h", "north-south",
+            datetime.datetime(2017, 1, 1, 9),
+            datetime.datetime(2017, 1, 1, 10), 0, 2)
+        # lease is taken with the first checkpoint and released with last
+        lease = int((1000 + db.DB._ROLLUP_LEASE) * 1000)
+
+        def checkpoint(idx, t, lease_until, **kwargs):
+            return mock.call(
+                index="netmet_rollup_%s" % idx, doc_type="checkpoint",
+                id="checkpoint", body={"timestamp": "2017-01-01T%s:00" % t,
+                                       "owner": "own_url",
+                                       "lease_until": lease_until}, **kwargs)
+
+        self.assertEqual(
+            [checkpoint("1m", "09:59", lease, version=3),
+             checkpoint("1m", "10:00", lease, version=4),
+             checkpoint("1m", "10:01", lease, version=5),
+             checkpoint("1m", "10:02", 1000000, version=6),
+             checkpoint("1h", "09:00", lease, op_type="create"),
+             checkpoint("1h", "10:00", 1000000, version=8)],
+            melastic.index.call_args_list)
+
+    @mock.patch("netmet.server.db.LOG")
+    @mock.patch("netmet.server.db.time.time", return_value=1000)
+    @mock.patch("netmet.server.db.DB._rollup_period")
+    @mock.patch("netmet.server.db.DB.clients_count")
+    @mock.patch("netmet.server.db.datetime")
+    def test_rollup_data_leased(self, mock_dt, mock_clients_count,
+                                mock_rollup_period, mock_time, mock_log):
+        mock_dt.datetime.now.return_value = datetime.datetime(
+            2017, 1, 1, 10, 5, 30)
+        mock_dt.datetime.strptime = datetime.datetime.strptime
+        mock_dt.timedelta = datetime.timedelta
+        mock_clients_count.return_value = 1
+        d = db.DB()
+        d.own_url = "own_url"
+        d.elastic = melastic = mock.MagicMock()
+
+        # 1m is leased by other server, 1h lease of crashed server expired
+        melastic.get.side_effect = [
+            {"found": True, "_version": 3,
+             "_source": {"timestamp": "2017-01-01T09:59:00",
+                         "owner": "other", "lease_until": 1001000}},
+            {"found": True, "_version": 7,
+             "_source": {"timestamp": "2017-01-01T09:00:00",
+                         "owner": "other", "lease_until": 999000}}
+        ]
+        melastic.index.side_effect = [{"_version": 8}, {"_version": 9}]
+        d._rollup_data()
+        self.assertEqual(2, mock_rollup_period.call_count)
+        self.assertEqual(
+            ["netmet_rollup_1h"] * 2,
+            [c[0][0] for c in mock_rollup_period.call_args_list])
+        self.assertEqual([7, 8], [c[1]["version"]
+                                  for c in melastic.index.call_args_list])
+        self.assertIn("other", mock_log.info.call_args[0][0])
+
+        # other server takes the lease at the same time
+        melastic.get.side_effect = [
+            {"found": False},
+            {"found": True, "_version": 7,
+             "_source": {"timestamp": "2017-01-01T09:00:00"}}
+        ]
+        melastic.index.side_effect = elasticsearch.exceptions.ConflictError
+        d._rollup_data()
+        self.assertEqual(2, mock_rollup_period.call_count)
+        self.assertEqual(3, mock_log.info.call_count)
+
+    @mock.patch("netmet.server.db.DB._rollup_period")
+    @mock.patch("netmet.server.db.DB.clients_count")
+    def test_rollup_data_no_clients(self, mock_clients_count,
+                                    mock_rollup_period):
+        mock_clients_count.return_value = 0
+        db.DB()._rollup_data()
+        self.assertFalse(mock_rollup_period.called)
+
+    def test_matrix_query(self):
+        start = datetime.datetime(2017, 1, 1, 10)
+        q = db.DB()._matrix_query(start, "az", "east-west",
+                                  {"src_dc": "dc1", "protocol": "icmp"}, False)
+        self.assertEqual(
+            [{"range": {"timestamp": {"gte": "2017-01-01T10:00:00"}}},
+             {"term": {"protocol": "icmp"}},
+             {"term": {"client_src.dc": "dc1"}}],
+            q["query"]["bool"]["filter"])
+        src = q["aggs"]["src"]
+        self.assertEqual("client_src.az", src["terms"]["field"])
+        dest = src["aggs"]["dest"]
+        self.assertEqual("client_dest.az", dest["terms"]["field"])
+        self.assertEqual(["latency", "lost", "transmitted"],
+                         sorted(dest["aggs"]))
+
+        q = db.DB()._matrix_query(start, "host", "north-south",
+                                  {"dest_host": "d"}, True)
+        self.assertEqual({"term": {"dest": "d"}},
+                         q["query"]["bool"]["filter"][1])
+        dest = q["aggs"]["src"]["aggs"]["dest"]
+        self.assertEqual("dest", dest["terms"]["field"])
+        self.assertEqual(["count", "latency_count", "latency_max",
+                          "latency_min", "latency_sum", "lost", "transmitted"],
+                         sorted(dest["aggs"]))
+
+    def _matrix_response(self, cells):
+        return {"aggregations": {"src": {"buckets": [
+            {"key": "az1", "dest": {"buckets": cells}}]}}}
+
+    @mock.patch("netmet.server.db.datetime")
+    def test_metrics_matrix(self, mock_dt):
+        mock_dt.datetime.now.return_value = datetime.datetime(2017, 1, 2)
+        mock_dt.timedelta = datetime.timedelta
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = self._matrix_response([
+            {"key": "az2", "doc_count": 10,
+             "latency": {"avg": 2, "min": 1, "max": 3},
+             "lost": {"value": 1.0}, "transmitted": {"value": 10.0}},
+            {"key": "az3", "doc_count": 0,
+             "latency": {"avg": None, "min": None, "max": None},
+             "lost": {"value": 0}, "transmitted": {"value": 0}}
+        ])
+
+        expected = [
+            {"src": "az1", "dest": "az2", "count": 10, "lost": 1,
+             "transmitted": 10, "loss": 1 / 11.0, "latency_avg": 2,
+             "latency_min": 1, "latency_max": 3},
+            {"src": "az1", "dest": "az3", "count": 0, "lost": 0,
+             "transmitted": 0, "loss": None, "latency_avg": None,
+             "latency_min": None, "latency_max": None}
+        ]
+        expected = {"matrix": expected, "truncated": False}
+        self.assertEqual(expected, d.metrics_matrix(600))
+        self.assertEqual(expected, d.metrics_matrix(600))
+        d.elastic.search.assert_called_once_with(
+            index="netmet_data_v2*", doc_type="east-west",
+            body=d._matrix_query(datetime.datetime(2017, 1, 1, 23, 50), "az",
+                                 "east-west", {}, False))
+
+        d.metrics_matrix(600, filters={"protocol": "icmp"})
+        d.metrics_matrix(600, group_by="host")
+        self.assertEqual(3, d.elastic.search.call_count)
+
+    @mock.patch("netmet.server.db.LOG")
+    def test_metrics_matrix_truncated(self, mock_log):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        response = self._matrix_response([])
+        d.elastic.search.return_value = response
+        self.assertFalse(d.metrics_matrix(600)["truncated"])
+
+        response["aggregations"]["src"]["sum_other_doc_count"] = 5
+        self.assertTrue(d.metrics_matrix(601)["truncated"])
+
+        response["aggregations"]["src"]["sum_other_doc_count"] = 0
+        response["aggregations"]["src"]["buckets"][0]["dest"][
+            "sum_other_doc_count"] = 5
+        self.assertTrue(d.metrics_matrix(602)["truncated"])
+        self.assertEqual(2, mock_log.warning.call_count)
+
+    def test_matrix_cell_loss(self):
+        def loss(lost, transmitted):
+            bucket = {"key": "b", "doc_count": 1,
+                      "latency": {"avg": None, "min": None, "max": None},
+                      "lost": {"value": lost},
+                      "transmitted": {"value": transmitted}}
+            return db.DB()._matrix_cell("a", bucket, False)["loss"]
+
+        self.assertEqual(1.0, loss(1, 0))
+        self.assertEqual(0.5, loss(1, 1))
+        self.assertEqual(0.0, loss(0, 1))
+        self.assertIsNone(loss(0, 0))
+
+    def test_metrics_matrix_rollups(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = self._matrix_response([
+            {"key": "az2", "doc_count": 2, "count": {"value": 20.0},
+             "latency_sum": {"value": 30.0}, "latency_count": {"value": 15.0},
+             "latency_min": {"value": 1}, "latency_max": {"value": 4},
+             "lost": {"value": 5.0}, "transmitted": {"value": 20.0}}
+        ])
+        self.assertEqual(
+            [{"src": "az1", "dest": "az2", "count": 20, "lost": 5,
+              "transmitted": 20, "loss": 0.2, "latency_avg": 2,
+              "latency_min": 1, "latency_max": 4}],
+            d.metrics_matrix(3600)["matrix"])
+        d.metrics_matrix(86400 * 7)
+        self.assertEqual(
+            ["netmet_rollup_1m", "netmet_rollup_1h"],
+            [c[1]["index"] for c in d.elastic.search.call_args_list])
+
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
     def test_clients_get(self, mock_elastic):
         mock_elastic.return_value.search.return_value = {
             "hits": {"hits": [{"_source": {"a": 1}}, {"_source": {"a": 2}}]}
         }
         db.DB.create("a", ["b"])
-        self.assertEqual(db.get().clients_get(), [{"a": 1}, {"a": 2}])
+        self.assertEqual(list(db.get().clients_get()), [{"a": 1}, {"a": 2}])
+
+    def test_clients_get_pages(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        bodies = []
+
+        def search(**kwargs):
+            bodies.append(json.loads(json.dumps(kwargs["body"])))
+            pages = [
+                {"hits": {"hits": [{"_source": {"a.b": 1}, "sort": ["c#1"]},
+                                   {"_source": {"a.b": 2}, "sort": ["c#2"]}]}},
+                {"hits": {"hits": [{"_source": {"a.b": 3}, "sort": ["c#3"]}]}}
+            ]
+            return pages[len(bodies) - 1]
+
+        d.elastic.search.side_effect = search
+        clients = d.clients_get(page_size=2)
+        self.assertEqual({"a": {"b": 1}}, next(clients))
+        self.assertEqual(1, len(bodies))
+        self.assertEqual([{"a": {"b": 2}}, {"a": {"b": 3}}], list(clients))
+        self.assertEqual(
+            [{"size": 2, "sort": [{"_uid": "asc"}]},
+             {"size": 2, "sort": [{"_uid": "asc"}], "search_after": ["c#2"]}],
+            bodies)
+
+    def test_clients_get_empty(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = {}
+        self.assertEqual([], list(d.clients_get()))
+
+    def test_clients_count(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.count.return_value = {"count": 5}
+        self.assertEqual(5, d.clients_count())
+        d.elastic.count.assert_called_once_with(index="netmet_catalog",
+                                                doc_type="clients")
 
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
     def test_clients_set(self, mock_elastic):
@@ -104,8 +481,44 @@ class DBTestCase(test.TestCase):
             index="netmet_catalog", doc_type="clients", body=expected_body,
             refresh="true")
 
-    @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
-    def test_server_config_get(self, mock_elastic):
+    @mock.patch("netmet.server.db.LOG")
+    def test_clients_configured(self, mock_log):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.update_by_query.return_value = {"failures": []}
+        d.clients_configured(["a", "b", "c"], chunk_size=2)
+        d.clients_configured([], configured=False)
+
+        body = {
+            "query": {"terms": {"host": ["c"]}},
+            "script": {
+                "inline": "ctx._source.configured = params.configured",
+                "lang": "painless",
+                "params": {"configured": True}
+            }
+        }
+        self.assertEqual(2, d.elastic.update_by_query.call_count)
+        d.elastic.update_by_query.assert_called_with(
+            index="netmet_catalog", doc_type="clients", body=body,
+            conflicts="proceed", refresh="true")
+
+        d.clients_configured({"a": "x", "b": "y"})
+        body = d.elastic.update_by_query.call_args[1]["body"]
+        self.assertEqual(["a", "b"], sorted(body["query"]["terms"]["host"]))
+        self.assertEqual({"configured": True, "hashes": {"a": "x", "b": "y"}},
+                         body["script"]["params"])
+        self.assertIn("tasks_hash", body["script"]["inline"])
+        self.assertFalse(mock_log.error.called)
+
+        # e.g. strict mapping rejects field
+        d.elastic.update_by_query.return_value = {"failures": [
+            {"cause": {"type": "strict_dynamic_mapping_exception"}}]}
+        d.clients_configured({"a": "x", "b": "y"})
+        mock_log.error.assert_called_once_with(mock.ANY)
+        self.assertIn("strict_dynamic_mapping_exception",
+                      mock_log.error.call_args[0][0])
+
+    def test_server_config_get(self):
         config = {
             "config": json.dumps({"some": "stuff"}),
             "applied": True,
@@ -124,17 +537,109 @@ class DBTestCase(test.TestCase):
             "query": {"term": {"applied": True}}
         }
 
-        mock_elastic.return_value.search.side_effect = [
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.side_effect = [
             {"hits": {"hits": [{"_id": "id", "_source": config}]}},
             {"hits": {"hits": []}}
         ]
-        db.DB.create("a", ["b"])
         self.assertEqual(expected_result,
-                         db.get().server_config_get(only_applied=True))
-        mock_elastic.return_value.search.assert_called_once_with(
-            index="netmet_catalog", doc_type="config", body=query, size=1)
-
-        self.assertIsNone(db.get().server_config_get(only_applied=True))
+                         d.server_config_get(only_applied=True))
+        d.elastic.search.assert_called_once_with(
+            index="netmet_catalog", doc_type="config", body=query, size=1,
+            version=True)
+
+        self.assertIsNone(d.server_config_get(only_applied=True,
+                                              cached=False))
+
+    def test_server_config_get_cached(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = {"hits": {"hits": [
+            {"_id": "id", "_version": 1, "_source": {"config": "{}"}}]}}
+
+        config = d.server_config_get()
+        self.assertEqual({"id": "id", "config": {}}, config)
+        config["config"]["a"] = 1
+        self.assertEqual({"id": "id", "config": {}}, d.server_config_get())
+        self.assertEqual(1, d.elastic.search.call_count)
+
+        d.server_config_apply("id")
+        d.server_config_get()
+        self.assertEqual(2, d.elastic.search.call_count)
+
+    def test_catalog_cache_invalidated_by_new_version(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        config = {"_id": "id", "_version": 1, "_source": {"config": "{}"}}
+        d.elastic.search.side_effect = lambda **kw: (
+            {"hits": {"hits": [{"_source": {"a": 1}}]}}
+            if kw["doc_type"] == "clients" else {"hits": {"hits": [config]}})
+
+        d.server_config_get()
+        self.assertEqual([{"a": 1}], list(d.clients_get()))
+        self.assertEqual([{"a": 1}], list(d.clients_get()))
+        self.assertEqual(2, d.elastic.search.call_count)
+
+        d.server_config_get(cached=False)
+        list(d.clients_get())
+        self.assertEqual(3, d.elastic.search.call_count)
+
+        config["_version"] = 2
+        d.server_config_get(cached=False)
+        list(d.clients_get())
+        self.assertEqual(5, d.elastic.search.call_count)
+
+    def test_server_config_get_not_cached_if_changed(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        config = {"_id": "id", "_version": 1, "_source": {"config": "{}"}}
+
+        def search(**kwargs):
+            d.clients_set([])
+            return {"hits": {"hits": [config]}}
+
+        d.elastic.search.side_effect = search
+        d.server_config_get()
+        d.elastic.search.side_effect = None
+        d.elastic.search.return_value = {"hits": {"hits": [config]}}
+        d.server_config_get()
+        self.assertEqual(2, d.elastic.search.call_count)
+        d.server_config_get()
+        self.assertEqual(2, d.elastic.search.call_count)
+
+    def test_clients_view(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = {
+            "hits": {"hits": [{"_source": {"a": 1}}]}}
+        build = mock.MagicMock(side_effect=lambda clients: list(clients))
+
+        self.assertEqual([{"a": 1}], d.clients_view("view", build))
+        self.assertEqual([{"a": 1}], d.clients_view("view", build))
+        self.assertEqual(1, build.call_count)
+        self.assertEqual(1, d.elastic.search.call_count)
+
+        d.clients_set([])
+        d.clients_view("view", build)
+        self.assertEqual(2, build.call_count)
+
+    def test_clients_get_not_cached_if_changed(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = {
+            "hits": {"hits": [{"_source": {"a": 1}}]}}
+
+        clients = d.clients_get()
+        d.clients_set([])
+        list(clients)
+        list(d.clients_get())
+        self.assertEqual(2, d.elastic.search.call_count)
+
+        list(d.clients_get())
+        self.assertEqual(2, d.elastic.search.call_count)
+        list(d.clients_get(cached=False))
+        self.assertEqual(3, d.elastic.search.call_count)
 
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
     def test_server_config_add(self, mock_elastic):
@@ -173,20 +678,109 @@ class DBTestCase(test.TestCase):
 
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
     def test_metrics_add(self, mock_elastic):
-        mock_elastic.return_value.bulk.return_value = {
-            "items": [
-                {"index": {"status": 200}},
-                {"index": {"status": 200}},
-                {"index": {"status": 500}}
-            ]
-        }
+        mock_elastic.return_value.bulk.return_value = {"errors": False}
         db.DB.create("a", ["b"])
         doc = {"a": {"b": 1}, "c": 2}
-        expected_bulk = '{"index": {}}\n{"c": 2, "a.b": 1}'
-        self.assertEqual({200: 2, 500: 1},
-                         db.get().metrics_add("east-west", [doc]))
+        self.assertEqual({201: 1}, db.get().metrics_add("east-west", [doc]))
         mock_elastic.return_value.bulk.assert_called_once_with(
-            index="netmet_data_v2", doc_type="east-west", body=expected_bulk)
+            index="netmet_data_v2", body=mock.ANY,
+            filter_path=db.DB._BULK_FILTER)
+        body = mock_elastic.return_value.bulk.call_args[1]["body"]
+        self.assertEqual(
+            [{"index": {"_type": "east-west"}}, {"c": 2, "a.b": 1}],
+            map(json.loads, body.split("\n")))
+
+    def test_metrics_bulk_items(self):
+        items = db.DB.metrics_bulk_items("north-south",
+                                         [{"a": {"b": 1}, "c": 2}])
+        self.assertEqual(1, len(items))
+        self.assertEqual([{"index": {"_type": "north-south"}},
+                          {"c": 2, "a.b": 1}],
+                         map(json.loads, items[0].split("\n")))
+        self.assertRaises(ValueError, db.DB.metrics_bulk_items, "wrong", [])
+
+    @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
+    def test_metrics_bulk(self, mock_elastic):
+        mock_elastic.return_value.bulk.return_value = {"errors": False}
+        db.DB.create("a", ["b"])
+        self.assertEqual(({201: 2}, []),
+                         db.get().metrics_bulk(["a\nb", "c\nd"]))
+        mock_elastic.return_value.bulk.assert_called_once_with(
+            index="netmet_data_v2", body="a\nb\nc\nd",
+            filter_path=db.DB._BULK_FILTER)
+
+    @mock.patch("netmet.server.db.time.sleep")
+    @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
+    def test_metrics_bulk_retries(self, mock_elastic, mock_sleep):
+        error = {"type": "mapper_parsing_exception", "reason": "wrong"}
+        mock_elastic.return_value.bulk.side_effect = [
+            {"errors": True, "items": [
+                {"index": {"status": 201}},
+                {"index": {"status": 429, "error": {"type": "rejected"}}},
+                {"index": {"status": 400, "error": error}},
+                {"index": {"status": 503, "error": {"type": "unavailable"}}}
+            ]},
+            {"errors": False},
+            {"errors": True, "items": [
+                {"index": {"status": 429, "error": {"type": "rejected"}}},
+                {"index": {"status": 201}}
+            ]},
+            {"errors": True, "items": [
+                {"index": {"status": 201}},
+                {"index": {"status": 503}},
+                {"index": {"status": 201}}
+            ]}
+        ]
+        db.DB.create("a", ["b"])
+        self.assertEqual(({201: 2, 400: 1}, ["b\n"]),
+                         db.get().metrics_bulk(["a\n", "b\n", "c\n", "d\n"],
+                                               attempts=2))
+        self.assertEqual(1, mock_sleep.call_count)
+        self.assertTrue(0.25 <= mock_sleep.call_args[0][0] <= 0.5)
+
+        calls = mock_elastic.return_value.bulk.call_args_list
+        self.assertEqual(3, len(calls))
+        self.assertEqual("b\n\nd\n", calls[2][1]["body"])
+
+        self.assertEqual("netmet_dead_letters", calls[1][1]["index"])
+        letter = json.loads(calls[1][1]["body"].split("\n")[1])
+        self.assertEqual(400, letter["status"])
+        self.assertEqual("c\n", letter["item"])
+        self.assertEqual(error, json.loads(letter["error"]))
+
+        self.assertEqual(({201: 2}, ["b\n"]),
+                         db.get().metrics_bulk(["a\n", "b\n", "c\n"],
+                                               attempts=1))
+
+    @mock.patch("netmet.server.db.time.sleep")
+    def test_metrics_bulk_request_fails(self, mock_sleep):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.bulk.side_effect = [
+            {"errors": True, "items": [
+                {"index": {"status": 201}},
+                {"index": {"status": 429, "error": {"type": "rejected"}}}
+            ]},
+            elasticsearch.exceptions.ConnectionError("N/A", "timeout", None)
+        ]
+        # "a" is stored by the first attempt, so it's not returned
+        self.assertEqual(({201: 1}, ["b"]),
+                         d.metrics_bulk(["a", "b"], attempts=2))
+
+        d.elastic.bulk.side_effect = elasticsearch.exceptions.TransportError(
+            503, "unavailable")
+        self.assertEqual(({}, ["a", "b"]),
+                         d.metrics_bulk(["a", "b"], attempts=3))
+        self.assertEqual(3, d.elastic.bulk.call_count - 2)
+
+    @mock.patch("netmet.server.db.LOG")
+    def test_dead_letters_add_fails(self, mock_log):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.bulk.side_effect = (
+            elasticsearch.exceptions.ElasticsearchException)
+        d._dead_letters_add([("a", 400, None)])
+        self.assertEqual(1, mock_log.exception.call_count)
 
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
     def test_event_get(self, mock_elastic):
@@ -207,15 +801,15 @@ class DBTestCase(test.TestCase):
         mock_elastic.return_value.get.assert_called_once_with(
             index="netmet_events", doc_type="events", id="some_id2")
 
-    @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
-    def test_events_list(self, mock_elastic):
-        mock_elastic.return_value.search.return_value = {
+    def test_events_list(self):
+        d = db.DB()
+        d.elastic = mock.MagicMock()
+        d.elastic.search.return_value = {
             "hits": {"hits": [{"_source": {"a": 1}}, {"_source": {"b": 2}}]}
         }
 
-        db.DB.create("a", ["b"])
         self.assertEqual([{"a": 1}, {"b": 2}],
-                         db.get().events_list(10, 20, only_active=True))
+                         d.events_list(10, 20, only_active=True))
 
         expected_query = {
             "from": 10,
@@ -231,7 +825,7 @@ class DBTestCase(test.TestCase):
                 "filter": [{"range": {"started_at": {"lte": "now/m"}}}]
             }
         }
-        mock_elastic.return_value.search.assert_called_once_with(
+        d.elastic.search.assert_called_once_with(
             index="netmet_events", body=expected_query)
 
     @mock.patch("netmet.server.db.elasticsearch.Elasticsearch")
@@ -0,0 +1,91 @@
+# Copyright 2017: GoDaddy Inc.
+
+import time
+
+import mock
+
+from netmet.server import ingester
+from tests.unit import test
+
+
+class IngesterTestCase(test.TestCase):
+
+    def tearDown(self):
+        ingester.Ingester.destroy()
+        super(IngesterTestCase, self).tearDown()
+
+    def test_add(self):
+        i = ingester.Ingester()
+        self.assertTrue(i.add({"east-west": [{"a": 1}], "north-south": []}))
+        self.assertEqual(1, i.size())
+        self.assertEqual(len(i._queue[0]), i._queue_bytes)
+        self.assertRaises(ValueError, i.add, {"wrong": [{"a": 1}]})
+        self.assertEqual(1, i.size())
+
+    def test_add_full(self):
+        i = ingester.Ingester()
+        i.max_items = 3
+        self.assertTrue(i.add({"east-west": [{"a": 1}, {"a": 2}]}))
+        self.assertFalse(i.add({"east-west": [{"a": 3}, {"a": 4}]}))
+        self.assertTrue(i.add({"east-west": [{"a": 5}]}))
+        self.assertEqual(3, i.size())
+
+    @mock.patch("netmet.server.ingester.Ingester.force_update")
+    def test_add_forces_flush(self, mock_force_update):
+        i = ingester.Ingester()
+        i.bulk_size = 100
+        i.add({"east-west": [{"a": 1}]})
+        self.assertFalse(mock_force_update.called)
+        i.add({"east-west": [{"a": x} for x in xrange(5)]})
+        mock_force_update.assert_called_once_with()
+
+    @mock.patch("netmet.server.db.get")
+    def test_flush(self, mock_db_get):
+        mock_db_get.return_value.metrics_bulk.return_value = ({}, [])
+        i = ingester.Ingester()
+        i.bulk_size = 1
+        i.add({"east-west": [{"a": 1}, {"a": 2}], "north-south": [{"b": 1}]})
+        items = list(i._queue)
+        i._job()
+        self.assertEqual([mock.call([item]) for item in items],
+                         mock_db_get.return_value.metrics_bulk.call_args_list)
+        self.assertEqual(0, i.size())
+        self.assertEqual(0, i._queue_bytes)
+
+    @mock.patch("netmet.server.ingester.LOG")
+    @mock.patch("netmet.server.db.get")
+    def test_flush_fails(self, mock_db_get, mock_log):
+        mock_db_get.return_value.metrics_bulk.side_effect = [
+            ({}, []), Exception]
+        i = ingester.Ingester()
+        i.bulk_size = 80
+        i.add({"east-west": [{"a": x} for x in xrange(4)]})
+        items = list(i._queue)
+        i._job()
+        self.assertEqual(items[2:], list(i._queue))
+        self.assertEqual(sum(len(x) for x in items[2:]), i._queue_bytes)
+        self.assertEqual(1, mock_log.exception.call_count)
+
+    @mock.patch("netmet.server.ingester.LOG")
+    @mock.patch("netmet.server.db.get")
+    def test_flush_rejected(self, mock_db_get, mock_log):
+        i = ingester.Ingester()
+        i.add({"east-west": [{"a": x} for x in xrange(4)]})
+        items = list(i._queue)
+        mock_db_get.return_value.metrics_bulk.return_value = (
+            {201: 2}, items[1:3])
+        i._job()
+        self.assertEqual(items[1:3], list(i._queue))
+        self.assertEqual(sum(len(x) for x in items[1:3]), i._queue_bytes)
+        self.assertEqual(1, mock_log.warning.call_count)
+
+    @mock.patch("netmet.server.db.get")
+    def test_create_and_destroy(self, mock_db_get):
+        mock_db_get.return_value.metrics_bulk.return_value = ({}, [])
+        ingester.Ingester.create()
+        ingester.Ingester.get().add({"east-west": [{"a": 1}]})
+        time.sleep(0.2)
+        ingester.Ingester.get().add({"east-west": [{"a": 2}]})
+        ingester.Ingester.destroy()
+        self.assertIsNone(ingester.Ingester.get())
+        self.assertEqual(2, mock_db_get.return_value.metrics_bulk.call_count)
@@ -0,0 +1,182 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+
+import mock
+
+from netmet.server import main
+from netmet.utils import batch
+from tests.unit import test
+
+
+class ClientsListTestCase(test.TestCase):
+
+    def setUp(self):
+        super(ClientsListTestCase, self).setUp()
+        self.client = main.app.test_client()
+
+    @mock.patch("netmet.server.db.get")
+    def test_clients_list(self, mock_get):
+        mock_get.return_value.clients_get.return_value = iter(
+            [{"host": "a"}, {"host": "b"}])
+        r = self.client.get("/api/v1/clients")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([{"host": "a"}, {"host": "b"}], json.loads(r.data))
+
+        mock_get.return_value.clients_get.return_value = iter([])
+        self.assertEqual([], json.loads(
+            self.client.get("/api/v1/clients").data))
+
+    @mock.patch("netmet.server.main.LOG")
+    @mock.patch("netmet.server.db.get")
+    def test_clients_list_elastic_fails(self, mock_get, mock_log):
+        mock_get.return_value.clients_get.side_effect = Exception
+        self.assertEqual(500, self.client.get("/api/v1/clients").status_code)
+
+        def clients():
+            yield {"host": "a"}
+            raise ValueError("second page")
+
+        mock_get.return_value.clients_get.side_effect = None
+        mock_get.return_value.clients_get.return_value = clients()
+        r = self.client.get("/api/v1/clients")
+        # error is not hidden by truncated list, it aborts response
+        self.assertRaises(ValueError, r.get_data)
+        self.assertEqual(1, mock_log.exception.call_count)
+
+
+class MetricsAddTestCase(test.TestCase):
+
+    def setUp(self):
+        super(MetricsAddTestCase, self).setUp()
+        self.client = main.app.test_client()
+        config = mock.patch.dict("netmet.config._DATA",
+                                 {"hmac_skip_check": True})
+        config.start()
+        self.addCleanup(config.stop)
+        ingester = mock.patch("netmet.server.main.ingester.Ingester.get")
+        self.ingester = ingester.start().return_value
+        self.addCleanup(ingester.stop)
+        self.ingester.add.return_value = True
+        self.metrics = [{"east-west": {"latency": 1}},
+                        {"north-south": {"latency": 2}},
+                        {"wrong": {}}]
+
+    def test_metrics_add(self):
+        r = self.client.post("/api/v1/metrics",
+                             data=json.dumps(self.metrics))
+        self.assertEqual(201, r.status_code)
+        self.assertEqual({"message": "metrics are queued"},
+                         json.loads(r.data))
+        self.ingester.add.assert_called_once_with(
+            {"east-west": [{"latency": 1}], "north-south": [{"latency": 2}]})
+
+    def test_metrics_add_batch_gzip(self):
+        r = self.client.post(
+            "/api/v1/metrics",
+            data=batch.compress(batch.dumps(self.metrics)),
+            headers={"Content-Type": batch.CONTENT_TYPE,
+                     "Content-Encoding": "gzip"})
+        self.assertEqual(201, r.status_code)
+        self.ingester.add.assert_called_once_with(
+            {"east-west": [{"latency": 1}], "north-south": [{"latency": 2}]})
+
+    def test_metrics_add_gzip(self):
+        r = self.client.post(
+            "/api/v1/metrics",
+            data=batch.compress(json.dumps(self.metrics)),
+            headers={"Content-Encoding": "gzip"})
+        self.assertEqual(201, r.status_code)
+        self.assertEqual(1, self.ingester.add.call_count)
+
+    def test_metrics_add_unsupported_encoding(self):
+        r = self.client.post("/api/v1/metrics",
+                             data=json.dumps(self.metrics),
+                             headers={"Content-Encoding": "br"})
+        self.assertEqual(415, r.status_code)
+        self.assertEqual({"error": "Unsupported Content-Encoding: br"},
+                         json.loads(r.data))
+        self.assertFalse(self.ingester.add.called)
+
+    def test_metrics_add_bad_request(self):
+        for data in ["not json", json.dumps({"east-west": {}}),
+                     json.dumps([5]), json.dumps([{"east-west": 5}]),
+                     batch.compress("not json")]:
+            r = self.client.post("/api/v1/metrics", data=data)
+            self.assertEqual(400, r.status_code)
+
+        r = self.client.post("/api/v1/metrics", data="not gzip",
+                             headers={"Content-Encoding": "gzip"})
+        self.assertEqual(400, r.status_code)
+        self.assertFalse(self.ingester.add.called)
+
+    def test_metrics_add_queue_full(self):
+        self.ingester.add.return_value = False
+        r = self.client.post("/api/v1/metrics",
+                             data=json.dumps(self.metrics))
+        self.assertEqual(429, r.status_code)
+        self.assertEqual("5", r.headers["Retry-After"])
+
+
+class MetricsGetTestCase(test.TestCase):
+
+    def setUp(self):
+        super(MetricsGetTestCase, self).setUp()
+        self.client = main.app.test_client()
+
+    @mock.patch("netmet.server.db.get")
+    def test_metrics_get(self, mock_get):
+        matrix = [{"src": "az1", "dest": "az2", "loss": 0.5}]
+        mock_get.return_value.metrics_matrix.return_value = {
+            "matrix": matrix, "truncated": True}
+
+        r = self.client.get("/api/v1/metrics/15m")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({"period": "15m", "group_by": "az",
+                          "type": "east-west", "matrix": matrix,
+                          "truncated": True}, json.loads(r.data))
+        mock_get.return_value.metrics_matrix.assert_called_once_with(
+            900, group_by="az", doc_type="east-west", filters={})
+
+    @mock.patch("netmet.server.db.get")
+    def test_metrics_get_periods(self, mock_get):
+        mock_get.return_value.metrics_matrix.return_value = {
+            "matrix": [], "truncated": False}
+        for period, seconds in [("30s", 30), ("6h", 21600), ("7d", 604800)]:
+            r = self.client.get("/api/v1/metrics/%s" % period)
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(
+                seconds,
+                mock_get.return_value.metrics_matrix.call_args[0][0])
+
+    @mock.patch("netmet.server.db.get")
+    def test_metrics_get_wrong_period(self, mock_get):
+        for period in ["0m", "x", "2w", "m", "-1h"]:
+            r = self.client.get("/api/v1/metrics/%s" % period)
+            self.assertEqual(400, r.status_code)
+            self.assertEqual({"error": "Wrong period %s" % period},
+                             json.loads(r.data))
+        self.assertFalse(mock_get.return_value.metrics_matrix.called)
+
+    @mock.patch("netmet.server.db.get")
+    def test_metrics_get_group_by_and_filters(self, mock_get):
+        mock_get.return_value.metrics_matrix.return_value = {
+            "matrix": [], "truncated": False}
+        r = self.client.get("/api/v1/metrics/1h?group_by=host&"
+                            "type=north-south&src_az=az1&protocol=http&x=y")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual("host", json.loads(r.data)["group_by"])
+        mock_get.return_value.metrics_matrix.assert_called_once_with(
+            3600, group_by="host", doc_type="north-south",
+            filters={"src_az": "az1", "protocol": "http"})
+
+    @mock.patch("netmet.server.db.get")
+    def test_metrics_get_wrong_args(self, mock_get):
+        r = self.client.get("/api/v1/metrics/1h?group_by=rack")
+        self.assertEqual(400, r.status_code)
+        self.assertEqual({"error": "Wrong group_by rack"}, json.loads(r.data))
+
+        r = self.client.get("/api/v1/metrics/1h?type=up-down")
+        self.assertEqual(400, r.status_code)
+        self.assertEqual({"error": "Wrong type up-down"}, json.loads(r.data))
+        self.assertFalse(mock_get.return_value.metrics_matrix.called)
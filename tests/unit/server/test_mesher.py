@@ -1,5 +1,6 @@
 # Copyright 2017: GoDaddy Inc.
 
+import threading
 import time
 
 import mock
@@ -98,3 +99,122 @@ class MesherTestCase(test.TestCase):
         mesh._job()
         mock_log.info.assert_called_once_with(mesher.Mesher.new_config_msg)
         self.assertEqual(1, mock_log.info.call_count)
+        mock_clients_get.assert_called_once_with(cached=False)
+
+    @mock.patch("netmet.server.mesher.Mesher._post_config")
+    @mock.patch("netmet.server.mesher.eslock.Glock")
+    @mock.patch("netmet.server.db.get")
+    def test_refresh_client(self, mock_db_get, mock_glock, mock_post):
+        clients = [{k: i for k in self.keys} for i in xrange(5)]
+        external = [{"dest": "a", "protocol": "http", "period": 1,
+                     "timeout": 1}]
+        config = {"mesher": {"full_mesh": {}}, "external": external}
+        mock_db_get.return_value.server_config_get.return_value = {
+            "applied": True, "meshed": True, "config": config}
+        mock_db_get.return_value.clients_view.side_effect = (
+            lambda name, build: build(clients))
+        mock_post.return_value = (True, 200, "Client updated")
+
+        mesh = mesher.Mesher()
+        mesh.netmet_server_url = "some_url"
+        self.assertEqual((True, 200, "Client updated"),
+                         mesh.refresh_client(2, 2))
+        expected = list(mesher.FullMesh().mesh({}, clients, external))[2]
+        data = mesh._client_data(*expected)
+        mock_post.assert_called_once_with(clients[2], data)
+        mock_db_get.return_value.clients_configured.assert_called_once_with(
+            {2: mesh._tasks_hash(data)})
+
+        self.assertEqual((False, 404, "Client not found"),
+                         mesh.refresh_client(2, 3))
+        # host, ip and port change only with new config, that drops cache
+        self.assertFalse(mock_db_get.return_value.clients_get.called)
+        mock_db_get.return_value.clients_view.assert_called_with(
+            "mesher_clients", mesh._build_clients)
+
+    def _mesher(self):
+        config = mock.patch.dict("netmet.config._DATA",
+                                 {"hmac_keys": ["key"], "hmac_version": None})
+        config.start()
+        self.addCleanup(config.stop)
+        mesh = mesher.Mesher()
+        mesh.netmet_server_url = "some_url"
+        mesh._death = threading.Event()
+        mesh._session = mock.MagicMock()
+        mesh.push_backoff = 0
+        return mesh
+
+    def test_update_client_retries(self):
+        mesh = self._mesher()
+        mesh._session.post.side_effect = [
+            Exception("timeout"), mock.MagicMock(status_code=503),
+            mock.MagicMock(status_code=200)]
+
+        self.assertEqual((True, 200, "Client updated"),
+                         mesh._update_client({"host": "h", "port": 1}, []))
+        self.assertEqual(3, mesh._session.post.call_count)
+        mesh._session.post.assert_called_with(
+            "http://h:1/api/v2/config", data=mock.ANY, headers=mock.ANY,
+            timeout=mesh.push_timeout)
+
+    def test_update_client_fails(self):
+        mesh = self._mesher()
+        mesh._session.post.return_value = mock.MagicMock(status_code=503)
+        self.assertFalse(mesh._update_client({"host": "h", "port": 1}, [])[0])
+        self.assertEqual(3, mesh._session.post.call_count)
+
+        mesh._session.post.reset_mock()
+        mesh._session.post.return_value = mock.MagicMock(status_code=400)
+        self.assertFalse(mesh._update_client({"host": "h", "port": 1}, [])[0])
+        self.assertEqual(1, mesh._session.post.call_count)
+
+    def test_push(self):
+        mesh = self._mesher()
+        mesh.push_workers = 10
+
+        def post(url, **kwargs):
+            time.sleep(0.05)
+            return mock.MagicMock(status_code=500 if "h3:" in url else 200)
+
+        mesh._session.post.side_effect = post
+        clients = [({"host": "h%s" % i, "port": i}, []) for i in xrange(20)]
+
+        started_at = time.time()
+        configured, failed = mesh._push(iter(clients))
+        # serial push takes 22 * 0.05 seconds
+        self.assertLess(time.time() - started_at, 0.6)
+        self.assertEqual(["h%s" % i for i in xrange(20) if i != 3],
+                         sorted(configured, key=lambda h: int(h[1:])))
+        self.assertEqual(mesh._tasks_hash(mesh._client_data(*clients[0])),
+                         configured["h0"])
+        self.assertEqual(["h3"], failed)
+
+    def test_push_skips_not_changed(self):
+        mesh = self._mesher()
+        mesh._session.post.return_value = mock.MagicMock(status_code=201)
+        clients = [({"host": "h%s" % i, "port": i}, [i]) for i in xrange(3)]
+        hashes = {"h0": mesh._tasks_hash(mesh._client_data(*clients[0])),
+                  "h1": "old"}
+
+        configured, failed = mesh._push(clients, hashes)
+        self.assertEqual(["h1", "h2"], sorted(configured))
+        self.assertEqual([], failed)
+        self.assertEqual(2, mesh._session.post.call_count)
+        self.assertEqual(
+            set(["http://h1:1/api/v2/config", "http://h2:2/api/v2/config"]),
+            set(c[0][0] for c in mesh._session.post.call_args_list))
+
+    @mock.patch("netmet.server.db.get")
+    def test_clients_hashes(self, mock_db_get):
+        mock_db_get.return_value.clients_get.return_value = [
+            {"host": "a", "port": 1, "configured": True, "tasks_hash": "x"},
+            {"host": "b", "port": 2, "configured": False, "tasks_hash": "y"},
+            {"host": "c", "port": 3, "configured": True}
+        ]
+        clients, index, hashes = mesher.Mesher()._clients(cached=False)
+        self.assertEqual([{"host": "a", "port": 1}, {"host": "b", "port": 2},
+                          {"host": "c", "port": 3}], clients)
+        self.assertIs(clients[1], index[("b", 2)])
+        self.assertEqual({"a": "x"}, hashes)
+        mock_db_get.return_value.clients_get.assert_called_once_with(
+            cached=False)
@@ -0,0 +1,46 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+
+import morph
+
+from netmet.server.utils import bulk
+from tests.unit import test
+
+
+class BulkTestCase(test.TestCase):
+
+    def test_encode(self):
+        for value in ["a", u"\u0444\"", 1, 10 ** 20, 0.1, 1e16, True, False,
+                      None, float("nan"), float("inf"), [1, "a"]]:
+            self.assertEqual(json.dumps(value), bulk._encode(value))
+
+    def test_item(self):
+        src = {"host": "h1", "ip": "1.1.1.1", "port": 80, "az": "a"}
+        dest = {"host": "h2", "ip": "1.1.1.2", "port": 80, "az": "b"}
+        metric = {"client_src": src, "client_dest": dest, "latency": 0.5,
+                  "protocol": "icmp", "lost": 0, "events": ["e1"],
+                  "empty": {}, "empty_list": []}
+        s = bulk.Serializer("east-west")
+        action, doc = s.item(metric).split("\n")
+        self.assertEqual({"index": {"_type": "east-west"}}, json.loads(action))
+        self.assertEqual(morph.flatten(metric), json.loads(doc))
+
+    def test_items_share_hosts(self):
+        src = {"host": "h1", "location": {"dc": "dc1"}}
+        s = bulk.Serializer("north-south")
+        items = s.items([{"client_src": src, "dest": "d%s" % i}
+                         for i in xrange(3)])
+        self.assertEqual(1, len(s._hosts))
+        for i, item in enumerate(items):
+            self.assertEqual(
+                {"client_src.host": "h1", "client_src.location.dc": "dc1",
+                 "dest": "d%s" % i},
+                json.loads(item.split("\n")[1]))
+
+    def test_items_same_host_src_and_dest(self):
+        host = {"host": "h1"}
+        s = bulk.Serializer("east-west")
+        item = s.item({"client_src": host, "client_dest": host})
+        self.assertEqual({"client_src.host": "h1", "client_dest.host": "h1"},
+                         json.loads(item.split("\n")[1]))
@@ -0,0 +1,17 @@
+# Copyright 2017: GoDaddy Inc.
+
+from netmet import config
+from tests.unit import test
+
+
+class ConfigTestCase(test.TestCase):
+
+    def test_set_and_get(self):
+        config.set("some_key", 42)
+        self.assertEqual(42, config.get("some_key"))
+        self.assertEqual(42, config.get("some_key", 10))
+
+    def test_get_missing(self):
+        self.assertRaises(KeyError, config.get, "missing_key")
+        self.assertEqual(10, config.get("missing_key", 10))
+        self.assertIsNone(config.get("missing_key", None))
@@ -5,6 +5,7 @@ import os
 from gevent import wsgi
 import mock
 
+from netmet import config
 from netmet import run
 from tests.unit import test
 
@@ -66,10 +67,54 @@ class RunTestCase(test.TestCase):
         self.assertEqual("1.2.3.4", http_server.server_host)
         self.assertEqual(80, http_server.server_port)
 
+    @mock.patch.dict(os.environ, {
+        "APP": "client", "NETMET_HMAC_SKIP": "True",
+        "NETMET_COLLECTOR_BACKEND": "events",
+        "NETMET_COLLECTOR_WORKERS": "10",
+        "NETMET_COLLECTOR_SCHEDULE_POLICY": "catch-up",
+        "NETMET_PUSHER_DRAIN_RATE": "500"})
+    @mock.patch("netmet.client.main.load")
+    def test_load_collector_backend(self, mock_load):
+        run.load()
+        self.assertEqual("events", config.get("collector_backend"))
+        self.assertEqual(10, config.get("collector_workers"))
+        self.assertEqual("catch-up", config.get("collector_schedule_policy"))
+        self.assertEqual(500, config.get("pusher_drain_rate"))
+
+    @mock.patch.dict(os.environ, {
+        "APP": "client", "NETMET_HMAC_SKIP": "True",
+        "NETMET_COLLECTOR_SCHEDULE_POLICY": "wrong"})
+    @mock.patch("netmet.client.main.load")
+    def test_load_wrong_schedule_policy(self, mock_load):
+        self.assertRaises(ValueError, run.load)
+
+    @mock.patch.dict(os.environ, {
+        "APP": "client", "NETMET_HMAC_SKIP": "True",
+        "NETMET_COLLECTOR_BACKEND": "asyncio"})
+    @mock.patch("netmet.client.main.load")
+    def test_load_wrong_collector_backend(self, mock_load):
+        self.assertRaises(ValueError, run.load)
+
+    @mock.patch.dict(os.environ, {
+        "APP": "client", "NETMET_HMAC_SKIP": "True",
+        "NETMET_HMAC_VERSION": "1"})
+    @mock.patch("netmet.client.main.load")
+    def test_load_hmac_version(self, mock_load):
+        run.load()
+        self.assertEqual(1, config.get("hmac_version"))
+
+    @mock.patch.dict(os.environ, {
+        "APP": "client", "NETMET_HMAC_SKIP": "True",
+        "NETMET_HMAC_VERSION": "3"})
+    @mock.patch("netmet.client.main.load")
+    def test_load_wrong_hmac_version(self, mock_load):
+        self.assertRaises(ValueError, run.load)
+
     @mock.patch.dict(os.environ, {"APP": "client", "NETMET_HMAC_SKIP": "True"})
     @mock.patch("netmet.run.wsgi.WSGIServer.serve_forever")
     @mock.patch("netmet.client.main.load")
     def test_run(self, mock_load, mock_serve_forever):
         run.run()
+        self.assertIsNone(config.get("hmac_version"))
         self.assertEqual(mock_serve_forever.call_count, 1)
         mock_serve_forever.assert_called_once_with()
@@ -0,0 +1,64 @@
+# Copyright 2017: GoDaddy Inc.
+
+import json
+
+from netmet.client import records
+from netmet.utils import batch
+from tests.unit import test
+
+
+class BatchTestCase(test.TestCase):
+
+    def test_document(self):
+        self.assertEqual(
+            {"north-south": {"client_src": "a", "dest": "b", "latency": 1}},
+            batch.document("north-south", "a", "b", {"latency": 1}))
+        self.assertEqual(
+            {"east-west": {"client_src": "a", "client_dest": "b"}},
+            batch.document("east-west", "a", "b", {}))
+
+    def test_dumps_loads(self):
+        hosts = records.HostTable()
+        src = {"host": "a", "az": "az1"}
+        dests = [{"host": "b"}, {"host": "c"}]
+        metrics = [
+            records.Metric(hosts, "east-west", hosts.intern(src),
+                           hosts.intern(dests[i % 2]), latency=i)
+            for i in xrange(4)
+        ]
+        objects = metrics + [{"north-south": {"dest": "x"}}]
+
+        data = batch.dumps(objects)
+        self.assertEqual([src] + dests, json.loads(data)["hosts"])
+        self.assertEqual([m.to_dict() for m in metrics] +
+                         [{"north-south": {"dest": "x"}}],
+                         batch.loads(data))
+
+    def test_dumps_default(self):
+        self.assertEqual([{"a": [10]}], batch.loads(
+            batch.dumps([set([10])], default=lambda x: {"a": list(x)})))
+
+    def test_loads_invalid(self):
+        self.assertRaises(ValueError, batch.loads, "[]")
+        self.assertRaises(ValueError, batch.loads, "not json")
+        self.assertRaises(ValueError, batch.loads,
+                          json.dumps({"hosts": [], "metrics": [
+                              ["east-west", 0, 1, {}]]}))
+        self.assertRaises(ValueError, batch.loads,
+                          json.dumps({"hosts": ["a"], "metrics": [
+                              ["east-west", 0, 0, []]]}))
+        self.assertRaises(ValueError, batch.loads,
+                          json.dumps({"hosts": ["a"], "metrics": [
+                              ["east-west", 0]]}))
+
+    def test_compress_decompress(self):
+        data = json.dumps(range(1000))
+        compressed = batch.compress(data)
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual("\x1f\x8b", compressed[:2])
+        self.assertEqual(data, batch.decompress(compressed))
+
+    def test_decompress_invalid(self):
+        self.assertRaises(ValueError, batch.decompress, "not gzip")
+        self.assertRaises(ValueError, batch.decompress,
+                          batch.compress("a" * 1000), max_size=100)
@@ -0,0 +1,200 @@
+# Copyright 2017: GoDaddy Inc.
+
+import BaseHTTPServer
+import socket
+import threading
+
+import mock
+
+from netmet.utils import httping
+from tests.unit import test
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith("/redirect/"):
+            # /redirect/N redirects N times before /check
+            left = int(self.path.split("/")[2]) - 1
+            self.send_response(302)
+            self.send_header("Location", "/redirect/%s" % left
+                             if left else "/check")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = "Q" * 100000
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(BaseHTTPServer.HTTPServer):
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.paths = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        thread = threading.Thread(
+            target=BaseHTTPServer.HTTPServer.process_request,
+            args=(self, request, client_address))
+        thread.daemon = True
+        thread.start()
+
+
+class ConnectionPoolTestCase(test.TestCase):
+
+    def test_get_put(self):
+        pool = httping.ConnectionPool(max_size=2)
+        self.assertIsNone(pool.get("a"))
+        conns = [mock.MagicMock() for i in xrange(3)]
+        for conn in conns:
+            pool.put("a", conn)
+
+        conns[2].close.assert_called_once_with()
+        self.assertIs(conns[1], pool.get("a"))
+        self.assertIs(conns[0], pool.get("a"))
+        self.assertIsNone(pool.get("a"))
+        self.assertIsNone(pool.get("b"))
+
+    def test_close(self):
+        pool = httping.ConnectionPool()
+        conns = [mock.MagicMock(), mock.MagicMock()]
+        pool.put("a", conns[0])
+        pool.put("b", conns[1])
+        pool.close()
+        for conn in conns:
+            conn.close.assert_called_once_with()
+        self.assertIsNone(pool.get("a"))
+
+
+class HTTPPingTestCase(test.TestCase):
+
+    def setUp(self):
+        super(HTTPPingTestCase, self).setUp()
+        self.server = _Server()
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={"poll_interval": 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(HTTPPingTestCase, self).tearDown()
+
+    def test_init(self):
+        p = httping.HTTPPing("https://host/a?b=1", timeout=3)
+        self.assertTrue(p.https)
+        self.assertTrue(p.valid)
+        self.assertEqual("host", p.host)
+        self.assertEqual(443, p.port)
+        self.assertEqual("/a?b=1", p.path)
+        self.assertEqual(3, p.timeout)
+        self.assertFalse(p.keepalive)
+
+    def test_ping(self):
+        p = httping.HTTPPing(self.url + "/check")
+        for i in xrange(2):
+            result = p.ping()
+            self.assertEqual(200, result["ret_code"])
+            self.assertEqual(100000, result["size"])
+            self.assertGreater(result["connect_latency"], 0)
+            self.assertGreaterEqual(result["ttfb_latency"],
+                                    result["connect_latency"])
+            self.assertGreaterEqual(result["latency"],
+                                    result["ttfb_latency"])
+
+        self.assertEqual(["/check", "/check"], self.server.paths)
+        self.assertEqual(2, self.server.connections)
+        self.assertIsNone(p.pool.get((False, "127.0.0.1",
+                                      p.port, "127.0.0.1")))
+
+    def test_ping_keepalive(self):
+        p = httping.HTTPPing(self.url, keepalive=True)
+        first, second = p.ping(), p.ping()
+        self.assertEqual(200, first["ret_code"])
+        self.assertEqual(200, second["ret_code"])
+        self.assertGreater(first["connect_latency"], 0)
+        self.assertEqual(0, second["connect_latency"])
+        self.assertEqual(1, self.server.connections)
+
+    def test_ping_keepalive_stale_connection(self):
+        p = httping.HTTPPing(self.url, keepalive=True)
+        stale = mock.MagicMock()
+        stale.request.side_effect = socket.error
+        p.pool.put((False, "127.0.0.1", p.port, "127.0.0.1"), stale)
+
+        result = p.ping()
+        self.assertEqual(200, result["ret_code"])
+        stale.close.assert_called_once_with()
+        self.assertEqual(1, self.server.connections)
+
+    def test_ping_with_resolver(self):
+        resolver = mock.MagicMock()
+        resolver.resolve.return_value = ("127.0.0.1", 12)
+        p = httping.HTTPPing(
+            "http://host:%s" % self.server.server_address[1],
+            resolver=resolver)
+
+        result = p.ping()
+        resolver.resolve.assert_called_once_with("host")
+        self.assertEqual(200, result["ret_code"])
+        self.assertEqual(12, result["dns_latency"])
+
+    def test_ping_host_not_found(self):
+        resolver = mock.MagicMock()
+        resolver.resolve.return_value = (None, 12)
+        result = httping.HTTPPing("http://host", resolver=resolver).ping()
+        self.assertEqual(httping.FAILED_CODE, result["ret_code"])
+        self.assertEqual(12, result["dns_latency"])
+        self.assertIsNone(result["latency"])
+
+    def test_ping_wrong_url(self):
+        resolver = mock.MagicMock()
+        for url in ["example.com", "ftp://host/a", "http://", "http://h:x"]:
+            p = httping.HTTPPing(url, resolver=resolver)
+            self.assertFalse(p.valid)
+            result = p.ping()
+            self.assertEqual(httping.FAILED_CODE, result["ret_code"])
+            self.assertEqual(url, result["dest"])
+            self.assertIsNone(result["latency"])
+        self.assertFalse(resolver.resolve.called)
+
+    def test_ping_connection_refused(self):
+        self.server.shutdown()
+        self.server.server_close()
+        result = httping.HTTPPing(self.url).ping()
+        self.assertEqual(httping.FAILED_CODE, result["ret_code"])
+        self.assertIsNone(result["ttfb_latency"])
+        self.assertIsNone(result["latency"])
+
+    def test_ping_redirect(self):
+        p = httping.HTTPPing(self.url + "/redirect/2", keepalive=True)
+        result = p.ping()
+        self.assertEqual(200, result["ret_code"])
+        self.assertEqual(100000, result["size"])
+        self.assertEqual(self.url + "/redirect/2", result["dest"])
+        self.assertGreaterEqual(result["latency"], result["ttfb_latency"])
+        self.assertNotIn("location", result)
+        self.assertEqual(["/redirect/2", "/redirect/1", "/check"],
+                         self.server.paths)
+        self.assertEqual(1, self.server.connections)
+
+    def test_ping_too_many_redirects(self):
+        p = httping.HTTPPing(self.url + "/redirect/3")
+        p.max_redirects = 2
+        result = p.ping()
+        self.assertEqual(302, result["ret_code"])
+        self.assertEqual(["/redirect/3", "/redirect/2", "/redirect/1"],
+                         self.server.paths)
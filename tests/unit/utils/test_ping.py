@@ -1,5 +1,6 @@
 # Copyright 2017: GoDaddy Inc.
 
+import errno
 import socket
 import struct
 
@@ -73,11 +74,43 @@ class PingTestCase(test.TestCase):
         self.assertEqual(20, id_)
         self.assertEqual(1, seq)
 
+    def _legacy_create_packet(self, packet_size, packet_id, sequence):
+        src = struct.pack("bbHHh", 8, 0, 0, packet_id, sequence)
+        src += packet_size * "Q"
+        checksum = 0
+        count_to = len(src) & -2
+        for count in xrange(0, count_to, 2):
+            checksum += ord(src[count + 1]) * 256 + ord(src[count])
+        if count_to < len(src):
+            checksum += ord(src[len(src) - 1])
+        checksum = (checksum >> 16) + (checksum & 0xffff)
+        checksum += checksum >> 16
+        answer = ~checksum & 0xffff
+        answer = answer >> 8 | (answer << 8 & 0xff00)
+        return struct.pack("bbHHh", 8, 0, socket.htons(answer),
+                           packet_id, sequence) + packet_size * "Q"
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_create_packet_checksum(self, mock_socket):
+        for packet_size in [0, 1, 55, 56, 1000]:
+            p = ping.Ping("127.0.0.1", packet_size=packet_size)
+            for packet_id in [0, 1, 255, 256, 10000, 65535]:
+                for sequence in [1, 2, 300]:
+                    packet = p._create_packet(packet_id, sequence)
+                    self.assertEqual(
+                        self._legacy_create_packet(packet_size, packet_id,
+                                                   sequence), packet)
+                    # Checksum of packet with valid checksum is zero
+                    self.assertEqual(0, ping._fold(ping._sum16(packet)))
+
+        self.assertIn(1000, ping._TEMPLATES)
+
     @mock.patch("netmet.utils.ping.socket")
     @mock.patch("netmet.utils.ping.select")
     @mock.patch("netmet.utils.ping.monotonic.monotonic")
     def test_handle_response(self, mock_monotonic, mock_select, mock_socket):
         p = ping.Ping("127.0.0.1")
+        p.raw = True
         id_ = 10
         resp = "_" * 20   # NOTE(boris-42) We don't check header
         # NOTE(boris-42) Check checksum (fix me please)
@@ -88,6 +121,20 @@ class PingTestCase(test.TestCase):
         mock_monotonic.side_effect = [0.1, 0.2, 0.25]
         self.assertEqual(150.0, p._response_handler(id_, 0.1))
 
+    @mock.patch("netmet.utils.ping.socket")
+    @mock.patch("netmet.utils.ping.select")
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_handle_response_dgram(self, mock_monotonic, mock_select,
+                                   mock_socket):
+        p = ping.Ping("127.0.0.1")
+        p.raw = False
+        # Kernel replaces id of ping socket packets
+        resp = struct.pack("bbHHh", 0, 0, 1, 777, 1) + "Q" * p.packet_size
+
+        p.sock.recvfrom.return_value = (resp, "addr")
+        mock_monotonic.side_effect = [0.1, 0.2, 0.25]
+        self.assertEqual(150.0, p._response_handler(10, 0.1))
+
     @mock.patch("netmet.utils.ping.socket")
     @mock.patch("netmet.utils.ping.select")
     @mock.patch("netmet.utils.ping.monotonic.monotonic")
@@ -96,3 +143,421 @@ class PingTestCase(test.TestCase):
         p = ping.Ping("127.0.0.1")
         mock_monotonic.side_effect = [2]
         self.assertEqual(None, p._response_handler(10, 0.1))
+
+    @mock.patch("netmet.utils.ping.socket")
+    def test_init_with_engine(self, mock_socket):
+        mock_socket.inet_pton.return_value = "1.1.1.1"
+        engine = ping.Engine()
+        p = ping.Ping("1.1.1.1", engine=engine)
+        self.assertEqual(0, p.ret_code)
+        self.assertEqual("1.1.1.1", p.dest_ip)
+        self.assertIsNone(p.sock)
+        self.assertIs(engine, p.engine)
+        self.assertFalse(mock_socket.socket.called)
+
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_with_engine(self, mock_socket):
+        engine = mock.MagicMock(ret_code=0)
+        engine.next_id.return_value = 42
+        engine.ping.return_value = 12.5
+        p = ping.Ping("1.1.1.1", engine=engine)
+        result = p.ping()
+        self.assertEqual(ping.EXIT_STATUS.SUCCESS, result["ret_code"])
+        self.assertEqual(12.5, result["rtt"])
+        engine.ping.assert_called_once_with(
+            "1.1.1.1", p._create_packet(42), 42, 1, 1)
+
+    def test_ping_with_resolver(self):
+        engine = mock.MagicMock(ret_code=0)
+        engine.ping.return_value = 12.5
+        resolver = mock.MagicMock()
+        resolver.resolve.side_effect = [("1.1.1.1", 20), ("2.2.2.2", 0)]
+        p = ping.Ping("host", engine=engine, resolver=resolver)
+        self.assertEqual("1.1.1.1", p.dest_ip)
+        self.assertEqual(20, p.dns_latency)
+
+        result = p.ping()
+        self.assertEqual("2.2.2.2", result["dest"])
+        self.assertEqual(0, result["dns_latency"])
+        self.assertEqual("2.2.2.2", engine.ping.call_args[0][0])
+
+    def test_ping_with_resolver_not_found(self):
+        engine = mock.MagicMock(ret_code=0)
+        resolver = mock.MagicMock()
+        resolver.resolve.side_effect = [("1.1.1.1", 0), (None, 0)]
+        p = ping.Ping("host", engine=engine, resolver=resolver)
+
+        result = p.ping()
+        self.assertEqual(ping.EXIT_STATUS.ERROR_HOST_NOT_FOUND,
+                         result["ret_code"])
+        self.assertFalse(engine.ping.called)
+
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_with_engine_timeout(self, mock_socket):
+        engine = mock.MagicMock(ret_code=0)
+        engine.ping.return_value = None
+        p = ping.Ping("1.1.1.1", engine=engine)
+        self.assertEqual(ping.EXIT_STATUS.ERROR_TIMEOUT,
+                         p.ping()["ret_code"])
+
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_async_with_engine(self, mock_socket):
+        engine = mock.MagicMock(ret_code=0)
+        engine.next_id.return_value = 42
+        engine.send.side_effect = lambda *args: args[-1](12.5)
+        callback = mock.Mock()
+        p = ping.Ping("1.1.1.1", engine=engine)
+        p.ping_async(callback)
+
+        engine.send.assert_called_once_with(
+            "1.1.1.1", p._create_packet(42), 42, 1, 1, mock.ANY)
+        result = callback.call_args[0][0]
+        self.assertEqual(ping.EXIT_STATUS.SUCCESS, result["ret_code"])
+        self.assertEqual(12.5, result["rtt"])
+
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_async_with_engine_socket_error(self, mock_socket):
+        mock_socket.error = socket.error
+        engine = mock.MagicMock(ret_code=0)
+        engine.send.side_effect = socket.error
+        callback = mock.Mock()
+        ping.Ping("1.1.1.1", engine=engine).ping_async(callback)
+        self.assertEqual(ping.EXIT_STATUS.ERROR_SOCKET_ERROR,
+                         callback.call_args[0][0]["ret_code"])
+
+    @mock.patch("netmet.utils.ping.Ping.ping")
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_async_without_engine(self, mock_socket, mock_ping):
+        callback = mock.Mock()
+        ping.Ping("1.1.1.1").ping_async(callback)
+        callback.assert_called_once_with(mock_ping.return_value)
+
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_with_engine_failed(self, mock_socket):
+        engine = mock.MagicMock(ret_code=ping.EXIT_STATUS.ERROR_ROOT_REQUIRED)
+        p = ping.Ping("1.1.1.1", engine=engine)
+        self.assertEqual(ping.EXIT_STATUS.ERROR_ROOT_REQUIRED,
+                         p.ping()["ret_code"])
+        self.assertFalse(engine.ping.called)
+
+
+class EngineTestCase(test.TestCase):
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_start_and_stop(self, mock_socket):
+        engine = ping.Engine()
+        mock_socket.return_value.fileno.return_value = -1
+        with mock.patch.object(engine, "_receive"):
+            engine.start()
+            receiver = engine._receiver
+            engine.start()   # test that start() can be called 2 times
+            self.assertIs(receiver, engine._receiver)
+            self.assertEqual(mock_socket.return_value, engine.sock)
+            engine.stop()
+            engine.stop()   # test that stop() can be called 2 times
+
+        self.assertIsNone(engine.sock)
+        self.assertIsNone(engine._receiver)
+        mock_socket.return_value.close.assert_called_once_with()
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_start_root_required(self, mock_socket):
+        e = socket.error()
+        e.errno = 1
+        mock_socket.side_effect = e
+        engine = ping.Engine()
+        engine.start()
+        self.assertEqual(ping.EXIT_STATUS.ERROR_ROOT_REQUIRED, engine.ret_code)
+        self.assertIsNone(engine._receiver)
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_open_socket_dgram(self, mock_socket):
+        self.assertEqual((mock_socket.return_value, False, 0),
+                         ping.open_socket())
+        mock_socket.assert_called_once_with(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_open_socket_raw(self, mock_socket):
+        raw_socket = mock.Mock()
+        mock_socket.side_effect = [socket.error(13, "denied"), raw_socket]
+        self.assertEqual((raw_socket, True, 0), ping.open_socket())
+        mock_socket.assert_called_with(
+            socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_open_socket_failed(self, mock_socket):
+        mock_socket.side_effect = [socket.error(13, "denied"),
+                                   socket.error(1, "not permitted")]
+        self.assertEqual((None, True, ping.EXIT_STATUS.ERROR_ROOT_REQUIRED),
+                         ping.open_socket())
+
+        mock_socket.side_effect = [socket.error(13, "denied"),
+                                   socket.error(24, "too many files")]
+        self.assertEqual(
+            (None, True, ping.EXIT_STATUS.ERROR_CANT_OPEN_SOCKET),
+            ping.open_socket())
+
+    def test_next_id(self):
+        engine = ping.Engine()
+        first = engine.next_id()
+        self.assertEqual((first + 1) & 0xffff, engine.next_id())
+
+    def test_send_not_started(self):
+        self.assertRaises(socket.error, ping.Engine().send,
+                          "1.1.1.1", "packet", 1, 1, 1, mock.Mock())
+
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_send(self, mock_monotonic):
+        engine = ping.Engine()
+        engine.sock = mock.MagicMock()
+        engine.sock.sendto.side_effect = lambda p, a: len(p)
+        mock_monotonic.return_value = 10
+        callback = mock.Mock()
+
+        engine.send("1.1.1.1", "packet", 5, 1, 2, callback)
+        engine.sock.sendto.assert_called_once_with("packet", ("1.1.1.1", 1))
+        self.assertEqual({("1.1.1.1", 5, 1): [10, 12, callback, None]},
+                         engine._probes)
+        self.assertEqual([(12, ("1.1.1.1", 5, 1))], engine._deadlines)
+        self.assertFalse(callback.called)
+
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_send_dgram(self, mock_monotonic):
+        engine = ping.Engine()
+        engine.raw = False
+        engine._sequences = iter([70000])
+        engine.sock = mock.MagicMock()
+        engine.sock.sendto.side_effect = lambda p, a: len(p)
+        mock_monotonic.return_value = 10
+        callback = mock.Mock()
+
+        packet = struct.pack("bbHHh", 8, 0, 0, 5, 1) + "QQ"
+        engine.send("1.1.1.1", packet, 5, 1, 2, callback)
+        sequence = 70000 & 0xffff
+        engine.sock.sendto.assert_called_once_with(
+            struct.pack("bbHHH", 8, 0, 0, 5, sequence) + "QQ",
+            ("1.1.1.1", 1))
+        self.assertEqual({("1.1.1.1", 0, sequence): [10, 12, callback, None]},
+                         engine._probes)
+
+    def test_send_failed(self):
+        engine = ping.Engine()
+        engine.sock = mock.MagicMock()
+        engine.sock.sendto.side_effect = socket.error
+        self.assertRaises(socket.error, engine.send,
+                          "1.1.1.1", "packet", 5, 1, 2, mock.Mock())
+        self.assertEqual({}, engine._probes)
+        self.assertEqual([], engine._deadlines)
+
+    @mock.patch("netmet.utils.ping.Engine.send")
+    def test_ping(self, mock_send):
+        engine = ping.Engine()
+        mock_send.side_effect = lambda *args: args[-1](250)
+        self.assertEqual(250, engine.ping("1.1.1.1", "packet", 5, 1, 1))
+        mock_send.assert_called_once_with("1.1.1.1", "packet", 5, 1, 1,
+                                          mock.ANY)
+
+    @mock.patch("netmet.utils.ping.Engine.send")
+    def test_ping_timeout(self, mock_send):
+        engine = ping.Engine()
+        mock_send.side_effect = lambda *args: args[-1](None)
+        self.assertIsNone(engine.ping("1.1.1.1", "packet", 5, 1, 1))
+
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_read(self, mock_monotonic):
+        engine = ping.Engine()
+        engine.sock = mock.MagicMock()
+        probe = [2, 4, mock.Mock()]
+        late = [1, 2, mock.Mock()]
+        other = [2, 4, mock.Mock()]
+        engine._probes = {("1.1.1.1", 7, 1): probe,
+                          ("1.1.1.1", 8, 1): late,
+                          ("2.2.2.2", 8, 1): other}
+
+        def reply(type_, id_):
+            resp = "_" * 20 + struct.pack("bbHHh", type_, 0, 1, id_, 1)
+            return resp, ("1.1.1.1", 0)
+
+        eagain = socket.error()
+        eagain.errno = errno.EAGAIN
+        engine.sock.recvfrom.side_effect = [
+            reply(8, 7), reply(0, 7), reply(0, 8), eagain]
+        mock_monotonic.return_value = 3
+        engine._read()
+
+        probe[2].assert_called_once_with(1000)
+        late[2].assert_called_once_with(None)
+        self.assertFalse(other[2].called)
+        self.assertEqual({("2.2.2.2", 8, 1): other}, engine._probes)
+
+    @mock.patch("netmet.utils.ping.fcntl.ioctl")
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_create_socket_kernel_timestamps(self, mock_socket, mock_ioctl):
+        engine = ping.Engine(kernel_timestamps=True)
+        mock_ioctl.side_effect = IOError(errno.ENOENT, "no packets")
+        engine._create_socket()
+        mock_ioctl.assert_called_once_with(
+            mock_socket.return_value.fileno.return_value, ping.SIOCGSTAMPNS,
+            mock.ANY)
+        self.assertTrue(engine.kernel_timestamps)
+
+        mock_ioctl.side_effect = IOError(errno.ENOTTY, "not supported")
+        engine._create_socket()
+        self.assertFalse(engine.kernel_timestamps)
+
+    @mock.patch("netmet.utils.ping.fcntl.ioctl")
+    def test_rx_timestamp(self, mock_ioctl):
+        engine = ping.Engine(kernel_timestamps=True)
+        engine.sock = mock.MagicMock()
+        mock_ioctl.return_value = struct.pack("ll", 10, 500000000)
+        self.assertEqual(10.5, engine._rx_timestamp())
+        mock_ioctl.assert_called_once_with(
+            engine.sock.fileno.return_value, ping.SIOCGSTAMPNS, mock.ANY)
+
+        mock_ioctl.side_effect = IOError
+        self.assertIsNone(engine._rx_timestamp())
+
+    @mock.patch("netmet.utils.ping.Engine._rx_timestamp")
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_read_kernel_timestamps(self, mock_monotonic, mock_rx_timestamp):
+        engine = ping.Engine(kernel_timestamps=True)
+        engine.sock = mock.MagicMock()
+        probe = [2, 4, mock.Mock(), 100.5]
+        engine._probes = {("1.1.1.1", 7, 1): probe}
+
+        eagain = socket.error()
+        eagain.errno = errno.EAGAIN
+        resp = "_" * 20 + struct.pack("bbHHh", 0, 0, 1, 7, 1)
+        engine.sock.recvfrom.side_effect = [(resp, ("1.1.1.1", 0)), eagain]
+        mock_monotonic.return_value = 3
+        mock_rx_timestamp.return_value = 100.75
+        engine._read()
+
+        probe[2].assert_called_once_with(250)
+
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_read_dgram(self, mock_monotonic):
+        engine = ping.Engine()
+        engine.raw = False
+        engine.sock = mock.MagicMock()
+        probe = [2, 4, mock.Mock(), None]
+        engine._probes = {("1.1.1.1", 0, 40000): probe}
+
+        eagain = socket.error()
+        eagain.errno = errno.EAGAIN
+        resp = struct.pack("bbHHH", 0, 0, 1, 61581, 40000)
+        engine.sock.recvfrom.side_effect = [(resp, ("1.1.1.1", 0)), eagain]
+        mock_monotonic.return_value = 3
+        engine._read()
+
+        probe[2].assert_called_once_with(1000)
+        self.assertEqual({}, engine._probes)
+
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_expire(self, mock_monotonic):
+        engine = ping.Engine()
+        expired = [0, 1, mock.Mock()]
+        resent = [2, 4, mock.Mock()]
+        alive = [2, 4, mock.Mock()]
+        engine._probes = {"a": expired, "b": resent, "c": alive}
+        engine._deadlines = [(1, "a"), (2, "b"), (4, "c")]
+        mock_monotonic.return_value = 3
+
+        engine._expire()
+        expired[2].assert_called_once_with(None)
+        self.assertFalse(resent[2].called)
+        self.assertFalse(alive[2].called)
+        self.assertEqual({"b": resent, "c": alive}, engine._probes)
+        self.assertEqual([(4, "c")], engine._deadlines)
+
+    @mock.patch("netmet.utils.ping.monotonic.monotonic")
+    def test_next_wait(self, mock_monotonic):
+        engine = ping.Engine()
+        mock_monotonic.return_value = 3
+        self.assertEqual(engine.max_poll_interval, engine._next_wait())
+        engine._deadlines = [(3.05, "a")]
+        self.assertAlmostEqual(0.05, engine._next_wait())
+        engine._deadlines = [(2, "a")]
+        self.assertEqual(0, engine._next_wait())
+
+    @mock.patch("netmet.utils.ping.socket.socket")
+    def test_stop_expires_probes(self, mock_socket):
+        engine = ping.Engine()
+        with mock.patch.object(engine, "_receive"):
+            engine.start()
+            callback = mock.Mock()
+            engine._probes = {"a": [0, 1, callback]}
+            engine.stop()
+
+        callback.assert_called_once_with(None)
+        self.assertEqual({}, engine._probes)
+
+
+class TrainTestCase(test.TestCase):
+
+    def _result(self, rtt, ret_code=0):
+        return {"rtt": rtt, "ret_code": ret_code, "packet_size": 55,
+                "timeout": 1, "timestamp": "ts", "dest": "1.1.1.1",
+                "dest_ip": None}
+
+    def test_train_stats(self):
+        results = [self._result(10), self._result(None, 2),
+                   self._result(14), self._result(12)]
+        stats = ping.train_stats(results, 0.1)
+        self.assertEqual(ping.EXIT_STATUS.SUCCESS, stats["ret_code"])
+        self.assertEqual(12, stats["rtt"])
+        self.assertEqual(10, stats["rtt_min"])
+        self.assertEqual(14, stats["rtt_max"])
+        self.assertAlmostEqual(1.63299, stats["rtt_stddev"], places=4)
+        self.assertEqual(3, stats["jitter"])
+        self.assertEqual(4, stats["count"])
+        self.assertEqual(3, stats["received"])
+        self.assertEqual(1, stats["lost"])
+        self.assertEqual(0.25, stats["loss"])
+        self.assertEqual("ts", stats["timestamp"])
+
+    def test_train_stats_all_lost(self):
+        stats = ping.train_stats([self._result(None, 2)] * 2, 0.1)
+        self.assertEqual(ping.EXIT_STATUS.ERROR_TIMEOUT, stats["ret_code"])
+        self.assertIsNone(stats["rtt"])
+        self.assertIsNone(stats["jitter"])
+        self.assertEqual(2, stats["lost"])
+        self.assertEqual(1, stats["loss"])
+
+    @mock.patch("netmet.utils.ping.time.sleep")
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_train_with_engine(self, mock_socket, mock_sleep):
+        engine = mock.MagicMock(ret_code=0)
+        engine.next_id.return_value = 42
+        rtts = iter([10, 12, 14])
+        engine.send.side_effect = lambda *args: args[-1](next(rtts))
+        callback = mock.Mock()
+
+        p = ping.Ping("1.1.1.1", engine=engine)
+        p.ping_train(3, 0.05, callback)
+
+        self.assertEqual(2, mock_sleep.call_count)
+        mock_sleep.assert_called_with(0.05)
+        engine.send.assert_has_calls([
+            mock.call("1.1.1.1", p._create_packet(42, i), 42, i, 1, mock.ANY)
+            for i in xrange(1, 4)])
+        stats = callback.call_args[0][0]
+        self.assertEqual(1, callback.call_count)
+        self.assertEqual(12, stats["rtt"])
+        self.assertEqual(2, stats["jitter"])
+        self.assertEqual(3, stats["received"])
+
+    @mock.patch("netmet.utils.ping.time.sleep")
+    @mock.patch("netmet.utils.ping.Ping.ping")
+    @mock.patch("netmet.utils.ping.socket")
+    def test_ping_train_without_engine(self, mock_socket, mock_ping,
+                                       mock_sleep):
+        mock_ping.side_effect = [self._result(10), self._result(None, 2)]
+        callback = mock.Mock()
+        ping.Ping("1.1.1.1").ping_train(2, 0.05, callback)
+
+        self.assertEqual(2, mock_ping.call_count)
+        stats = callback.call_args[0][0]
+        self.assertEqual(1, stats["lost"])
+        self.assertEqual(10, stats["rtt"])
@@ -1,6 +1,9 @@
 # Copyright 2017: Godaddy Inc.
 
 import json
+import os
+import shutil
+import tempfile
 import threading
 import time
 
@@ -8,6 +11,7 @@ import futurist
 import mock
 import requests
 
+from netmet.utils import batch
 from netmet.utils import pusher
 from tests.unit import test
 
@@ -60,13 +64,30 @@ class PusherTestCase(test.TestCase):
         mock_session.return_value.post.assert_has_calls(calls)
         self.assertEqual(4, mock_session.return_value.post.call_count)
 
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_json_default(self, mock_session):
+        mock_session.return_value.post.return_value = (
+            mock.Mock(status_code=201))
+
+        p = pusher.Pusher("http://some_url", json_default=lambda x: x.value)
+        p._death = threading.Event()
+        p.add(mock.Mock(value=10))
+        p.add(20)
+        p._send()
+
+        mock_session.return_value.post.assert_called_once_with(
+            "http://some_url", data=json.dumps([10, 20]), headers={},
+            timeout=2)
+
     @mock.patch("netmet.utils.pusher.requests.session")
     def test_send_hmac(self, mock_session):
         mock_session.return_value.post.return_value = (
             mock.Mock(status_code=201))
+        on_response = mock.Mock()
 
         p = pusher.Pusher("http://some_url", timeout=5,
-                          extra_headers=lambda x: {"a": "a"}, max_count=10)
+                          extra_headers=lambda x: {"a": "a"}, max_count=10,
+                          on_response=on_response)
         p._death = threading.Event()
         for i in xrange(11):
             p.add(i)
@@ -77,6 +98,8 @@ class PusherTestCase(test.TestCase):
             "http://some_url",
             data=json.dumps(range(0, 10)), headers={"a": "a"}, timeout=5)
         self.assertEqual(1, mock_session.return_value.post.call_count)
+        on_response.assert_called_once_with(
+            mock_session.return_value.post.return_value)
 
     def test_send_periodically_stops(self):
         p = pusher.Pusher("")
@@ -115,3 +138,243 @@ class PusherTestCase(test.TestCase):
         mock_send_periodically.assert_called_once_with()
         p.stop()
         p.stop()   # test that stop() can be called 2 times
+
+    def test_encode(self):
+        p = pusher.Pusher("")
+        self.assertEqual(("[1]", {}), p._encode([1]))
+
+        p = pusher.Pusher("", compact=True)
+        data, headers = p._encode([1])
+        self.assertEqual([1], batch.loads(data))
+        self.assertEqual({"Content-Type": batch.CONTENT_TYPE}, headers)
+
+        p = pusher.Pusher("", compress=True)
+        data, headers = p._encode([1])
+        self.assertEqual("[1]", batch.decompress(data))
+        self.assertEqual({"Content-Type": "application/json",
+                          "Content-Encoding": "gzip"}, headers)
+
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_compact_fallback(self, mock_session):
+        mock_session.return_value.post.side_effect = [
+            mock.Mock(status_code=400),
+            mock.Mock(status_code=201)
+        ]
+        p = pusher.Pusher("http://some_url", compact=True, compress=True,
+                          extra_headers=lambda x: {"a": "a"})
+        p._death = threading.Event()
+        p.add(1)
+        p._send()
+
+        calls = mock_session.return_value.post.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual({"Content-Type": batch.CONTENT_TYPE,
+                          "Content-Encoding": "gzip", "a": "a"},
+                         calls[0][1]["headers"])
+        self.assertEqual([1], batch.loads(
+            batch.decompress(calls[0][1]["data"])))
+        self.assertEqual(mock.call("http://some_url", data="[1]",
+                                   headers={"a": "a"}, timeout=2), calls[1])
+        self.assertFalse(p.compact)
+        self.assertFalse(p.compress)
+
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_adaptive(self, mock_session):
+        mock_session.return_value.post.side_effect = [
+            mock.Mock(status_code=503),
+            mock.Mock(status_code=429, headers={"Retry-After": "2"}),
+            mock.Mock(status_code=201),
+            mock.Mock(status_code=201)
+        ]
+        p = pusher.Pusher("http://some_url", max_count=40, period=100,
+                          adaptive=True)
+        p.window.min_count = p.window.step = 10
+        p._death = mock.MagicMock()
+        p._death.is_set.return_value = False
+        for i in xrange(45):
+            p.add(i)
+
+        p._send()
+        sent = [json.loads(call[1]["data"])
+                for call in mock_session.return_value.post.call_args_list]
+        self.assertEqual([range(40), range(20), range(10), range(10, 30)],
+                         sent)
+        self.assertEqual(range(30, 45), list(p.objects))
+        self.assertEqual(30, p.window.count)
+        waits = [c[0][0] for c in p._death.wait.call_args_list]
+        self.assertTrue(0.2 <= waits[0] <= 0.4)
+        self.assertTrue(1 <= waits[1] <= 2)
+
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_adaptive_gives_up(self, mock_session):
+        mock_session.return_value.post.side_effect = (
+            requests.exceptions.RequestException)
+        p = pusher.Pusher("http://some_url", period=1, adaptive=True)
+        p._death = mock.MagicMock()
+        p._death.is_set.return_value = False
+        p.add(1)
+
+        p._send()
+        # delays 0.4, 0.8 and 1.6 that is longer than period
+        self.assertEqual(3, mock_session.return_value.post.call_count)
+        self.assertEqual([1], list(p.objects))
+        self.assertTrue(1 <= p._next_interval() <= 1.6)
+
+    def test_add_drops_oldest(self):
+        p = pusher.Pusher("", max_memory=3)
+        for i in xrange(5):
+            p.add(i)
+        self.assertEqual([2, 3, 4], list(p.objects))
+        self.assertEqual(2, p.dropped)
+
+
+class WindowTestCase(test.TestCase):
+
+    def test_update_success(self):
+        w = pusher.Window(100, min_count=10, min_delay=0.5)
+        w.count, w.delay = 50, 4
+        w.update(201, 0.1)
+        self.assertEqual((60, 2), (w.count, w.delay))
+        w.update(202, 0.1)
+        self.assertEqual((70, 1), (w.count, w.delay))
+        for i in xrange(10):
+            w.update(201, 0.1)
+        self.assertEqual((100, 0.5), (w.count, w.delay))
+
+    def test_update_slow(self):
+        w = pusher.Window(100, target_latency=1)
+        w.update(201, 3)
+        self.assertEqual((50, 3), (w.count, w.delay))
+
+    def test_update_overloaded(self):
+        w = pusher.Window(100, min_count=10, min_delay=1, max_delay=5)
+        for status, count, delay in [(500, 50, 2), (None, 25, 4),
+                                     (429, 12, 5), (429, 10, 5)]:
+            w.update(status, 0.1)
+            self.assertEqual((count, delay), (w.count, w.delay))
+
+    def test_update_other_errors(self):
+        w = pusher.Window(100, min_delay=1, max_delay=60)
+        w.update(403, 0.1)
+        self.assertEqual((100, 2), (w.count, w.delay))
+        w.update(429, 0.1, retry_after=30)
+        self.assertEqual((50, 30), (w.count, w.delay))
+
+    def test_wait_time(self):
+        w = pusher.Window(100)
+        w.delay = 10
+        waits = set(w.wait_time() for i in xrange(20))
+        self.assertTrue(all(5 <= x <= 10 for x in waits))
+        self.assertGreater(len(waits), 1)
+
+
+class PusherSpoolTestCase(test.TestCase):
+
+    def setUp(self):
+        super(PusherSpoolTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super(PusherSpoolTestCase, self).tearDown()
+
+    def test_add_spills(self):
+        p = pusher.Pusher("", max_memory=3, spool_dir=self.path)
+        for i in xrange(6):
+            p.add(i)
+        self.assertEqual([0, 1, 2], list(p.objects))
+        self.assertFalse(p.spool.empty())
+
+        p.objects.popleft()
+        p.add(6)   # goes after spooled objects to keep order
+        self.assertEqual([1, 2], list(p.objects))
+        self.assertTrue(p._refill())
+        self.assertEqual([1, 2, 3], list(p.objects))
+        p.objects.clear()
+        self.assertTrue(p._refill())
+        self.assertEqual([4, 5, 6], list(p.objects))
+        p.objects.clear()
+        self.assertTrue(p._refill())
+        self.assertEqual([], list(p.objects))
+        self.assertTrue(p.spool.empty())
+        self.assertFalse(p._refill())
+
+    @mock.patch("netmet.utils.pusher.LOG")
+    @mock.patch("netmet.utils.pusher.Pusher._send_periodically")
+    def test_spool_fails(self, mock_send_periodically, mock_log):
+        # spool dir can't be created, as its parent is file
+        open(self.path, "w").close()
+        p = pusher.Pusher("", max_memory=2,
+                          spool_dir=os.path.join(self.path, "spool"))
+        p.start()
+        for i in xrange(4):
+            p.add(i)
+        self.assertEqual([2, 3], list(p.objects))
+        self.assertEqual(2, p.dropped)
+        self.assertEqual(2, p.spool_errors)
+        self.assertEqual(1, len([c for c in mock_log.warning.call_args_list
+                                 if "spool" in c[0][0]]))
+
+        p.stop()
+        self.assertEqual([2, 3], list(p.objects))
+        self.assertEqual(1, mock_log.exception.call_count)
+
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_drains_spool(self, mock_session):
+        mock_session.return_value.post.return_value = (
+            mock.Mock(status_code=201))
+        p = pusher.Pusher("http://some_url", max_memory=5, max_count=4,
+                          spool_dir=self.path, dealey_between_requests=0,
+                          drain_rate=100000)
+        p._death = threading.Event()
+        for i in xrange(20):
+            p.add(i)
+
+        p._send()
+        self.assertTrue(p.spool.empty())
+        self.assertEqual(0, len(p.objects))
+        sent = []
+        for call in mock_session.return_value.post.call_args_list:
+            sent.extend(json.loads(call[1]["data"]))
+        self.assertEqual(range(20), sent)
+
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_drain_rate(self, mock_session):
+        mock_session.return_value.post.return_value = (
+            mock.Mock(status_code=201))
+        p = pusher.Pusher("http://some_url", max_memory=2, max_count=2,
+                          spool_dir=self.path, drain_rate=5)
+        p._death = mock.MagicMock()
+        p._death.is_set.return_value = False
+        for i in xrange(6):
+            p.add(i)
+
+        p._send()
+        p._death.wait.assert_has_calls([mock.call(0.4), mock.call(0.4)])
+
+    @mock.patch("netmet.utils.pusher.requests.session")
+    def test_send_keeps_body_on_death(self, mock_session):
+        p = pusher.Pusher("http://some_url", max_count=2)
+        p._death = mock.MagicMock()
+        p._death.is_set.side_effect = [False, True]
+        mock_session.return_value.post.return_value = (
+            mock.Mock(status_code=500))
+        for i in xrange(3):
+            p.add(i)
+
+        p._send()
+        self.assertEqual([0, 1, 2], list(p.objects))
+
+    @mock.patch("netmet.utils.pusher.Pusher._send_periodically")
+    def test_stop_moves_objects_to_spool(self, mock_send_periodically):
+        p = pusher.Pusher("", max_memory=2, spool_dir=self.path)
+        p.start()
+        for i in xrange(4):
+            p.add(i)
+        p.stop()
+        self.assertEqual(0, len(p.objects))
+
+        p = pusher.Pusher("", max_memory=10, spool_dir=self.path)
+        self.assertTrue(p._refill())
+        self.assertEqual([0, 1, 2, 3], list(p.objects))
@@ -0,0 +1,97 @@
+# Copyright 2017: Godaddy Inc.
+
+import socket
+
+import mock
+
+from netmet.utils import resolver
+from tests.unit import test
+
+
+class ResolverTestCase(test.TestCase):
+
+    def test_get(self):
+        self.assertIsInstance(resolver.get(), resolver.Resolver)
+        self.assertIs(resolver.get(), resolver.get())
+
+    def test_is_ip(self):
+        self.assertTrue(resolver.is_ip("1.2.3.4"))
+        self.assertFalse(resolver.is_ip("example.com"))
+        self.assertFalse(resolver.is_ip(None))
+
+    @mock.patch("netmet.utils.resolver.socket.gethostbyname")
+    def test_resolve_ip(self, mock_gethostbyname):
+        r = resolver.Resolver()
+        self.assertEqual(("1.2.3.4", 0), r.resolve("1.2.3.4"))
+        self.assertFalse(mock_gethostbyname.called)
+
+    @mock.patch("netmet.utils.resolver.monotonic.monotonic")
+    @mock.patch("netmet.utils.resolver.socket.gethostbyname")
+    def test_resolve_cached(self, mock_gethostbyname, mock_monotonic):
+        mock_gethostbyname.return_value = "1.2.3.4"
+        mock_monotonic.side_effect = [1, 1.5, 2]
+        r = resolver.Resolver(ttl=60)
+
+        self.assertEqual(("1.2.3.4", 500), r.resolve("host"))
+        self.assertEqual(("1.2.3.4", 0), r.resolve("host"))
+        mock_gethostbyname.assert_called_once_with("host")
+
+    @mock.patch("netmet.utils.resolver.monotonic.monotonic")
+    @mock.patch("netmet.utils.resolver.socket.gethostbyname")
+    def test_resolve_expired(self, mock_gethostbyname, mock_monotonic):
+        mock_gethostbyname.side_effect = ["1.2.3.4", "4.3.2.1"]
+        mock_monotonic.side_effect = [0, 1, 62, 62, 63]
+        r = resolver.Resolver(ttl=60)
+
+        self.assertEqual(("1.2.3.4", 1000), r.resolve("host"))
+        self.assertEqual(("4.3.2.1", 1000), r.resolve("host"))
+        self.assertEqual(2, mock_gethostbyname.call_count)
+
+    @mock.patch("netmet.utils.resolver.monotonic.monotonic")
+    @mock.patch("netmet.utils.resolver.socket.gethostbyname")
+    def test_resolve_negative(self, mock_gethostbyname, mock_monotonic):
+        mock_gethostbyname.side_effect = [socket.gaierror, "1.2.3.4"]
+        mock_monotonic.side_effect = [0, 0, 5, 11, 11, 11]
+        r = resolver.Resolver(ttl=60, negative_ttl=10)
+
+        self.assertEqual((None, 0), r.resolve("host"))
+        self.assertEqual((None, 0), r.resolve("host"))
+        self.assertEqual(("1.2.3.4", 0), r.resolve("host"))
+        self.assertEqual(2, mock_gethostbyname.call_count)
+
+    @mock.patch("netmet.utils.resolver.Resolver._refresh_async")
+    @mock.patch("netmet.utils.resolver.monotonic.monotonic")
+    @mock.patch("netmet.utils.resolver.socket.gethostbyname")
+    def test_resolve_refresh_ahead(self, mock_gethostbyname, mock_monotonic,
+                                   mock_refresh_async):
+        mock_gethostbyname.return_value = "1.2.3.4"
+        mock_monotonic.side_effect = [0, 0, 30, 50]
+        r = resolver.Resolver(ttl=60, refresh_after=0.75)
+
+        r.resolve("host")
+        self.assertEqual(("1.2.3.4", 0), r.resolve("host"))
+        self.assertFalse(mock_refresh_async.called)
+        self.assertEqual(("1.2.3.4", 0), r.resolve("host"))
+        mock_refresh_async.assert_called_once_with("host")
+
+    @mock.patch("netmet.utils.resolver.socket.gethostbyname")
+    def test_refresh_async(self, mock_gethostbyname):
+        mock_gethostbyname.return_value = "4.3.2.1"
+        r = resolver.Resolver()
+        r._cache["host"] = ("1.2.3.4", 0)
+
+        with mock.patch("netmet.utils.resolver.threading.Thread") as thread:
+            r._refresh_async("host")
+            r._refresh_async("host")
+            thread.assert_called_once_with(target=r._refresh, args=("host",))
+            self.assertEqual(set(["host"]), r._refreshing)
+
+        r._refresh("host")
+        self.assertEqual("4.3.2.1", r._cache["host"][0])
+        self.assertEqual(set(), r._refreshing)
+
+    def test_clear(self):
+        r = resolver.Resolver()
+        r._cache["host"] = ("1.2.3.4", 0)
+        r.clear()
+        self.assertEqual({}, r._cache)
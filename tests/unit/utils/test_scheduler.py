@@ -0,0 +1,99 @@
+# Copyright 2017: GoDaddy Inc.
+
+import threading
+
+import mock
+
+from netmet.utils import scheduler
+from tests.unit import test
+
+
+class SchedulerTestCase(test.TestCase):
+
+    def test_phase(self):
+        self.assertEqual(scheduler.phase("a"), scheduler.phase("a"))
+        self.assertNotEqual(scheduler.phase("a"), scheduler.phase("b"))
+        for key in ["a", "b", "c", "some long key"]:
+            self.assertTrue(0 <= scheduler.phase(key) < 1)
+
+    def test_init_wrong_policy(self):
+        self.assertRaises(ValueError, scheduler.Scheduler, policy="wrong")
+
+    @mock.patch("netmet.utils.scheduler.time.time")
+    @mock.patch("netmet.utils.scheduler.monotonic.monotonic")
+    def test_add(self, mock_monotonic, mock_time):
+        mock_monotonic.return_value = 100
+        mock_time.return_value = 1003
+        s = scheduler.Scheduler()
+        s.add(10, "a", phase=0.5)
+        s.add(10, "b", phase=0.1)
+        s.add(5, "c")
+        # wall clock 1003: "a" runs at 1005, "b" at 1011, "c" at 1005
+        self.assertEqual([(102, 0), (108, 1), (102, 2)],
+                         sorted(s._queue, key=lambda x: x[1]))
+        self.assertEqual([(10, "a"), (10, "b"), (5, "c")], s._tasks)
+
+    def test_next_deadline_skip(self):
+        s = scheduler.Scheduler(policy=scheduler.SKIP)
+        self.assertEqual((11, 0), s._next_deadline(1, 10, 0.5))
+        self.assertEqual((31, 2), s._next_deadline(1, 10, 25))
+
+    def test_next_deadline_catch_up(self):
+        s = scheduler.Scheduler(policy=scheduler.CATCH_UP, max_catch_up=3)
+        self.assertEqual((11, 0), s._next_deadline(1, 10, 0.5))
+        self.assertEqual((11, 0), s._next_deadline(1, 10, 25))
+        self.assertEqual((31, 2), s._next_deadline(1, 10, 55))
+
+    def test_run(self):
+        s = scheduler.Scheduler()
+        death = threading.Event()
+        calls = []
+
+        def dispatch(task):
+            calls.append(task)
+            if len(calls) == 10:
+                death.set()
+            return task != "b"
+
+        s.add(0.01, "a")
+        s.add(0.01, "b", phase=0.5)
+        s.run(death, dispatch)
+
+        self.assertEqual(10, len(calls))
+        self.assertEqual(set(["a", "b"]), set(calls))
+        stats = s.stats()
+        self.assertEqual(2, stats["tasks"])
+        self.assertEqual(10, stats["runs"])
+        self.assertEqual(calls.count("b"), stats["skipped"])
+        self.assertGreaterEqual(stats["lag_max"], stats["lag_avg"])
+
+    @mock.patch("netmet.utils.scheduler.LOG")
+    def test_count_warns(self, mock_log):
+        s = scheduler.Scheduler()
+        s._count(0.1, 0)
+        self.assertFalse(mock_log.warning.called)
+        s._count(20, 2)
+        s._count(30, 1)
+        self.assertEqual(1, mock_log.warning.call_count)
+        self.assertEqual(
+            {"tasks": 0, "runs": 3, "skipped": 3, "lag_total": 50100,
+             "lag_max": 30000, "lag_avg": 16700},
+            s.stats())
+
+    def test_stats_empty(self):
+        self.assertEqual(
+            {"tasks": 0, "runs": 0, "skipped": 0, "lag_total": 0,
+             "lag_max": 0, "lag_avg": 0},
+            scheduler.Scheduler().stats())
+
+    def test_merge_stats(self):
+        self.assertEqual(
+            {"tasks": 3, "runs": 4, "skipped": 1, "lag_total": 40,
+             "lag_max": 20, "lag_avg": 10},
+            scheduler.merge_stats([
+                {"tasks": 1, "runs": 3, "skipped": 0, "lag_total": 30,
+                 "lag_max": 20, "lag_avg": 10},
+                {"tasks": 2, "runs": 1, "skipped": 1, "lag_total": 10,
+                 "lag_max": 10, "lag_avg": 10}
+            ]))
+        self.assertEqual(0, scheduler.merge_stats([])["lag_avg"])
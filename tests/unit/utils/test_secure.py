@@ -1,5 +1,6 @@
 # Copyright 2017: GoDaddy Inc.
 
+import flask
 import mock
 
 from netmet.utils import secure
@@ -16,8 +17,67 @@ class GenTestCase(test.TestCase):
         self.assertTrue(secure.is_valid_digest(digest, "abc", ["2", "3", "1"]))
         self.assertFalse(secure.is_valid_digest(digest, "abc", ["2", "3"]))
 
+    def test_generate_digest_v2(self):
+        self.assertEqual(secure.generate_digest_v2("a", "1", "k"),
+                         secure.generate_digest_v2("a", "1", "k"))
+        self.assertNotEqual(secure.generate_digest_v2("a", "1", "k"),
+                            secure.generate_digest_v2("a", "2", "k"))
+        self.assertNotEqual(secure.generate_digest_v2("a1", "", "k"),
+                            secure.generate_digest_v2("a", "1", "k"))
+
+    def test_key_id(self):
+        self.assertEqual(16, len(secure.key_id("a")))
+        self.assertEqual(secure.key_id("a"), secure.key_id("a"))
+        self.assertNotEqual(secure.key_id("a"), secure.key_id("b"))
+
+    def test_is_valid_digest_v2(self):
+        digest = secure.generate_digest_v2("abc", "10", "1")
+        self.assertTrue(
+            secure.is_valid_digest_v2(digest, "abc", "10", ["2", "1"]))
+        self.assertTrue(secure.is_valid_digest_v2(
+            digest, "abc", "10", ["2", "1"], kid=secure.key_id("1")))
+        self.assertFalse(secure.is_valid_digest_v2(
+            digest, "abc", "10", ["2", "1"], kid=secure.key_id("2")))
+        self.assertFalse(
+            secure.is_valid_digest_v2(digest, "abc", "11", ["2", "1"]))
+
+    @mock.patch.dict(secure._PEER_VERSIONS, clear=True)
+    @mock.patch.dict("netmet.config._DATA", {"hmac_version": None})
+    def test_gen_hmac_headers_negotiated(self):
+        url = "http://peer:5000/api/v2/config"
+        self.assertEqual(1, secure.hmac_version(url))
+        self.assertNotIn("X-AUTH-HMAC-VERSION",
+                         secure.gen_hmac_headers("d", hmac="h", url=url))
+
+        secure.learn_hmac_version(
+            url, mock.Mock(headers={"X-AUTH-HMAC-VERSIONS": "1,2,3"}))
+        self.assertEqual(2, secure.hmac_version(url))
+        self.assertEqual(1, secure.hmac_version("http://other:5000"))
+        h = secure.gen_hmac_headers("d", hmac="h", url=url)
+        self.assertEqual("2", h["X-AUTH-HMAC-VERSION"])
+
+        # peer was downgraded
+        secure.learn_hmac_version(url, mock.Mock(headers={}))
+        self.assertEqual(1, secure.hmac_version(url))
+
+    @mock.patch.dict(secure._PEER_VERSIONS, clear=True)
+    @mock.patch.dict("netmet.config._DATA", {"hmac_version": 1})
+    def test_hmac_version_from_config(self):
+        url = "http://peer:5000"
+        secure.learn_hmac_version(
+            url, mock.Mock(headers={"X-AUTH-HMAC-VERSIONS": "1,2"}))
+        self.assertEqual(1, secure.hmac_version(url))
+
     def test_gen_hmac_headers(self):
-        h = secure.gen_hmac_headers("d", hmac="h")
+        h = secure.gen_hmac_headers("d", hmac="h", version=2)
+        self.assertEqual("2", h["X-AUTH-HMAC-VERSION"])
+        self.assertEqual(secure.key_id("h"), h["X-AUTH-HMAC-KEY-ID"])
+        self.assertTrue(secure.is_valid_digest_v2(
+            h["X-AUTH-HMAC-DIGEST"], "d", h["X-AUTH-HMAC-TIMESTAMP"], ["h"]))
+
+    def test_gen_hmac_headers_v1(self):
+        h = secure.gen_hmac_headers("d", hmac="h", version=1)
+        self.assertNotIn("X-AUTH-HMAC-VERSION", h)
         self.assertIn("X-AUTH-HMAC-TIMESTAMP", h)
         self.assertIn("X-AUTH-HMAC-DIGEST", h)
 
@@ -33,7 +93,8 @@ class GenTestCase(test.TestCase):
 
     @mock.patch("netmet.config.get")
     def test_get_hmac_headers_env(self, mock_get):
-        mock_get.return_value = ["a", "b"]
+        cfg = {"hmac_keys": ["a", "b"], "hmac_version": 1}
+        mock_get.side_effect = lambda x, *args: cfg[x]
 
         h = secure.gen_hmac_headers("d")
         self.assertIn("X-AUTH-HMAC-TIMESTAMP", h)
@@ -101,6 +162,60 @@ class GenTestCase(test.TestCase):
 
         self.assertEqual(403, f(3, 2)[1])
 
+    @mock.patch.dict("netmet.config._DATA", {"hmac_skip_check": False,
+                                             "hmac_keys": ["a"]})
+    def test_check_hmac_auth_advertises_versions(self):
+        app = flask.Flask(__name__)
+
+        @app.route("/", methods=["POST"])
+        @secure.check_hmac_auth
+        def f():
+            return "ok"
+
+        client = app.test_client()
+        for headers in [{}, secure.gen_hmac_headers("d", version=1)]:
+            r = client.post("/", data="d", headers=headers)
+            self.assertEqual("1,2", r.headers["X-AUTH-HMAC-VERSIONS"])
+        self.assertEqual(200, r.status_code)
+
+    def _check_hmac_auth(self, headers, data="some_data", now="22"):
+        cfg = {"hmac_skip_check": False, "hmac_keys": ["a", "b"]}
+
+        @secure.check_hmac_auth
+        def f():
+            return "ok"
+
+        with mock.patch("netmet.utils.secure.config.get") as mock_conf_get:
+            mock_conf_get.side_effect = lambda x: cfg[x]
+            with mock.patch("netmet.utils.secure.flask") as mock_flask:
+                mock_flask.request.get_data.return_value = data
+                mock_flask.request.headers = headers
+                with mock.patch("netmet.utils.secure.datetime") as mock_dt:
+                    now_ = mock_dt.datetime.now.return_value
+                    now_.strftime.return_value = now
+                    result = f()
+        return result if isinstance(result, str) else result[1]
+
+    def test_check_hmac_auth_v1(self):
+        headers = secure.gen_hmac_headers("some_data", hmac="b", version=1)
+        self.assertEqual("ok", self._check_hmac_auth(
+            headers, now=headers["X-AUTH-HMAC-TIMESTAMP"]))
+
+    def test_check_hmac_auth_v2(self):
+        headers = secure.gen_hmac_headers("some_data", hmac="b", version=2)
+        now = headers["X-AUTH-HMAC-TIMESTAMP"]
+        self.assertEqual("ok", self._check_hmac_auth(headers, now=now))
+        self.assertEqual(403, self._check_hmac_auth(
+            headers, data="other_data", now=now))
+
+        headers.pop("X-AUTH-HMAC-KEY-ID")
+        self.assertEqual("ok", self._check_hmac_auth(headers, now=now))
+        headers["X-AUTH-HMAC-KEY-ID"] = secure.key_id("a")
+        self.assertEqual(403, self._check_hmac_auth(headers, now=now))
+        headers["X-AUTH-HMAC-KEY-ID"] = secure.key_id("b")
+        headers["X-AUTH-HMAC-VERSION"] = "3"
+        self.assertEqual(403, self._check_hmac_auth(headers, now=now))
+
     @mock.patch("netmet.utils.secure.flask")
     @mock.patch("netmet.utils.secure.config.get")
     def test_check_basic_auth_invlid(self, mock_conf_get, mock_flask):
@@ -0,0 +1,114 @@
+# Copyright 2017: GoDaddy Inc.
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from netmet.utils import spool
+from tests.unit import test
+
+
+class SpoolTestCase(test.TestCase):
+
+    def setUp(self):
+        super(SpoolTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super(SpoolTestCase, self).tearDown()
+
+    def test_empty(self):
+        s = spool.Spool(self.path)
+        self.assertTrue(s.empty())
+        self.assertEqual(0, s.size())
+        self.assertEqual([], s.read(10))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_append_read(self):
+        s = spool.Spool(self.path, segment_size=100)
+        s.append([{"a": i} for i in xrange(20)])
+        self.assertFalse(s.empty())
+        self.assertGreater(len(os.listdir(self.path)), 1)
+
+        self.assertEqual([{"a": i} for i in xrange(7)], s.read(7))
+        s.append([{"a": 20}])
+        self.assertEqual([{"a": i} for i in xrange(7, 21)], s.read(100))
+        self.assertTrue(s.empty())
+        self.assertEqual(0, s.size())
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_append_fails(self):
+        s = spool.Spool(self.path)
+        s.append([1])
+        writer = s._writer
+        s._writer = mock.MagicMock()
+        s._writer.tell.return_value = 0
+        s._writer.write.side_effect = IOError("No space left on device")
+        self.assertRaises(IOError, s.append, [2])
+        self.assertIsNone(s._writer)
+        writer.close()
+
+        s.append([3])
+        self.assertEqual([1, 3], s.read(10))
+
+    def test_prepend(self):
+        s = spool.Spool(self.path, segment_size=30)
+        s.append([3, 4, 5])
+        self.assertEqual([3], s.read(1))
+        s.prepend([1, 2])
+        s.prepend([])
+        s.append([6])
+        self.assertEqual([1, 2, 4, 5, 6], s.read(10))
+
+    def test_prepend_empty_spool(self):
+        s = spool.Spool(self.path)
+        s.prepend([1, 2])
+        s.append([3])
+        self.assertEqual([1, 2, 3], s.read(10))
+
+    def test_restore(self):
+        s = spool.Spool(self.path, segment_size=30)
+        s.append(range(10))
+        self.assertEqual([0, 1], s.read(2))
+        s.close()
+
+        s = spool.Spool(self.path, segment_size=30)
+        self.assertEqual(s.size(), sum(
+            os.path.getsize(os.path.join(self.path, f))
+            for f in os.listdir(self.path)))
+        self.assertEqual(range(2, 10), s.read(100))
+        s.append([10])
+        self.assertEqual([10], s.read(100))
+
+    def test_broken_frame(self):
+        s = spool.Spool(self.path)
+        s.append([1, 2])
+        s.close()
+        with open(os.path.join(self.path, "0.seg"), "ab") as f:
+            f.write("\x00\x00\x00\x10{\"broken")
+
+        s = spool.Spool(self.path)
+        self.assertEqual([1, 2], s.read(100))
+        self.assertTrue(s.empty())
+
+    def test_max_size(self):
+        s = spool.Spool(self.path, segment_size=20, max_size=50)
+        s.append(range(100, 130))
+        self.assertLessEqual(s.size(), 70)
+        self.assertGreater(s.dropped, 0)
+        items = s.read(100)
+        self.assertEqual(129, items[-1])
+        self.assertEqual(range(items[0], 130), items)
+
+    def test_json_default(self):
+        s = spool.Spool(self.path, json_default=lambda x: x.value)
+
+        class Obj(object):
+            value = {"a": 1}
+
+        s.append([Obj()])
+        self.assertEqual([{"a": 1}], s.read(1))